@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# Encoded Lightspeed Pascal (LSP) units inside archives and Macintosh
+# container formats, read in place instead of extracted to disk first.
+#
+# A unit copied off a Mac usually comes wrapped.  MacBinary (I, II or III)
+# puts a 128 byte header before the data fork and the resource fork after
+# it; AppleSingle puts a table of entries before all of them.  The encoded
+# source is the data fork, which unwrap() cuts out of a loaded file and
+# openDataFork() limits a stream to.  Archive members are always unwrapped,
+# but a file named on the command line only with --unwrap (see
+# addUnwrapArgument), since a plain unit can start with bytes that look
+# like a header.  AppleDouble keeps the data fork in the plain file and the
+# rest in a "._" companion (or under __MACOSX in a zip), and those are
+# skipped like any hidden file.
+#
+# Zip and tar archives (tar optionally gzip or bzip2 compressed) are read a
+# member at a time: a tar as one stream, a zip in the order its members are
+# stored, so either way the archive is read once from start to end.  Only
+# the member being decoded is in memory, and none bigger than
+# MAX_MEMBER_SIZE is read at all.
+
+import argparse
+import binascii
+import functools
+import os
+import posixpath
+import struct
+import sys
+import tarfile
+import zipfile
+# lspDecoder imports this module in turn
+import lspDecoder
+import lspTrace
+
+MAX_MEMBER_SIZE = 64 * 1024 * 1024
+
+# enough of the start of a file to recognize any of the formats
+PEEK_SIZE = 1024
+
+MACBINARY_HEADER_SIZE = 128
+
+APPLE_SINGLE = 0x00051600
+APPLE_DOUBLE = 0x00051607
+APPLE_VERSIONS = (0x00010000, 0x00020000)
+APPLE_DATA_FORK = 1
+
+
+def padded(n):
+    # MacBinary parts start on 128 byte boundaries
+    return (n + 127) & ~127
+
+
+def macBinarySpan(data, size):
+    # (start, length) of the data fork if data starts a MacBinary file of
+    # size bytes, else None.  Bytes 0, 74 and 82 are always zero; past that,
+    # MacBinary II and III carry a CRC of the header, and MacBinary I zeros.
+    if len(data) < MACBINARY_HEADER_SIZE or data[0] != '\0' or data[74] != '\0' or data[82] != '\0':
+        return None
+    if not 1 <= ord(data[1]) <= 63:
+        return None
+    crc, = struct.unpack_from('>H', data, 124)
+    if binascii.crc_hqx(data[:124], 0) != crc and data[102:106] != 'mBIN' and data[99:128].strip('\0'):
+        return None
+    dataLength, = struct.unpack_from('>I', data, 83)
+    secondaryLength, = struct.unpack_from('>H', data, 120)
+    start = MACBINARY_HEADER_SIZE + padded(secondaryLength)
+    if start + dataLength > size:
+        return None
+    return start, dataLength
+
+
+def appleEntries(data):
+    # (magic, {entry id: (offset, length)}) if data starts an AppleSingle or
+    # AppleDouble file, else None
+    if len(data) < 26:
+        return None
+    magic, version = struct.unpack_from('>II', data, 0)
+    if magic not in (APPLE_SINGLE, APPLE_DOUBLE) or version not in APPLE_VERSIONS:
+        return None
+    count, = struct.unpack_from('>H', data, 24)
+    if len(data) < 26 + 12 * count:
+        raise lspDecoder.DecodeError('AppleSingle header with %d entries is too long' % count)
+    entries = {}
+    for i in xrange(count):
+        entry, offset, length = struct.unpack_from('>III', data, 26 + 12 * i)
+        entries[entry] = (offset, length)
+    return magic, entries
+
+
+def archiveKind(data):
+    # 'zip' or 'tar' if data starts an archive, else None
+    if data[:4] in ('PK\x03\x04', 'PK\x05\x06'):
+        return 'zip'
+    if data[257:262] == 'ustar' or data[:2] == '\x1f\x8b' or data[:3] == 'BZh':
+        return 'tar'
+    return None
+
+
+def forkSpan(data, size):
+    # (wrapper, start, length) of the encoded unit in a file of size bytes
+    # that starts with data: the data fork of a MacBinary or AppleSingle
+    # file, or (None, 0, size) for a plain one
+    span = macBinarySpan(data, size)
+    if span is not None:
+        return ('MacBinary',) + span
+    apple = appleEntries(data)
+    if apple is not None:
+        magic, entries = apple
+        if APPLE_DATA_FORK not in entries:
+            if magic == APPLE_DOUBLE:
+                raise lspDecoder.DecodeError('AppleDouble header; the data fork is in the file of the same name')
+            raise lspDecoder.DecodeError('AppleSingle file without a data fork')
+        start, length = entries[APPLE_DATA_FORK]
+        if start + length > size:
+            raise lspDecoder.DecodeError('AppleSingle data fork runs past the end of the file')
+        return 'AppleSingle', start, length
+    kind = archiveKind(data)
+    if kind is not None:
+        raise lspDecoder.DecodeError('a %s archive, not a unit (lspBatch converts its members)' % kind)
+    return None, 0, size
+
+
+def unwrap(data):
+    # the encoded unit in a whole loaded file
+    wrapper, start, length = forkSpan(data[:PEEK_SIZE], len(data))
+    if wrapper is None:
+        return data
+    return data[start:start + length]
+
+
+class ForkReader(object):
+    # a file that ends where its data fork does, for the stream decoder
+    def __init__(self, f, length):
+        self.f = f
+        self.left = length
+        self.name = getattr(f, 'name', None)
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.f.read(n)
+        self.left -= len(data)
+        return data
+
+
+def openDataFork(infile):
+    # infile, moved to the start of its encoded unit and reading no further
+    # than the end of it
+    size = os.fstat(infile.fileno()).st_size
+    wrapper, start, length = forkSpan(infile.read(PEEK_SIZE), size)
+    infile.seek(start)
+    if wrapper is None:
+        return infile
+    return ForkReader(infile, length)
+
+
+def memberPath(name):
+    # the relative path of an archive member, or None if it isn't a unit:
+    # hidden files (AppleDouble companions among them), anything under
+    # __MACOSX, and names that would lead out of wherever it is converted to
+    path = posixpath.normpath(name.replace('\\', '/'))
+    parts = path.split('/')
+    if path.startswith('/') or '..' in parts:
+        lspTrace.warning('skipping archive member %s outside the archive' % name)
+        return None
+    if any(part.startswith('.') or part == '__MACOSX' for part in parts):
+        return None
+    return os.path.join(*parts)
+
+
+def checkSize(name, size, maxSize):
+    if size > maxSize:
+        raise lspDecoder.DecodeError('%s is %d bytes, more than the %d allowed' % (name, size, maxSize))
+
+
+def readZipMember(archive, info, maxSize):
+    checkSize(info.filename, info.file_size, maxSize)
+    with archive.open(info) as member:
+        data = member.read(maxSize + 1)
+    checkSize(info.filename, len(data), maxSize)
+    return unwrap(data)
+
+
+def readTarMember(archive, info, maxSize):
+    checkSize(info.name, info.size, maxSize)
+    return unwrap(archive.extractfile(info).read(info.size))
+
+
+def isArchive(infilename):
+    with open(infilename, 'rb') as infile:
+        return archiveKind(infile.read(PEEK_SIZE)) is not None
+
+
+def readMembers(infilename, maxSize=MAX_MEMBER_SIZE):
+    # yields (path, read) for every unit in a zip or tar archive, in the
+    # order they are stored; read() returns the member's encoded data, and
+    # has to be called (if at all) before moving on to the next member
+    with open(infilename, 'rb') as infile:
+        kind = archiveKind(infile.read(PEEK_SIZE))
+        infile.seek(0)
+        if kind == 'zip':
+            archive = zipfile.ZipFile(infile)
+            for info in sorted(archive.infolist(), key=lambda info: info.header_offset):
+                path = memberPath(info.filename)
+                if path is not None and not info.filename.endswith('/'):
+                    yield path, functools.partial(readZipMember, archive, info, maxSize)
+        elif kind == 'tar':
+            # 'r|' reads the archive as a stream, never seeking back
+            archive = tarfile.open(fileobj=infile, mode='r|*')
+            for info in archive:
+                path = memberPath(info.name)
+                if path is not None and info.isfile():
+                    yield path, functools.partial(readTarMember, archive, info, maxSize)
+        else:
+            raise lspDecoder.DecodeError('not a zip or tar archive')
+
+
+def readFile(infilename, unwrap=False):
+    with open(infilename, 'rb') as infile:
+        return lspDecoder.loadFile(infile, unwrap)
+
+
+def readUnits(infilename, wanted=None, maxSize=MAX_MEMBER_SIZE, unwrap=False):
+    # yields (name, read) for the units in a file: the file itself (unwrapped
+    # with unwrap), or the members of an archive whose paths pass wanted,
+    # named archive/path
+    if not isArchive(infilename):
+        yield infilename, functools.partial(readFile, infilename, unwrap)
+        return
+    for path, read in readMembers(infilename, maxSize):
+        if wanted is None or wanted(path):
+            yield os.path.join(infilename, path), read
+
+
+def addUnwrapArgument(parser):
+    parser.add_argument('--unwrap', action='store_true',
+                        help='take the data fork out of MacBinary and AppleSingle files '
+                        '(archive members are always unwrapped)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the encoded Lightspeed Pascal units in archives '
+                                     'and MacBinary or AppleSingle files.')
+    parser.add_argument('files', nargs='+', metavar='file', help='archive, wrapped or plain encoded file')
+    parser.add_argument('--max-size', type=int, default=MAX_MEMBER_SIZE / (1024 * 1024), metavar='MB',
+                        help='skip archive members bigger than this (default: %(default)d)')
+    addUnwrapArgument(parser)
+    lspTrace.addArguments(parser)
+    args = parser.parse_args()
+    lspTrace.configure(args)
+
+    failures = 0
+    for infilename in args.files:
+        try:
+            for name, read in readUnits(infilename, maxSize=args.max_size * 1024 * 1024, unwrap=args.unwrap):
+                try:
+                    print '%d\t%s' % (len(read()), name)
+                except (lspDecoder.DecodeError, zipfile.BadZipfile, RuntimeError) as e:
+                    lspTrace.error('%s: %s' % (name, getattr(e, 'value', e)))
+                    failures += 1
+        except (IOError, lspDecoder.DecodeError, tarfile.TarError, zipfile.BadZipfile) as e:
+            lspTrace.error('%s: %s' % (infilename, getattr(e, 'value', e)))
+            failures += 1
+    sys.exit(1 if failures else 0)
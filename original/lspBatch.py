@@ -0,0 +1,430 @@
+#!/usr/bin/python
+# Convert whole trees of encoded Lightspeed Pascal (LSP) source files at
+# once, spreading the files over a pool of worker processes.
+#
+# Inputs are files, directories (searched recursively) or glob patterns.
+# Each output goes either next to its input or, with --output-dir, to the
+# same relative path under that directory.  A file that fails to convert is
+# reported and counted, and the rest of the batch carries on.  With --cache,
+# outputs are kept in an lspCache keyed by input content, and files that
+# haven't changed since an earlier run are copied from there; otherwise
+# the text and token outputs of a file are all made from one decode of it
+# (see lspSinks).  With
+# --incremental (or --watch, which repeats it), an lspManifest records what
+# each input was converted to, and only new and changed inputs are
+# converted again.  A zip or tar archive among the inputs is converted by
+# one worker in one read of it (see lspArchive), its members' outputs going
+# to the same relative paths under a directory named after the archive plus
+# MEMBERS_SUFFIX.  Archive members are always taken out of any MacBinary or
+# AppleSingle wrapper, and other inputs only with --unwrap.
+
+import argparse
+import functools
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import traceback
+from lspCache import CACHE_VERSION, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, Cache, hashFile
+from lspDecoder import addRecoveryArguments, errorBudget, opcodeTableVersion
+from lspManifest import MANIFEST_NAME, Manifest
+from lspTokenStream import TEXT_ENCODING
+from lspInputs import findInputs, wanted
+from lspOutput import openOutput
+import lspArchive
+import lspParser
+import lspSinks
+import lspTokenizer
+import lspTrace
+import parseLSP
+
+# tool name -> (output suffix, function(infilename, outfilename, maxErrors=None, unwrap=False))
+TOOLS = {
+    'text': ('.p', parseLSP.convertFile),
+    'tokens': ('.tokens', lspTokenizer.convertFile),
+    'binary-tokens': ('.btokens',
+                      lambda infilename, outfilename, maxErrors=None, unwrap=False:
+                      lspTokenizer.convertFile(infilename, outfilename, binary=True, maxErrors=maxErrors,
+                                               unwrap=unwrap)),
+    'columns': ('.lspc',
+                lambda infilename, outfilename, maxErrors=None, unwrap=False:
+                lspTokenizer.convertFile(infilename, outfilename, maxErrors=maxErrors, columns=True,
+                                         unwrap=unwrap)),
+    'tree': ('.json', lspParser.convertFile),
+}
+
+# tools whose output includes the input file name (the text header, the
+# column store's file table), which is then part of their cache key
+PATH_DEPENDENT = set(['text', 'columns'])
+
+# added to an archive's name for the directory its members' outputs go in
+MEMBERS_SUFFIX = '.d'
+
+
+def outputPath(infilename, relpath, outdir, suffix):
+    if outdir is None:
+        return infilename + suffix
+    return os.path.join(outdir, relpath + suffix)
+
+
+def initWorker(level):
+    lspTrace.setLevel(level)
+
+
+def makeTasks(infilename, outputs, cacheDir=None, maxErrors=None, unwrap=False):
+    # outputs is a list of (tool, outfilename); a task is (convertOne,
+    # (tools, infilename, outfilenames, cacheDir, maxErrors, unwrap)).
+    # Without a cache, the outputs lspSinks can make share one task and one
+    # decode; cached conversions are looked up one output at a time.
+    tasks = []
+    shared = []
+    for tool, outfilename in outputs:
+        if cacheDir is None and tool in lspSinks.OUTPUTS:
+            shared.append((tool, outfilename))
+        else:
+            tasks.append((convertOne, ((tool,), infilename, (outfilename,), cacheDir, maxErrors, unwrap)))
+    if shared:
+        tools, outfilenames = zip(*shared)
+        tasks.append((convertOne, (tools, infilename, outfilenames, cacheDir, maxErrors, unwrap)))
+    return tasks
+
+
+def archiveTask(tools, infilename, membersDir, match='*', maxErrors=None):
+    return (convertArchive, (tools, infilename, membersDir, match, maxErrors))
+
+
+def runTask(task):
+    function, args = task
+    return function(args)
+
+
+def makeOutputDirs(outfilenames):
+    for outfilename in outfilenames:
+        outdir = os.path.dirname(outfilename)
+        if outdir and not os.path.isdir(outdir):
+            try:
+                os.makedirs(outdir)
+            except OSError:
+                # another worker may have just made it
+                if not os.path.isdir(outdir):
+                    raise
+
+
+def convertOne(task):
+    # runs in a worker; never raises, so one bad file can't stop the pool.
+    # Returns an (infilename, outfilename, error, seconds) result per output.
+    tools, infilename, outfilenames, cacheDir, maxErrors, unwrap = task
+    start = time.time()
+    try:
+        makeOutputDirs(outfilenames)
+        if len(tools) > 1:
+            lspSinks.convertFile(infilename, dict(zip(tools, outfilenames)), maxErrors=maxErrors, unwrap=unwrap)
+        else:
+            convertSingle(tools[0], infilename, outfilenames[0], cacheDir, maxErrors, unwrap)
+        error = None
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+        for outfilename in outfilenames:
+            if os.path.exists(outfilename):
+                os.remove(outfilename)
+    seconds = time.time() - start
+    return [(infilename, outfilename, error, seconds) for outfilename in outfilenames]
+
+
+def convertSingle(tool, infilename, outfilename, cacheDir, maxErrors, unwrap=False):
+    # raises whatever the conversion does
+    convertFile = TOOLS[tool][1]
+    if maxErrors is not None:
+        convertFile = functools.partial(convertFile, maxErrors=maxErrors)
+    if unwrap:
+        convertFile = functools.partial(convertFile, unwrap=True)
+    if cacheDir is None:
+        convertFile(infilename, outfilename)
+    else:
+        conversion = tool
+        if tool in PATH_DEPENDENT:
+            conversion += '\0' + infilename
+        if maxErrors is not None:
+            conversion += '\0recover %d' % maxErrors
+        if unwrap:
+            conversion += '\0unwrap'
+        Cache(cacheDir).convert(conversion, convertFile, infilename, outfilename)
+
+
+def convertArchive(task):
+    # runs in a worker, like convertOne, and converts the wanted members of
+    # an archive from one read of it.  The results are under the archive's
+    # name, with the member's path starting any error.
+    tools, infilename, membersDir, match, maxErrors = task
+    results = []
+    start = time.time()
+    try:
+        if not os.path.isdir(membersDir):
+            os.makedirs(membersDir)
+        for path, read in lspArchive.readMembers(infilename):
+            if not wanted(path, match):
+                continue
+            outputs = [(tool, os.path.join(membersDir, path + TOOLS[tool][0])) for tool in tools]
+            for outfilename, error in convertMember(os.path.join(infilename, path), read, outputs, maxErrors):
+                if error is not None:
+                    error = '%s: %s' % (path, error)
+                results.append((infilename, outfilename, error, time.time() - start))
+            start = time.time()
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+        results.append((infilename, membersDir, error, time.time() - start))
+    return results
+
+
+def convertMember(name, read, outputs, maxErrors=None):
+    # returns (outfilename, error or None) per output; as with files, the
+    # outputs lspSinks makes come from one decode and fail together, and a
+    # tree fails on its own
+    shared = dict((tool, outfilename) for tool, outfilename in outputs if tool in lspSinks.OUTPUTS)
+    trees = [outfilename for tool, outfilename in outputs if tool not in lspSinks.OUTPUTS]
+    try:
+        makeOutputDirs([outfilename for tool, outfilename in outputs])
+        data = read()
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+        return [(outfilename, error) for tool, outfilename in outputs]
+    results = []
+    if shared:
+        error = tryConvert(shared.values(), lspSinks.convertData, name, data, shared, maxErrors=maxErrors)
+        results.extend((outfilename, error) for outfilename in shared.values())
+    for outfilename in trees:
+        results.append((outfilename, tryConvert([outfilename], writeTree, data, outfilename, maxErrors)))
+    return results
+
+
+def writeTree(data, outfilename, maxErrors=None):
+    out = openOutput(outfilename)
+    lspParser.parseBuffer(data, lspParser.treeWriter(out), False, maxErrors)
+    out.close()
+
+
+def tryConvert(outfilenames, function, *args, **kwargs):
+    # returns None, or the error after removing what was written
+    try:
+        function(*args, **kwargs)
+    except Exception:
+        for outfilename in outfilenames:
+            if os.path.exists(outfilename):
+                os.remove(outfilename)
+        return traceback.format_exc().strip().splitlines()[-1]
+    return None
+
+
+def convertAll(tasks, jobs=None):
+    # tasks is a list from makeTasks and archiveTask; returns the
+    # (infilename, outfilename, error, seconds) results as they complete
+    if jobs == 1:
+        return [result for task in tasks for result in runTask(task)]
+    pool = multiprocessing.Pool(jobs, initWorker, (lspTrace.level,))
+    try:
+        return [result for results in pool.imap_unordered(runTask, tasks) for result in results]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def runBatch(paths, tools, outdir=None, jobs=None, match='*', cache=None, maxErrors=None, unwrap=False):
+    tasks = []
+    cacheDir = cache.directory if cache else None
+    for infilename, relpath in findInputs(paths, match):
+        if lspArchive.isArchive(infilename):
+            membersDir = outputPath(infilename, relpath, outdir, MEMBERS_SUFFIX)
+            tasks.append(archiveTask(tools, infilename, membersDir, match, maxErrors))
+            continue
+        outputs = [(tool, outputPath(infilename, relpath, outdir, TOOLS[tool][0])) for tool in tools]
+        tasks.extend(makeTasks(infilename, outputs, cacheDir, maxErrors, unwrap))
+    start = time.time()
+    conversions = failures = 0
+    for infilename, outfilename, error, seconds in convertAll(tasks, jobs):
+        conversions += 1
+        if error is None:
+            lspTrace.info('%s -> %s (%.2fs)' % (infilename, outfilename, seconds))
+        else:
+            failures += 1
+            lspTrace.error('%s: %s' % (infilename, error))
+    lspTrace.info('%d conversions, %d failed, %.2fs' % (conversions, failures, time.time() - start))
+    if cache:
+        lspTrace.info('evicted %d cache entries' % cache.trim())
+    return failures
+
+
+def inspect(infilename, digest, unwrap=False):
+    # a fresh manifest entry for a new or changed input
+    if lspArchive.isArchive(infilename):
+        # all of an archive's outputs are in one directory, which stands for
+        # them in the entry
+        return { 'hash': digest, 'unit': None, 'uses': [], 'outputs': {}, 'archive': True }
+    try:
+        unit, uses = lspParser.decodeHeader(infilename, unwrap)
+        unit = unit.decode(TEXT_ENCODING)
+        uses = [name.decode(TEXT_ENCODING) for name in uses]
+    except Exception:
+        # it will fail to convert too, and be reported then
+        unit, uses = None, []
+    return { 'hash': digest, 'unit': unit, 'uses': uses, 'outputs': {} }
+
+
+def removeOutputs(entry):
+    for outfilename in entry['outputs'].values():
+        if entry.get('archive'):
+            shutil.rmtree(outfilename, ignore_errors=True)
+            continue
+        try:
+            os.remove(outfilename)
+        except OSError:
+            pass
+
+
+def runIncremental(paths, tools, outdir=None, jobs=None, match='*', cache=None, maxErrors=None,
+                   manifestFile=None, unwrap=False):
+    # like runBatch, but only converts inputs that are new or changed since
+    # the last run recorded in the manifest, rebuilds the trees of units
+    # that use a changed unit, and removes the outputs of inputs that have
+    # gone
+    start = time.time()
+    if manifestFile is None:
+        manifestFile = os.path.join(outdir or os.curdir, MANIFEST_NAME)
+    stamp = '%d:%s:%s:%s' % (CACHE_VERSION, opcodeTableVersion(), maxErrors, unwrap)
+    manifest = Manifest(manifestFile, stamp)
+    files = manifest.files
+    changedUnits = set()
+    changed = 0
+    seen = set()
+    inputs = []
+    for infilename, relpath in findInputs(paths, match):
+        seen.add(infilename)
+        st = os.stat(infilename)
+        entry = files.get(infilename)
+        if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            digest = hashFile(infilename)
+            if entry is None or entry['hash'] != digest:
+                if entry is not None and entry['unit']:
+                    changedUnits.add(entry['unit'])
+                if entry is not None and entry.get('archive'):
+                    # members may have gone from the archive
+                    removeOutputs(entry)
+                entry = files[infilename] = inspect(infilename, digest, unwrap)
+                if entry['unit']:
+                    changedUnits.add(entry['unit'])
+                changed += 1
+            entry['size'] = st.st_size
+            entry['mtime'] = st.st_mtime
+        inputs.append((infilename, relpath, entry))
+
+    removed = 0
+    for infilename in [name for name in files if name not in seen]:
+        entry = files.pop(infilename)
+        removeOutputs(entry)
+        if entry['unit']:
+            changedUnits.add(entry['unit'])
+        removed += 1
+
+    stale = manifest.dependents(changedUnits) if 'tree' in tools else set()
+    tasks = []
+    toolOf = {}
+    archives = {}
+    cacheDir = cache.directory if cache else None
+    for infilename, relpath, entry in inputs:
+        if entry.get('archive'):
+            membersDir = outputPath(infilename, relpath, outdir, MEMBERS_SUFFIX)
+            missing = [tool for tool in tools
+                       if entry['outputs'].get(tool) != membersDir or not os.path.isdir(membersDir)]
+            if missing:
+                for tool in missing:
+                    entry['outputs'].pop(tool, None)
+                archives[infilename] = (missing, membersDir)
+                tasks.append(archiveTask(missing, infilename, membersDir, match, maxErrors))
+            continue
+        outputs = []
+        for tool in tools:
+            outfilename = outputPath(infilename, relpath, outdir, TOOLS[tool][0])
+            if (entry['outputs'].get(tool) != outfilename or not os.path.exists(outfilename) or
+                    (tool == 'tree' and infilename in stale)):
+                entry['outputs'].pop(tool, None)
+                outputs.append((tool, outfilename))
+                toolOf[outfilename] = tool
+        tasks.extend(makeTasks(infilename, outputs, cacheDir, maxErrors, unwrap))
+
+    failures = 0
+    conversions = 0
+    failedArchives = set()
+    if tasks:
+        for infilename, outfilename, error, seconds in convertAll(tasks, jobs):
+            conversions += 1
+            if error is None:
+                if infilename not in archives:
+                    files[infilename]['outputs'][toolOf[outfilename]] = outfilename
+                lspTrace.info('%s -> %s (%.2fs)' % (infilename, outfilename, seconds))
+            else:
+                failures += 1
+                failedArchives.add(infilename)
+                lspTrace.error('%s: %s' % (infilename, error))
+    # an archive is only up to date if every member converted
+    for infilename, (missing, membersDir) in archives.items():
+        if infilename not in failedArchives:
+            for tool in missing:
+                files[infilename]['outputs'][tool] = membersDir
+    manifest.save()
+    lspTrace.info('%d inputs, %d changed, %d removed, %d conversions, %d failed, %.2fs' %
+                  (len(inputs), changed, removed, conversions, failures, time.time() - start))
+    if cache and tasks:
+        lspTrace.info('evicted %d cache entries' % cache.trim())
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert many encoded Lightspeed Pascal source files in parallel.')
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help='encoded Pascal source file, directory or glob pattern')
+    parser.add_argument('-t', '--tool', action='append', choices=sorted(TOOLS),
+                        help='conversion to run; may be repeated (default: text)')
+    parser.add_argument('-d', '--output-dir', metavar='dir',
+                        help='mirror the input tree under dir instead of writing next to each input')
+    parser.add_argument('-j', '--jobs', type=int, metavar='n',
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--match', default='*', metavar='pattern',
+                        help='only convert files whose names match pattern (default: all)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only convert new and changed inputs, and remove the outputs of deleted ones')
+    parser.add_argument('--watch', type=float, metavar='seconds',
+                        help='run incrementally every so many seconds until interrupted')
+    parser.add_argument('--manifest', metavar='file',
+                        help='where --incremental keeps track of inputs '
+                        '(default: %s in the output directory, or here)' % MANIFEST_NAME)
+    parser.add_argument('--cache', action='store_true',
+                        help='reuse outputs of unchanged inputs from a cache')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, metavar='dir',
+                        help='where to keep the cache (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE / (1024 * 1024), metavar='MB',
+                        help='evict least recently used cache entries beyond this size (default: %(default)d)')
+    addRecoveryArguments(parser)
+    lspArchive.addUnwrapArgument(parser)
+    lspTrace.addArguments(parser)
+    args = parser.parse_args()
+    lspTrace.configure(args)
+
+    cache = None
+    if args.cache:
+        cache = Cache(args.cache_dir, args.cache_size * 1024 * 1024)
+    tools = args.tool or ['text']
+    if args.watch:
+        try:
+            while True:
+                runIncremental(args.paths, tools, args.output_dir, args.jobs, args.match, cache,
+                               errorBudget(args), args.manifest, args.unwrap)
+                time.sleep(args.watch)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    elif args.incremental:
+        failures = runIncremental(args.paths, tools, args.output_dir, args.jobs, args.match, cache,
+                                  errorBudget(args), args.manifest, args.unwrap)
+    else:
+        failures = runBatch(args.paths, tools, args.output_dir, args.jobs, args.match, cache,
+                            errorBudget(args), args.unwrap)
+    sys.exit(1 if failures else 0)
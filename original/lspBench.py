@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# Benchmarks for the Lightspeed Pascal (LSP) tools.
+#
+#   lspBench.py run [FILE...]  tokens/sec, MB/sec and peak RSS of parseLSP,
+#                              lspTokenizer and lspParser, on the given files
+#                              or on a generated lspCorpus; compares against
+#                              and/or saves a baseline
+#   lspBench.py memory FILE    peak memory of holding every token of FILE
+#                              as old-style dicts vs. Token records
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from lspCorpus import parseSize, writeCorpus
+from lspDecoder import decodeBuffer, loadFile
+from lspOutput import OutputBuffer
+from lspTokenStream import JsonTokenWriter
+import lspParser
+import lspTokenizer
+import lspTrace
+import parseLSP
+from lspParser import tokenGenerator
+
+
+def peakRSS():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def dictTokens(tuples):
+    # the token representation lspParser used before Token
+    for id, name, data in tuples:
+        yield { 'id': id, 'name': name, 'data': data }
+
+
+def tokenRecords(tuples):
+    return tokenGenerator(tuples)
+
+
+MEMORY_VARIANTS = {
+    'dict': dictTokens,
+    'token': tokenRecords,
+}
+
+
+def measureMemory(infilename, variant, results):
+    lspTrace.setLevel(lspTrace.QUIET)
+    with open(infilename, 'rb') as infile:
+        # decode up front so only the token representation is measured
+        tuples = list(lspTokenizer.processFile(infile))
+    before = peakRSS()
+    tokens = list(MEMORY_VARIANTS[variant](tuples))
+    results.put((variant, len(tokens), peakRSS() - before))
+
+
+def benchMemory(infilename):
+    results = multiprocessing.Queue()
+    for variant in sorted(MEMORY_VARIANTS):
+        # a fresh process per variant, so each peak is its own
+        process = multiprocessing.Process(target=measureMemory,
+                                          args=(infilename, variant, results))
+        process.start()
+        variant, count, kilobytes = results.get()
+        process.join()
+        print '%-6s %9d tokens %9d KB peak %8.1f bytes/token' % (
+            variant, count, kilobytes, kilobytes * 1024.0 / max(count, 1))
+
+
+def runParseLSP(infile, out):
+    parseLSP.processFile(infile, out)
+
+
+def runTokenizer(infile, out):
+    lspTokenizer.writeTokens(infile, JsonTokenWriter(out))
+
+
+def runParser(infile, out):
+    lspParser.writeTree(lspParser.parseFile(lspTokenizer.processFile(infile, trivia=False)), out)
+
+
+TOOLS = [
+    ('parseLSP', runParseLSP),
+    ('lspTokenizer', runTokenizer),
+    ('lspParser', runParser),
+]
+
+
+def countTokens(infilename):
+    with open(infilename, 'rb') as infile:
+        return sum(1 for record in decodeBuffer(loadFile(infile)))
+
+
+def measureTool(run, infilenames, repeat, results):
+    # best time of repeat runs over all the files, and the peak RSS
+    lspTrace.setLevel(lspTrace.QUIET)
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for infilename in infilenames:
+            out = OutputBuffer(open(os.devnull, 'wb'))
+            with open(infilename, 'rb') as infile:
+                run(infile, out)
+            out.close()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    results.put((best, peakRSS()))
+
+
+def benchTools(infilenames, repeat=3):
+    tokens = sum(countTokens(infilename) for infilename in infilenames)
+    megabytes = sum(os.path.getsize(infilename) for infilename in infilenames) / (1024.0 * 1024.0)
+    report = {}
+    results = multiprocessing.Queue()
+    for name, run in TOOLS:
+        process = multiprocessing.Process(target=measureTool,
+                                          args=(run, infilenames, repeat, results))
+        process.start()
+        seconds, kilobytes = results.get()
+        process.join()
+        report[name] = {
+            'seconds': seconds,
+            'tokens_per_sec': tokens / seconds,
+            'mb_per_sec': megabytes / seconds,
+            'peak_rss_kb': kilobytes,
+        }
+    return tokens, megabytes, report
+
+
+def findRegressions(report, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(report.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result['tokens_per_sec'] < old['tokens_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.0f tokens/sec, baseline %.0f' % (
+                name, result['tokens_per_sec'], old['tokens_per_sec']))
+        if result['peak_rss_kb'] > old['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('%s: %d KB peak RSS, baseline %d' % (
+                name, result['peak_rss_kb'], old['peak_rss_kb']))
+    return regressions
+
+
+def benchRun(args):
+    corpus = None
+    infilenames = args.files
+    if not infilenames:
+        corpus = tempfile.mkdtemp(prefix='lspBench')
+        infilenames = writeCorpus(corpus, args.count, args.size, seed=args.seed)
+    try:
+        tokens, megabytes, report = benchTools(infilenames, args.repeat)
+    finally:
+        if corpus:
+            shutil.rmtree(corpus)
+    print '%d files, %d tokens, %.2f MB' % (len(infilenames), tokens, megabytes)
+    for name, run in TOOLS:
+        result = report[name]
+        print '%-13s %10.0f tokens/sec %7.2f MB/sec %9d KB peak RSS' % (
+            name, result['tokens_per_sec'], result['mb_per_sec'], result['peak_rss_kb'])
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = findRegressions(report, baseline, args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION', regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the Lightspeed Pascal tools.')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='measure the throughput of each tool')
+    run.add_argument('files', nargs='*', metavar='file',
+                     help='encoded Pascal source files (default: generate a corpus)')
+    run.add_argument('-n', '--count', type=int, default=4,
+                     help='units to generate (default: 4)')
+    run.add_argument('-s', '--size', type=parseSize, default=parseSize('256K'),
+                     help='size of each generated unit (default: 256K)')
+    run.add_argument('--seed', type=int, default=0, help='corpus random seed (default: 0)')
+    run.add_argument('-r', '--repeat', type=int, default=3,
+                     help='runs per tool; the best is reported (default: 3)')
+    run.add_argument('--baseline', metavar='file',
+                     help='flag results worse than this saved baseline')
+    run.add_argument('--save-baseline', metavar='file',
+                     help='save the results as a baseline')
+    run.add_argument('--tolerance', type=float, default=0.10,
+                     help='fraction worse than the baseline that counts as a regression (default: 0.10)')
+    memory = commands.add_parser('memory', help='compare token record memory use')
+    memory.add_argument('infilename', metavar='file', help='encoded Pascal source file')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        sys.exit(benchRun(args))
+    elif args.command == 'memory':
+        benchMemory(args.infilename)
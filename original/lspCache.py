@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# On-disk cache of converted outputs, so re-running a conversion over a
+# mostly unchanged archive only decodes the files that changed.
+#
+# An entry is keyed by a hash of the encoded input, the conversion that
+# produced it, and the opcode table version (see lspDecoder), so changing
+# the decoder invalidates every entry.  Entries live under the cache
+# directory as <key[:2]>/<key>.  Reading an entry touches its mtime, and
+# trim() removes the least recently used entries until the cache fits in
+# its size limit.
+
+import hashlib
+import os
+import shutil
+import tempfile
+from lspDecoder import opcodeTableVersion
+
+# bump when a conversion's output format changes
+CACHE_VERSION = 4
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lsp-tools')
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+def hashFile(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class Cache(object):
+    def __init__(self, directory=DEFAULT_CACHE_DIR, maxSize=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.version = '%d:%s' % (CACHE_VERSION, opcodeTableVersion())
+
+    def key(self, conversion, inputHash):
+        # conversion names the tool and anything else its output depends on
+        return hashlib.sha1('%s\0%s\0%s' % (self.version, conversion, inputHash)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, key, outfilename):
+        # copy a cached entry to outfilename; False if there is none
+        path = self.path(key)
+        try:
+            shutil.copyfile(path, outfilename)
+        except IOError:
+            return False
+        os.utime(path, None)
+        return True
+
+    def store(self, key, filename):
+        # copy filename into the cache; written to a temporary name first so
+        # a concurrent reader never sees a partial entry
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        fd, temp = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        shutil.copyfile(filename, temp)
+        os.rename(temp, path)
+
+    def convert(self, conversion, convertFile, infilename, outfilename):
+        # run convertFile(infilename, outfilename) unless the cache already
+        # has its output; returns True on a cache hit
+        key = self.key(conversion, hashFile(infilename))
+        if self.fetch(key, outfilename):
+            return True
+        convertFile(infilename, outfilename)
+        self.store(key, outfilename)
+        return False
+
+    def trim(self):
+        # evict least recently used entries until the cache fits
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
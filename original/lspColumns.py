@@ -0,0 +1,297 @@
+#!/usr/bin/python
+# Columnar token store for corpus-wide analytics over encoded Lightspeed
+# Pascal (LSP) units.
+#
+# Instead of a Python object per token, a store holds three parallel typed
+# columns -- opcode, source byte offset and value -- where a value is an
+# index into a pool of distinct payloads (-1 for none), so each token takes
+# nine bytes however often its name or number repeats.  The file is laid
+# out so the columns can be used straight from an mmap:
+#
+#   'LSPC' version-byte, 3 padding bytes, token count (uint32), 4 padding
+#   offsets   uint32 per token, little-endian
+#   values    int32 per token, little-endian
+#   opcodes   uint8 per token
+#   JSON      { "files": [[name, first token, tokens, bytes], ...],
+#               "pool": [value, ...] }
+#
+# With NumPy the columns are read-only arrays over the mapped file and the
+# queries (opcode histograms, value counts, routine sizes) are vectorized.
+# Without it they are copied into array-module arrays and the same queries
+# run as plain loops.
+
+import argparse
+import array
+import bisect
+import itertools
+import json
+import struct
+import sys
+from tokens import *
+from lspDecoder import addRecoveryArguments, decodeInto, errorBudget, loadFile
+from lspOutput import openOutput
+from lspTokenStream import TEXT_ENCODING, TOKEN_NAMES
+from lspInputs import findInputs, wanted
+import lspArchive
+# lspTokenizer imports this module in turn
+import lspTokenizer
+import lspTrace
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COLUMNS_MAGIC = 'LSPC'
+COLUMNS_VERSION = 1
+
+HEADER = struct.Struct('<4sB3xI4x')
+
+# array typecodes for 32 bit columns; 'I' and 'i' are 32 bits on every
+# platform we run on, but the C types behind them aren't guaranteed
+UINT32 = 'I' if array.array('I').itemsize == 4 else 'L'
+INT32 = 'i' if array.array('i').itemsize == 4 else 'l'
+
+ROUTINES = (TOKEN_PROCEDURE, TOKEN_FUNCTION)
+IDENTIFIERS = (TOKEN_IDENTIFIER, TOKEN_IDENTIFIER2)
+
+
+class ColumnStoreError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class ColumnWriter(object):
+    # collects the tokens of any number of files, then writes the store
+    def __init__(self):
+        self.opcodes = array.array('B')
+        self.offsets = array.array(UINT32)
+        self.values = array.array(INT32)
+        self.pool = {}
+        self.poolValues = []
+        self.files = []
+
+    def beginFile(self, name, size):
+        self.files.append([name, len(self.opcodes), 0, size])
+
+    def add(self, offset, code, value):
+        self.opcodes.append(code)
+        self.offsets.append(offset)
+        if value is None:
+            self.values.append(-1)
+            return
+        index = self.pool.get(value)
+        if index is None:
+            index = self.pool[value] = len(self.poolValues)
+            self.poolValues.append(value)
+        self.values.append(index)
+
+    def dropFile(self):
+        # forget the tokens of the last file begun, after it failed to decode
+        name, first, count, size = self.files.pop()
+        for column in (self.opcodes, self.offsets, self.values):
+            del column[first:]
+
+    def write(self, out):
+        count = len(self.opcodes)
+        ends = [entry[1] for entry in self.files[1:]] + [count]
+        for entry, end in zip(self.files, ends):
+            entry[2] = end - entry[1]
+        out.write(HEADER.pack(COLUMNS_MAGIC, COLUMNS_VERSION, count))
+        for column in (self.offsets, self.values, self.opcodes):
+            if sys.byteorder == 'big' and column.itemsize > 1:
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            out.write(column.tostring())
+        out.write(json.dumps({ 'files': self.files, 'pool': self.poolValues }, encoding=TEXT_ENCODING))
+
+
+class ColumnSink(object):
+    # adds the tokens of one file, with their offsets, to a ColumnWriter (see
+    # lspSinks); given out, writes the store there when the file is done
+    def __init__(self, columns, name, size, trivia=True, out=None):
+        columns.beginFile(name, size)
+        self.columns = columns
+        self.add = columns.add
+        self.out = out
+        self.emitters = lspTokenizer.EMITTERS if trivia else lspTokenizer.SIGNIFICANT_EMITTERS
+
+    def record(self, offset, code, value):
+        token = self.emitters[code](code, value)
+        if token is not None:
+            self.add(offset, code, token[2])
+
+    def close(self):
+        if self.out is not None:
+            self.columns.write(self.out)
+            self.out.close()
+
+
+class ColumnStore(object):
+    # a store opened for queries; strings come back as unicode and array
+    # bounds as lists
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.data = loadFile(f)
+        if len(self.data) < HEADER.size:
+            raise ColumnStoreError('not a column store: %s' % filename)
+        magic, version, count = HEADER.unpack_from(self.data, 0)
+        if magic != COLUMNS_MAGIC:
+            raise ColumnStoreError('not a column store: %s' % filename)
+        if version != COLUMNS_VERSION:
+            raise ColumnStoreError('unsupported column store version %d: %s' % (version, filename))
+        self.count = count
+        start = HEADER.size
+        self.offsets = self.column(start, '<u4', UINT32)
+        self.values = self.column(start + 4 * count, '<i4', INT32)
+        self.opcodes = self.column(start + 8 * count, 'u1', 'B')
+        trailer = json.loads(self.data[start + 9 * count:])
+        self.files = trailer['files']
+        self.pool = trailer['pool']
+
+    def column(self, start, dtype, typecode):
+        if numpy is not None:
+            return numpy.frombuffer(self.data, dtype, self.count, start)
+        column = array.array(typecode)
+        column.fromstring(self.data[start:start + self.count * column.itemsize])
+        if sys.byteorder == 'big' and column.itemsize > 1:
+            column.byteswap()
+        return column
+
+    def select(self, codes):
+        # indices of the tokens with any of the opcodes codes, in order
+        if numpy is not None:
+            return numpy.flatnonzero(numpy.in1d(self.opcodes, codes)).tolist()
+        wanted = set(codes)
+        return [i for i, code in enumerate(self.opcodes) if code in wanted]
+
+    def opcodeCounts(self):
+        # tokens per opcode, indexed by opcode
+        if numpy is not None:
+            return numpy.bincount(self.opcodes, minlength=256).tolist()
+        counts = [0] * 256
+        for code in self.opcodes:
+            counts[code] += 1
+        return counts
+
+    def valueCounts(self, codes):
+        # (value, count) for each value of the tokens with any of codes
+        if numpy is not None:
+            values = self.values[numpy.in1d(self.opcodes, codes)]
+            counts = numpy.bincount(values[values >= 0], minlength=len(self.pool))
+            found = numpy.flatnonzero(counts)
+            return zip((self.pool[i] for i in found.tolist()), counts[found].tolist())
+        wanted = set(codes)
+        counts = {}
+        for code, value in itertools.izip(self.opcodes, self.values):
+            if code in wanted and value >= 0:
+                counts[value] = counts.get(value, 0) + 1
+        return [(self.pool[i], n) for i, n in sorted(counts.items())]
+
+    def routineSizes(self):
+        # (file, kind, name, tokens, bytes) per procedure or function token,
+        # running to the next one in the same file or to the end of the file
+        starts = self.select(ROUTINES)
+        firsts = [first for name, first, count, size in self.files]
+        sizes = []
+        for i, start in enumerate(starts):
+            name, first, count, size = self.files[bisect.bisect_right(firsts, start) - 1]
+            end = first + count
+            if i + 1 < len(starts) and starts[i + 1] < end:
+                end = starts[i + 1]
+                endOffset = int(self.offsets[end])
+            else:
+                endOffset = size
+            sizes.append((name, TOKEN_NAMES[int(self.opcodes[start])], self.pool[int(self.values[start])],
+                          end - start, endOffset - int(self.offsets[start])))
+        return sizes
+
+
+def buildStore(paths, outfilename, match='*', trivia=True, maxErrors=None, unwrap=False):
+    # returns (files added, files failed); the members of archives among
+    # the inputs are added as archive/member
+    columns = ColumnWriter()
+    added = failed = 0
+    for infilename, relpath in findInputs(paths, match):
+        try:
+            for name, read in lspArchive.readUnits(infilename, lambda path: wanted(path, match), unwrap=unwrap):
+                try:
+                    data = read()
+                    decodeInto(data, [ColumnSink(columns, name, len(data), trivia)], maxErrors=maxErrors)
+                except Exception as e:
+                    if len(columns.files) > added:
+                        columns.dropFile()
+                    lspTrace.error('%s: %s' % (name, e))
+                    failed += 1
+                    continue
+                lspTrace.info('%s: %d tokens' % (name, len(columns.opcodes) - columns.files[-1][1]))
+                added += 1
+        except Exception as e:
+            # the archive itself couldn't be read (any further)
+            lspTrace.error('%s: %s' % (infilename, e))
+            failed += 1
+    out = openOutput(outfilename)
+    columns.write(out)
+    out.close()
+    return added, failed
+
+
+def text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return json.dumps(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and query columnar token stores of encoded Lightspeed Pascal units.')
+    lspTrace.addArguments(parser)
+    commands = parser.add_subparsers(dest='command')
+    build = commands.add_parser('build', help='tokenize files into a store')
+    build.add_argument('paths', nargs='+', metavar='path',
+                       help='encoded Pascal source file, directory or glob pattern')
+    build.add_argument('-o', '--output', required=True, metavar='store', help='store to write')
+    build.add_argument('--match', default='*', metavar='pattern',
+                       help='only add files whose names match pattern (default: all)')
+    build.add_argument('--no-trivia', dest='trivia', action='store_false',
+                       help='leave out SPACE and NEWLINE tokens')
+    addRecoveryArguments(build)
+    lspArchive.addUnwrapArgument(build)
+    opcodes = commands.add_parser('opcodes', help='how many tokens of each kind')
+    opcodes.add_argument('store')
+    identifiers = commands.add_parser('identifiers', help='the most used identifiers, ignoring case')
+    identifiers.add_argument('store')
+    identifiers.add_argument('-n', type=int, default=20, metavar='n', help='how many (default: %(default)d)')
+    routines = commands.add_parser('routines', help='the largest procedures and functions')
+    routines.add_argument('store')
+    routines.add_argument('-n', type=int, default=20, metavar='n', help='how many (default: %(default)d)')
+    args = parser.parse_args()
+    lspTrace.configure(args)
+
+    if args.command == 'build':
+        added, failed = buildStore(args.paths, args.output, args.match, args.trivia, errorBudget(args),
+                                   args.unwrap)
+        lspTrace.info('stored %d files, %d failed' % (added, failed))
+        sys.exit(1 if failed else 0)
+    try:
+        store = ColumnStore(args.store)
+    except (IOError, ColumnStoreError) as e:
+        lspTrace.error(str(e))
+        sys.exit(1)
+    if args.command == 'opcodes':
+        counts = store.opcodeCounts()
+        for code in sorted(xrange(256), key=lambda code: -counts[code]):
+            if counts[code]:
+                print '%02X\t%s\t%d' % (code, TOKEN_NAMES.get(code, '?'), counts[code])
+    elif args.command == 'identifiers':
+        folded = {}
+        for name, n in store.valueCounts(IDENTIFIERS):
+            folded[name.lower()] = folded.get(name.lower(), 0) + n
+        for name, n in sorted(folded.items(), key=lambda item: (-item[1], item[0]))[:args.n]:
+            print '%d\t%s' % (n, text(name))
+    elif args.command == 'routines':
+        sizes = sorted(store.routineSizes(), key=lambda size: -size[3])
+        for name, kind, routine, tokens, size in sizes[:args.n]:
+            print '%s\t%s\t%s\t%d tokens\t%d bytes' % (name, kind, text(routine), tokens, size)
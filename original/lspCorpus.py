@@ -0,0 +1,438 @@
+#!/usr/bin/python
+# Generate synthetic encoded Lightspeed Pascal (LSP) units, for benchmarks
+# and for exercising the tools without real (and unshareable) sources.
+#
+# Records are laid out from the opcode table in lspDecoder: each payload
+# reader there has an encoder here that writes exactly what it reads back.
+# The units follow the usual shape -- header, interface with uses, const,
+# type and var sections and routine headers, then an implementation with
+# routine bodies -- and the statement mix is tunable.
+
+import argparse
+import os
+import random
+import struct
+from tokens import *
+from lspDecoder import (OPCODES, readArray, readByte, readInt, readInteger,
+                        readIs, readString)
+
+
+def encodeString(s):
+    return chr(len(s)) + s
+
+
+def encodeByte(n):
+    return chr(n)
+
+
+def encodeInt(x):
+    if x < 0:
+        return '\x03\x04' + struct.pack('>H', x + 65536)
+    return '\x02' + struct.pack('>H', x)
+
+
+def encodeArrayRange(x):
+    if isinstance(x, str):
+        return '\x00\x00' + encodeString(x)
+    elif x < 0:
+        return '\x03\x04' + struct.pack('>H', x + 65536)
+    return '\x03\x00' + struct.pack('>H', x)
+
+
+def encodeArray(value):
+    first, last = value
+    return encodeArrayRange(first) + encodeArrayRange(last)
+
+
+def encodeIs(value):
+    type_code, x = value
+    if type_code == 3:
+        return '\x03' + encodeInt(x)
+    return '\x05' + '\0' * 4 + encodeString(x)
+
+
+def encodeInteger(value):
+    type_code, x = value
+    if type_code == 0x04:
+        return '\x04' + struct.pack('>I', x)
+    elif type_code == 0x03:
+        return '\x03' + struct.pack('>H', x)
+    elif type_code == 0x0A:
+        return '\x0A\0\0' + encodeString(x)
+    return chr(type_code) + encodeString(x)
+
+
+ENCODERS = {
+    readByte: encodeByte,
+    readString: encodeString,
+    readInt: encodeInt,
+    readArray: encodeArray,
+    readIs: encodeIs,
+    readInteger: encodeInteger,
+}
+
+
+def encodeRecord(code, value=None):
+    op = OPCODES[code]
+    record = chr(code) + '\0' * op.skip
+    if op.reader is not None:
+        record += ENCODERS[op.reader](value)
+    return record
+
+
+# relative weights of the kinds of statement in routine bodies
+DEFAULT_MIX = {
+    'assign': 6,
+    'call': 4,
+    'if': 3,
+    'while': 1,
+    'for': 1,
+    'with': 1,
+    'case': 1,
+    'comment': 1,
+}
+
+RELATIONAL = [TOKEN_EQUALS, TOKEN_NOT_EQUALS, TOKEN_LESS_THAN,
+              TOKEN_GREATER_THAN, TOKEN_LESS_EQUAL, TOKEN_GR_EQUAL]
+ARITHMETIC = [TOKEN_PLUS, TOKEN_MINUS, TOKEN_TIMES, TOKEN_DIV, TOKEN_MOD,
+              TOKEN_SLASH, TOKEN_AND, TOKEN_OR]
+
+WORDS = ['Board', 'Piece', 'Score', 'Level', 'Row', 'Col', 'Rect', 'Window',
+         'Event', 'Timer', 'Shape', 'Color', 'Sound', 'Delay', 'Count', 'Next']
+
+
+class UnitGenerator(object):
+    def __init__(self, name, mix=None, seed=0):
+        self.name = name
+        self.random = random.Random(seed)
+        self.mix = []
+        for kind, weight in sorted((mix or DEFAULT_MIX).items()):
+            self.mix.extend([kind] * weight)
+        self.records = []
+        self.size = 0
+
+    def emit(self, code, value=None):
+        record = encodeRecord(code, value)
+        self.records.append(record)
+        self.size += len(record)
+
+    def word(self, prefix=''):
+        return prefix + self.random.choice(WORDS) + str(self.random.randint(0, 99))
+
+    def separator(self):
+        self.emit(TOKEN_SEMICOLON, 1)
+        self.emit(TOKEN_NEWLINE, 1)
+
+    def integer(self):
+        kind = self.random.randint(0, 9)
+        if kind == 0:
+            self.emit(TOKEN_INTEGER, (0x04, self.random.randint(65536, 0xFFFFFFFF)))
+        elif kind == 1:
+            self.emit(TOKEN_INTEGER, (0x05, self.word()))
+        elif kind == 2:
+            self.emit(TOKEN_INTEGER, (0x0A, '$%04X' % self.random.randint(0, 0xFFFF)))
+        else:
+            self.emit(TOKEN_INTEGER, (0x03, self.random.randint(0, 1000)))
+
+    def designator(self):
+        self.emit(TOKEN_IDENTIFIER2, self.word('v'))
+        kind = self.random.randint(0, 5)
+        if kind == 0:
+            self.emit(TOKEN_DOT)
+            self.emit(TOKEN_IDENTIFIER2, self.word('f'))
+        elif kind == 1:
+            self.emit(TOKEN_LBRACKET)
+            self.expression(1)
+            self.emit(TOKEN_RBRACKET)
+        elif kind == 2:
+            self.emit(TOKEN_DEREFERENCE)
+
+    def factor(self, depth):
+        kind = self.random.randint(0, 5 if depth else 2)
+        if kind <= 1:
+            self.integer()
+        elif kind == 2:
+            self.designator()
+        elif kind == 3:
+            self.emit(TOKEN_LPAREN2)
+            self.expression(depth - 1)
+            self.emit(TOKEN_RPAREN2)
+        elif kind == 4:
+            self.emit(TOKEN_NOT)
+            self.factor(depth - 1)
+        else:
+            self.call(depth - 1)
+
+    def expression(self, depth=2):
+        self.factor(depth)
+        for i in xrange(self.random.randint(0, 2)):
+            self.emit(self.random.choice(ARITHMETIC))
+            self.factor(depth)
+
+    def bounds(self, low):
+        # low..high, as in subrange types, sets and case labels
+        self.emit(TOKEN_INTEGER, (0x03, low))
+        self.emit(TOKEN_RANGE)
+        self.emit(TOKEN_INTEGER, (0x03, low + self.random.randint(1, 20)))
+
+    def condition(self):
+        if self.random.randint(0, 3) == 0:
+            self.designator()
+            self.emit(TOKEN_IN)
+            self.emit(TOKEN_LBRACKET)
+            self.bounds(self.random.randint(0, 100))
+            for i in xrange(self.random.randint(0, 2)):
+                self.emit(TOKEN_COMMA2)
+                self.integer()
+            self.emit(TOKEN_RBRACKET)
+            return
+        self.expression()
+        self.emit(self.random.choice(RELATIONAL))
+        self.expression()
+
+    def call(self, depth=1):
+        self.emit(TOKEN_IDENTIFIER2, self.word())
+        n = self.random.randint(0, 3)
+        if n:
+            self.emit(TOKEN_LPAREN2)
+            for i in xrange(n):
+                if i:
+                    self.emit(TOKEN_COMMA2)
+                self.expression(depth)
+            self.emit(TOKEN_RPAREN2)
+
+    def statement(self, depth):
+        kind = self.random.choice(self.mix) if depth else 'assign'
+        if kind == 'assign':
+            self.designator()
+            self.emit(TOKEN_GETS)
+            self.expression()
+        elif kind == 'call':
+            self.call()
+        elif kind == 'if':
+            self.emit(TOKEN_IF)
+            self.condition()
+            self.emit(TOKEN_STATEMENT)
+            self.statement(depth - 1)
+            if self.random.randint(0, 1):
+                self.emit(TOKEN_ELSE)
+                self.statement(depth - 1)
+        elif kind == 'while':
+            self.emit(self.random.choice([TOKEN_WHILE, TOKEN_WHILE2]))
+            self.condition()
+            self.emit(TOKEN_DO)
+            self.compound(depth - 1)
+        elif kind == 'for':
+            self.emit(TOKEN_FOR, self.word('i'))
+            self.expression(0)
+            self.emit(self.random.choice([TOKEN_TO, TOKEN_DOWN_TO]))
+            self.expression(0)
+            self.emit(TOKEN_DO)
+            self.compound(depth - 1)
+        elif kind == 'with':
+            self.emit(TOKEN_WITH)
+            self.designator()
+            self.emit(TOKEN_DO)
+            self.compound(depth - 1)
+        elif kind == 'case':
+            self.emit(TOKEN_CASE)
+            self.expression(0)
+            self.emit(TOKEN_OF)
+            self.emit(TOKEN_NEWLINE, 1)
+            for i in xrange(self.random.randint(1, 4)):
+                if self.random.randint(0, 2) == 0:
+                    self.bounds(i * 100)
+                else:
+                    self.emit(TOKEN_INTEGER, (0x03, i * 100))
+                self.emit(TOKEN_COLON, 1)
+                self.statement(depth - 1)
+                self.separator()
+            if self.random.randint(0, 1):
+                self.emit(TOKEN_DEFAULT)
+                self.statement(depth - 1)
+                self.separator()
+            self.emit(TOKEN_END)
+        else:
+            self.emit(TOKEN_COMMENT, '{ %s }' % ' '.join(self.word() for i in xrange(4)))
+            self.call()
+
+    def statements(self, depth):
+        for i in xrange(self.random.randint(1, 6)):
+            self.statement(depth)
+            self.separator()
+
+    def compound(self, depth):
+        self.emit(TOKEN_BEGIN)
+        self.statements(depth)
+        self.emit(TOKEN_END)
+
+    def typeSpec(self):
+        kind = self.random.randint(0, 6)
+        if kind == 0:
+            self.emit(TOKEN_ARRAY, (0, self.random.randint(1, 40)))
+            self.emit(TOKEN_OF)
+            self.emit(TOKEN_IDENTIFIER, 'integer')
+        elif kind == 1:
+            self.emit(TOKEN_STRING, self.random.randint(1, 255))
+        elif kind == 2:
+            self.emit(TOKEN_POINTER, self.word('T'))
+        elif kind == 3:
+            self.bounds(self.random.randint(0, 10))
+        elif kind == 4:
+            self.emit(TOKEN_LPAREN)
+            for i in xrange(self.random.randint(1, 4)):
+                if i:
+                    self.emit(TOKEN_COMMA, 1)
+                self.emit(TOKEN_IDENTIFIER, self.word('e'))
+            self.emit(TOKEN_RPAREN)
+        else:
+            self.emit(TOKEN_IDENTIFIER, self.random.choice(['integer', 'longint', 'boolean', 'char', 'Rect']))
+
+    def fields(self):
+        for i in xrange(self.random.randint(1, 4)):
+            self.emit(TOKEN_IDENTIFIER, self.word('f'))
+            if self.random.randint(0, 2) == 0:
+                self.emit(TOKEN_COMMA, 1)
+                self.emit(TOKEN_IDENTIFIER, self.word('f'))
+            self.emit(TOKEN_COLON, 1)
+            self.typeSpec()
+            self.separator()
+
+    def header(self, code, name):
+        self.emit(code, name)
+        if self.random.randint(0, 1):
+            self.emit(TOKEN_LPAREN)
+            for i in xrange(self.random.randint(1, 3)):
+                if i:
+                    self.emit(TOKEN_SEMICOLON, 1)
+                if self.random.randint(0, 2) == 0:
+                    self.emit(TOKEN_VAR)
+                self.emit(TOKEN_IDENTIFIER, self.word('p'))
+                self.emit(TOKEN_COLON, 1)
+                self.emit(TOKEN_IDENTIFIER, 'integer')
+            self.emit(TOKEN_RPAREN)
+        if code == TOKEN_FUNCTION:
+            self.emit(TOKEN_COLON, 1)
+            self.emit(TOKEN_IDENTIFIER, 'integer')
+        self.separator()
+
+    def routine(self, n):
+        code = self.random.choice([TOKEN_PROCEDURE, TOKEN_FUNCTION])
+        self.header(code, 'Routine%d' % n)
+        if self.random.randint(0, 2) == 0:
+            self.emit(TOKEN_VAR)
+            self.emit(TOKEN_NEWLINE, 1)
+            self.fields()
+        self.compound(3)
+        self.separator()
+        self.emit(TOKEN_NEWLINE, 1)
+
+    def remark(self):
+        # sometimes a comment or conditional compilation line of its own
+        kind = self.random.randint(0, 2)
+        if kind == 0:
+            self.emit(TOKEN_COMMENT, '{ %s }' % ' '.join(self.word() for i in xrange(3)))
+            self.emit(TOKEN_NEWLINE, 1)
+        elif kind == 1:
+            self.emit(TOKEN_COND_COMP, '$IFC %s' % self.word('k'))
+
+    def interface(self, routines):
+        self.emit(TOKEN_INTERFACE)
+        self.emit(TOKEN_NEWLINE, 2)
+        self.remark()
+        self.emit(TOKEN_USES)
+        self.emit(TOKEN_SPACE)
+        for i, unit in enumerate(['QuickDraw', 'ToolIntf', 'OSIntf']):
+            if i:
+                self.emit(TOKEN_COMMA, 1)
+            self.emit(TOKEN_IDENTIFIER, unit)
+        self.separator()
+        self.emit(TOKEN_CONST)
+        for i in xrange(self.random.randint(2, 8)):
+            self.emit(TOKEN_CONST_DEF, 'k%s' % self.word())
+            if i % 4 == 3:
+                self.emit(TOKEN_IS, (5, "'%s'" % self.word()))
+            else:
+                self.emit(TOKEN_IS, (3, self.random.randint(-1000, 1000)))
+            self.separator()
+        self.emit(TOKEN_TYPE)
+        self.emit(TOKEN_NEWLINE, 1)
+        for i in xrange(self.random.randint(1, 4)):
+            self.emit(TOKEN_CONST_DEF, self.word('T'))
+            if self.random.randint(0, 1):
+                self.emit(TOKEN_RECORD)
+                self.fields()
+                self.emit(TOKEN_END)
+            else:
+                self.typeSpec()
+            self.separator()
+        self.emit(TOKEN_VAR)
+        self.emit(TOKEN_NEWLINE, 1)
+        self.fields()
+        for n in routines:
+            self.header(self.random.choice([TOKEN_PROCEDURE, TOKEN_FUNCTION]), 'Routine%d' % n)
+
+    def generate(self, size):
+        # a unit of roughly size bytes
+        self.emit(TOKEN_UNIT, self.name)
+        self.separator()
+        self.emit(TOKEN_NEWLINE, 1)
+        self.remark()
+        self.interface(range(self.random.randint(1, 5)))
+        self.emit(TOKEN_IMPLEMENTATION)
+        self.emit(TOKEN_NEWLINE, 2)
+        n = 0
+        while self.size < size:
+            self.routine(n)
+            n += 1
+        self.emit(TOKEN_END)
+        self.emit(TOKEN_PERIOD)
+        return ''.join(self.records)
+
+
+def generateUnit(name, size, mix=None, seed=0):
+    return UnitGenerator(name, mix, seed).generate(size)
+
+
+def parseSize(s):
+    # '200', '64K' or '3M'
+    scale = {'K': 1024, 'M': 1024 * 1024}.get(s[-1:].upper(), 1)
+    return int(s[:-1] if scale > 1 else s) * scale
+
+
+def parseMix(s):
+    # 'assign=4,if=2' overrides the default weights for those kinds
+    mix = dict(DEFAULT_MIX)
+    for item in s.split(','):
+        kind, weight = item.split('=')
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError('unknown statement kind %r' % kind)
+        mix[kind] = int(weight)
+    return mix
+
+
+def writeCorpus(directory, count, size, mix=None, seed=0):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filenames = []
+    for i in xrange(count):
+        filename = os.path.join(directory, 'Unit%d' % i)
+        with open(filename, 'wb') as f:
+            f.write(generateUnit('Unit%d' % i, size, mix, seed + i))
+        filenames.append(filename)
+    return filenames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic encoded Lightspeed Pascal units.')
+    parser.add_argument('directory', help='where to write the units')
+    parser.add_argument('-n', '--count', type=int, default=1, help='number of units (default: 1)')
+    parser.add_argument('-s', '--size', type=parseSize, default=parseSize('64K'),
+                        help='approximate size of each unit, e.g. 200K or 3M (default: 64K)')
+    parser.add_argument('--mix', type=parseMix, default=DEFAULT_MIX,
+                        help='statement weights, e.g. assign=4,if=2 (kinds: %s)' % ', '.join(sorted(DEFAULT_MIX)))
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args()
+
+    for filename in writeCorpus(args.directory, args.count, args.size, args.mix, args.seed):
+        print filename
@@ -0,0 +1,724 @@
+#!/usr/bin/python
+# Opcode table and record decoder shared by the Lightspeed Pascal (LSP) tools.
+#
+# Every encoded record is an opcode byte, a fixed number of bytes we don't
+# understand (and skip), and an optional payload.  OPCODES holds one entry
+# per possible byte value, so decoding a record is a single list lookup
+# regardless of which opcode it is.
+#
+# There are two sets of payload readers.  The stream readers (readString,
+# readInt, ...) pull bytes from a file object one read() at a time.  The
+# buffer readers (readStringAt, readIntAt, ...) take the whole encoded file
+# as a string or mmap plus an integer cursor, and return (value, new_cursor);
+# decodeBuffer walks a file this way without a read() call per byte.
+
+import argparse
+import cStringIO
+import hashlib
+import mmap
+import struct
+import sys
+from tokens import *
+# lspArchive imports this module in turn
+import lspArchive
+import lspTrace
+
+
+def skip(f, n):
+    f.read(n)
+
+
+def readByte(f):
+    return ord(f.read(1))
+
+
+def readString(f):
+    n = ord(f.read(1))
+    return f.read(n)
+
+
+def readInt(f):
+    n = ord(f.read(1))
+    x = 0
+    sign = 1
+    for i in xrange(n):
+        b = ord(f.read(1))
+        if b == 4 and i == 0:
+            sign = -1
+        else:
+            x = x * 256 + b
+    if sign == -1:
+        x -= 65536
+    return x
+
+
+class UnknownRange(str):
+    # the '?' bound read for an array range of unknown kind; the kind byte is
+    # kept for whatever reports it
+    def __new__(cls, kind=None):
+        s = str.__new__(cls, '?')
+        s.kind = kind
+        return s
+
+
+def readArrayRange(f):
+    b = ord(f.read(1))
+    if b == 0:
+        f.read(1)
+        return readString(f)
+    elif b == 3:
+        sign_code = ord(f.read(1))
+        x = ord(f.read(1)) * 256
+        x += ord(f.read(1))
+        if sign_code == 4:
+            x -= 65536
+        return x
+    else:
+        return UnknownRange(b)
+
+
+def readArray(f):
+    first = readArrayRange(f)
+    last = readArrayRange(f)
+    return (first, last)
+
+
+# TOKEN_IS and TOKEN_INTEGER payloads start with a type code that decides
+# how the rest is laid out; both readers return (type_code, value), with a
+# value of None for a type code we don't know.
+
+def readIs(f):
+    type_code = ord(f.read(1))
+    if type_code == 3:
+        return (type_code, readInt(f))
+    elif type_code == 5:
+        skip(f, 4)
+        return (type_code, readString(f))
+    return (type_code, None)
+
+
+def readInteger(f):
+    type_code = ord(f.read(1))
+    if type_code == 0x04:
+        x = ord(f.read(1)) * 256 * 256 * 256
+        x += ord(f.read(1)) * 256 * 256
+        x += ord(f.read(1)) * 256
+        x += ord(f.read(1))
+        return (type_code, x)
+    elif type_code == 0x03:
+        x = ord(f.read(1)) * 256
+        x += ord(f.read(1))
+        return (type_code, x)
+    elif type_code == 0x02 or type_code == 0x05:
+        return (type_code, readString(f))
+    elif type_code == 0x0A:
+        skip(f, 2)
+        return (type_code, readString(f))
+    return (type_code, None)
+
+
+def readByteAt(data, pos):
+    return (ord(data[pos]), pos + 1)
+
+
+def readStringAt(data, pos):
+    n = ord(data[pos])
+    pos += 1
+    return (data[pos:pos + n], pos + n)
+
+
+def readIntAt(data, pos):
+    n = ord(data[pos])
+    pos += 1
+    # a leading 4 is a sign marker (see readInt), not a high byte
+    if n == 2 and data[pos] != '\x04':
+        return (struct.unpack_from('>H', data, pos)[0], pos + 2)
+    elif n == 3 and ord(data[pos]) == 4:
+        return (struct.unpack_from('>H', data, pos + 1)[0] - 65536, pos + 3)
+    x = 0
+    sign = 1
+    for i in xrange(n):
+        b = ord(data[pos + i])
+        if b == 4 and i == 0:
+            sign = -1
+        else:
+            x = x * 256 + b
+    if sign == -1:
+        x -= 65536
+    return (x, pos + n)
+
+
+def readArrayRangeAt(data, pos):
+    b = ord(data[pos])
+    if b == 0:
+        return readStringAt(data, pos + 2)
+    elif b == 3:
+        sign_code = ord(data[pos + 1])
+        x = struct.unpack_from('>H', data, pos + 2)[0]
+        if sign_code == 4:
+            x -= 65536
+        return (x, pos + 4)
+    else:
+        return (UnknownRange(b), pos + 1)
+
+
+def readArrayAt(data, pos):
+    first, pos = readArrayRangeAt(data, pos)
+    last, pos = readArrayRangeAt(data, pos)
+    return ((first, last), pos)
+
+
+def readIsAt(data, pos):
+    type_code = ord(data[pos])
+    if type_code == 3:
+        x, pos = readIntAt(data, pos + 1)
+        return ((type_code, x), pos)
+    elif type_code == 5:
+        s, pos = readStringAt(data, pos + 5)
+        return ((type_code, s), pos)
+    return ((type_code, None), pos + 1)
+
+
+def readIntegerAt(data, pos):
+    type_code = ord(data[pos])
+    pos += 1
+    if type_code == 0x04:
+        return ((type_code, struct.unpack_from('>I', data, pos)[0]), pos + 4)
+    elif type_code == 0x03:
+        return ((type_code, struct.unpack_from('>H', data, pos)[0]), pos + 2)
+    elif type_code == 0x02 or type_code == 0x05:
+        s, pos = readStringAt(data, pos)
+        return ((type_code, s), pos)
+    elif type_code == 0x0A:
+        s, pos = readStringAt(data, pos + 2)
+        return ((type_code, s), pos)
+    return ((type_code, None), pos)
+
+
+BUFFER_READERS = {
+    readByte: readByteAt,
+    readString: readStringAt,
+    readInt: readIntAt,
+    readArray: readArrayAt,
+    readIs: readIsAt,
+    readInteger: readIntegerAt,
+}
+
+
+# The skippers find where a payload ends without decoding it, for scans
+# that only need to know where records start.
+
+def skipByteAt(data, pos):
+    return pos + 1
+
+
+def skipStringAt(data, pos):
+    return pos + 1 + ord(data[pos])
+
+
+def skipArrayRangeAt(data, pos):
+    b = ord(data[pos])
+    if b == 0:
+        return skipStringAt(data, pos + 2)
+    elif b == 3:
+        return pos + 4
+    return pos + 1
+
+
+def skipArrayAt(data, pos):
+    return skipArrayRangeAt(data, skipArrayRangeAt(data, pos))
+
+
+def skipIsAt(data, pos):
+    type_code = ord(data[pos])
+    if type_code == 3:
+        return skipStringAt(data, pos + 1)
+    elif type_code == 5:
+        return skipStringAt(data, pos + 5)
+    return pos + 1
+
+
+def skipIntegerAt(data, pos):
+    type_code = ord(data[pos])
+    pos += 1
+    if type_code == 0x04:
+        return pos + 4
+    elif type_code == 0x03:
+        return pos + 2
+    elif type_code == 0x02 or type_code == 0x05:
+        return skipStringAt(data, pos)
+    elif type_code == 0x0A:
+        return skipStringAt(data, pos + 2)
+    return pos
+
+
+SKIPPERS = {
+    readByte: skipByteAt,
+    readString: skipStringAt,
+    # readInt's length byte is laid out like a string's
+    readInt: skipStringAt,
+    readArray: skipArrayAt,
+    readIs: skipIsAt,
+    readInteger: skipIntegerAt,
+}
+
+
+class Opcode(object):
+    __slots__ = ('code', 'name', 'skip', 'reader', 'readerAt', 'skipperAt')
+
+    def __init__(self, code, name, skip, reader):
+        self.code = code
+        self.name = name
+        self.skip = skip
+        self.reader = reader
+        self.readerAt = BUFFER_READERS.get(reader)
+        self.skipperAt = SKIPPERS.get(reader)
+
+
+OPCODES = [None] * 256
+
+
+def defineOpcode(code, name, skip=0, reader=None):
+    OPCODES[code] = Opcode(code, name, skip, reader)
+
+
+defineOpcode(TOKEN_UNIT, 'unit', 5, readString)
+defineOpcode(TOKEN_PROGRAM, 'program', 5, readString)
+defineOpcode(TOKEN_INTERFACE, 'interface', 5)
+defineOpcode(TOKEN_IMPLEMENTATION, 'implementation', 5)
+defineOpcode(TOKEN_COND_COMP, 'CONDITIONAL', 3, readString)
+defineOpcode(TOKEN_SEMICOLON, ';', 0, readByte)
+defineOpcode(TOKEN_NEWLINE, 'NEWLINE', 0, readByte)
+defineOpcode(TOKEN_USES, 'uses', 1)
+defineOpcode(TOKEN_IDENTIFIER, 'IDENTIFIER_1', 1, readString)
+defineOpcode(TOKEN_IDENTIFIER2, 'IDENTIFIER_2', 0, readString)
+defineOpcode(TOKEN_COMMA, ',', 0, readByte)
+defineOpcode(TOKEN_CONST, 'const', 1)
+defineOpcode(TOKEN_COMMENT, 'COMMENT', 3, readString)
+defineOpcode(TOKEN_CONST_DEF, 'CONST_DEF', 1, readString)
+defineOpcode(TOKEN_IS, 'IS', 0, readIs)
+defineOpcode(TOKEN_POINTER, '^', 1, readString)
+defineOpcode(TOKEN_PACKED_A, 'packedA', 1)
+defineOpcode(TOKEN_PACKED_R, 'packedR', 1)
+defineOpcode(TOKEN_RECORD, 'record', 1)
+defineOpcode(TOKEN_TYPE, 'type', 1)
+defineOpcode(TOKEN_ARRAY, 'array', 1, readArray)
+defineOpcode(TOKEN_OF, 'of', 1)
+defineOpcode(TOKEN_COLON, ':', 0, readByte)
+defineOpcode(TOKEN_END, 'end', 1)
+defineOpcode(TOKEN_STRING, 'String', 1, readInt)
+defineOpcode(TOKEN_VAR, 'var', 1)
+defineOpcode(TOKEN_FUNCTION, 'function', 5, readString)
+defineOpcode(TOKEN_LPAREN, '(1', 1)
+defineOpcode(TOKEN_RPAREN, ')1', 1)
+defineOpcode(TOKEN_PROCEDURE, 'procedure', 5, readString)
+defineOpcode(TOKEN_BEGIN, 'begin', 9)
+defineOpcode(TOKEN_WITH, 'with', 1)
+defineOpcode(TOKEN_IF, 'if', 1)
+defineOpcode(TOKEN_STATEMENT, 'STATEMENT', 1)
+defineOpcode(TOKEN_ELSE, 'else', 1)
+defineOpcode(TOKEN_OR, 'or')
+defineOpcode(TOKEN_EQUALS, '=')
+defineOpcode(TOKEN_NOT_EQUALS, '<>')
+defineOpcode(TOKEN_GETS, ':=')
+defineOpcode(TOKEN_LPAREN2, '(2')
+defineOpcode(TOKEN_RPAREN2, ')2')
+defineOpcode(TOKEN_COMMA2, ',')
+defineOpcode(TOKEN_COMMA3, ',')
+defineOpcode(TOKEN_INTEGER, 'INTEGER', 0, readInteger)
+defineOpcode(TOKEN_TIMES, '*')
+defineOpcode(TOKEN_MOD, 'mod')
+defineOpcode(TOKEN_SLASH, '/')
+defineOpcode(TOKEN_DIV, 'div')
+defineOpcode(TOKEN_SPACE, 'SPACE')
+defineOpcode(TOKEN_LESS_EQUAL, '<=')
+defineOpcode(TOKEN_GR_EQUAL, '>=')
+defineOpcode(TOKEN_LBRACKET, '[')
+defineOpcode(TOKEN_RBRACKET, ']')
+defineOpcode(TOKEN_IN, 'in')
+defineOpcode(TOKEN_RANGE, '..')
+defineOpcode(TOKEN_PLUS, '+')
+defineOpcode(TOKEN_MINUS, '-')
+defineOpcode(TOKEN_NULL, 'null')
+defineOpcode(TOKEN_HYPHEN, '-')
+defineOpcode(TOKEN_CASE, 'case', 1)
+defineOpcode(TOKEN_DO, 'do', 1)
+defineOpcode(TOKEN_FOR, 'for', 1, readString)
+defineOpcode(TOKEN_AT, '@')
+defineOpcode(TOKEN_WHILE, 'while_1', 1)
+defineOpcode(TOKEN_WHILE2, 'while_2', 1)
+defineOpcode(TOKEN_DEFAULT, 'default', 1)
+defineOpcode(TOKEN_NOT, 'not')
+defineOpcode(TOKEN_AND, 'and')
+defineOpcode(TOKEN_LESS_THAN, '<')
+defineOpcode(TOKEN_GREATER_THAN, '>')
+defineOpcode(TOKEN_DOT, '.')
+defineOpcode(TOKEN_DEREFERENCE, '^')
+defineOpcode(TOKEN_TO, 'to')
+defineOpcode(TOKEN_DOWN_TO, 'down to')
+defineOpcode(TOKEN_PERIOD, '.', 3)
+
+
+# bump when a reader changes what it returns for the same bytes
+DECODER_VERSION = 2
+
+
+def opcodeTableVersion():
+    # a short hash of the opcode table, for anything that keeps decoded
+    # output around and has to notice when the decoder changes
+    h = hashlib.sha1('%d\n' % DECODER_VERSION)
+    for op in OPCODES:
+        if op is not None:
+            reader = op.reader.__name__ if op.reader else '-'
+            h.update('%02X %s %d %s\n' % (op.code, op.name, op.skip, reader))
+    return h.hexdigest()[:12]
+
+
+def decode(infile):
+    # yields (code, value) for every record; value is None for opcodes
+    # without a payload and for bytes that aren't in OPCODES at all
+    read = infile.read
+    opcodes = OPCODES
+    while True:
+        b = read(1)
+        if b == '':
+            break
+        b = ord(b)
+        op = opcodes[b]
+        if op is None:
+            yield b, None
+            continue
+        if op.skip:
+            read(op.skip)
+        if op.reader is None:
+            yield b, None
+        else:
+            yield b, op.reader(infile)
+
+
+def decodeBuffer(data, start=0, end=None):
+    # same records as decode(), read from a string or mmap of the whole file
+    if end is None:
+        end = len(data)
+    opcodes = OPCODES
+    pos = start
+    while pos < end:
+        b = ord(data[pos])
+        pos += 1
+        op = opcodes[b]
+        if op is None:
+            yield b, None
+            continue
+        pos += op.skip
+        if op.readerAt is None:
+            yield b, None
+        else:
+            value, pos = op.readerAt(data, pos)
+            yield b, value
+
+
+def decodeOffsets(data, start=0, end=None):
+    # the records of decodeBuffer as (offset, code, value), for consumers
+    # that need to know where each one starts
+    if end is None:
+        end = len(data)
+    opcodes = OPCODES
+    pos = start
+    while pos < end:
+        offset = pos
+        b = ord(data[pos])
+        pos += 1
+        op = opcodes[b]
+        if op is None:
+            yield offset, b, None
+            continue
+        pos += op.skip
+        if op.readerAt is None:
+            yield offset, b, None
+        else:
+            value, pos = op.readerAt(data, pos)
+            yield offset, b, value
+
+
+def scanBuffer(data, start=0, end=None):
+    # yields (offset, code) for every record, without decoding payloads
+    if end is None:
+        end = len(data)
+    opcodes = OPCODES
+    pos = start
+    while pos < end:
+        b = ord(data[pos])
+        yield pos, b
+        pos += 1
+        op = opcodes[b]
+        if op is not None:
+            pos += op.skip
+            if op.skipperAt is not None:
+                pos = op.skipperAt(data, pos)
+
+
+# Recovery: decodeBuffer turns every unknown byte into a record of its own,
+# so one damaged record becomes a long run of them.  decodeRecovering
+# instead looks ahead for the next offset where a few records in a row
+# decode cleanly, resumes there, and yields a single (TOKEN_ERROR, (start,
+# end)) record for the bytes in between.
+
+# records in a row that have to decode before a resync point is believed
+RESYNC_RECORDS = 4
+
+DEFAULT_MAX_ERRORS = 100
+
+
+class DecodeError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def recordEnd(data, pos, end):
+    # where the record at pos ends, or None if there can't be one there
+    op = OPCODES[ord(data[pos])]
+    if op is None:
+        return None
+    pos += 1 + op.skip
+    if op.skipperAt is not None:
+        try:
+            pos = op.skipperAt(data, pos)
+        except IndexError:
+            return None
+    if pos > end:
+        return None
+    return pos
+
+
+def resync(data, pos, end):
+    # the first offset after pos from which RESYNC_RECORDS records (or the
+    # rest of the data) decode
+    for start in xrange(pos + 1, end):
+        p = start
+        for i in xrange(RESYNC_RECORDS):
+            p = recordEnd(data, p, end)
+            if p is None or p == end:
+                break
+        if p is not None:
+            return start
+    return end
+
+
+def decodeRecovering(data, start=0, end=None, maxErrors=DEFAULT_MAX_ERRORS):
+    # the records of decodeBuffer, with damaged spans skipped; raises
+    # DecodeError at the first span past maxErrors
+    for offset, code, value in decodeRecoveringOffsets(data, start, end, maxErrors):
+        yield code, value
+
+
+def decodeRecoveringOffsets(data, start=0, end=None, maxErrors=DEFAULT_MAX_ERRORS):
+    # decodeRecovering as (offset, code, value)
+    if end is None:
+        end = len(data)
+    opcodes = OPCODES
+    errors = 0
+    pos = start
+    while pos < end:
+        b = ord(data[pos])
+        op = opcodes[b]
+        if op is not None:
+            after = pos + 1 + op.skip
+            if op.readerAt is None:
+                value = None
+            else:
+                try:
+                    value, after = op.readerAt(data, after)
+                except (IndexError, struct.error):
+                    # a payload that runs off the end
+                    op = None
+            if op is not None and after <= end:
+                yield pos, b, value
+                pos = after
+                continue
+        errors += 1
+        if errors > maxErrors:
+            raise DecodeError('more than %d damaged spans, the last at offset %d' % (maxErrors, pos))
+        skipped = resync(data, pos, end)
+        yield pos, TOKEN_ERROR, (pos, skipped)
+        pos = skipped
+
+
+def recordErrors(code, value):
+    # the messages for whatever part of a decoded record couldn't be decoded
+    if code == TOKEN_ERROR and value is not None:
+        start, end = value
+        return ['skipped %d damaged bytes at offset %d' % (end - start, start)]
+    elif OPCODES[code] is None:
+        return ['unknown byte %02X' % code]
+    elif code == TOKEN_IS and value[1] is None:
+        return ['unknown type code %02X' % value[0]]
+    elif code == TOKEN_INTEGER and value[1] is None:
+        return ['unknown number code %02X' % value[0]]
+    elif code == TOKEN_ARRAY:
+        return ['unknown array range %02X' % bound.kind for bound in value if isinstance(bound, UnknownRange)]
+    return []
+
+
+# the codes whose records can have errors
+ERROR_CODES = frozenset([code for code in xrange(256) if OPCODES[code] is None] +
+                        [TOKEN_IS, TOKEN_INTEGER, TOKEN_ARRAY])
+
+
+def traceErrors(code, value):
+    for message in recordErrors(code, value):
+        lspTrace.error(message)
+
+
+def tracing(functions):
+    # a copy of a table of (code, value) functions, such as parseLSP's
+    # renderers, that traces each record's errors before calling them
+    def traced(function):
+        def call(code, value):
+            traceErrors(code, value)
+            return function(code, value)
+        return call
+    table = list(functions)
+    for code in ERROR_CODES:
+        table[code] = traced(functions[code])
+    return table
+
+
+def decodeInto(data, sinks, start=0, end=None, maxErrors=None):
+    # one pass over the records from start to end, handing each to every
+    # sink's record(offset, code, value) and closing the sinks at the end
+    # (see lspSinks); with maxErrors, damaged spans are skipped as in
+    # decodeRecovering.  Errors are traced here, once per record, so sinks
+    # don't trace them again.
+    if maxErrors is None:
+        records = decodeOffsets(data, start, end)
+    else:
+        records = decodeRecoveringOffsets(data, start, end, maxErrors)
+    calls = [sink.record for sink in sinks]
+    errorCodes = ERROR_CODES
+    for offset, code, value in records:
+        if code in errorCodes:
+            traceErrors(code, value)
+        for call in calls:
+            call(offset, code, value)
+    for sink in sinks:
+        sink.close()
+
+
+def loadFile(infile, unwrap=False):
+    # map the whole file read-only (mmap refuses empty files), and with
+    # unwrap, take the data fork out of a MacBinary or AppleSingle wrapper
+    try:
+        data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        data = infile.read()
+    if unwrap:
+        return lspArchive.unwrap(data)
+    return data
+
+
+def decodeFile(infile, stream=False, stats=None, maxErrors=None, unwrap=False):
+    # stats is an lspStats.DecodeStats to record into.  With maxErrors,
+    # damaged spans are skipped (see decodeRecovering) instead of decoded
+    # byte by byte.  Either way the file is mapped whole, so stream only
+    # applies without both.
+    if stats is not None:
+        return stats.decode(loadFile(infile, unwrap), name=getattr(infile, 'name', None), maxErrors=maxErrors)
+    if maxErrors is not None:
+        return decodeRecovering(loadFile(infile, unwrap), maxErrors=maxErrors)
+    if stream:
+        return decode(lspArchive.openDataFork(infile) if unwrap else infile)
+    return decodeBuffer(loadFile(infile, unwrap))
+
+
+def addRecoveryArguments(parser):
+    parser.add_argument('--recover', action='store_true',
+                        help='skip damaged spans of the file as one error each instead of byte by byte')
+    parser.add_argument('--max-errors', type=int, default=DEFAULT_MAX_ERRORS, metavar='n',
+                        help='with --recover, give up on a file after n errors (default: %(default)d)')
+
+
+def errorBudget(args):
+    # the maxErrors the tools pass on, or None without --recover
+    return args.max_errors if args.recover else None
+
+
+def samplePayloads():
+    # (reader, payload) pairs covering each reader's layouts, including the
+    # two byte ints whose first byte (4) is also the sign marker
+    strings = ['\x00', '\x01A', '\x05Hello', '\xff' + 'x' * 255]
+    ints = ['\x00', '\x01\x04', '\x01\x7f']
+    for high in xrange(256):
+        for low in (0x00, 0x10, 0xff):
+            ints.append('\x02' + chr(high) + chr(low))
+            ints.append('\x03' + chr(high) + chr(low) + '\x01')
+    for x in xrange(1024, 1280):
+        ints.append('\x02' + struct.pack('>H', x))
+    ranges = ['\x00\x00' + s for s in strings]
+    ranges += ['\x03' + sign + struct.pack('>H', x) for sign in '\x00\x04' for x in (0, 1, 1040, 65535)]
+    ranges.append('\x07')
+    payloads = [(readByte, chr(b)) for b in xrange(256)]
+    payloads += [(readString, s) for s in strings]
+    payloads += [(readInt, i) for i in ints]
+    payloads += [(readArray, a + b) for a in ranges for b in ranges]
+    payloads += [(readIs, '\x03' + i) for i in ints]
+    payloads += [(readIs, '\x05\x00\x00\x00\x00' + s) for s in strings]
+    payloads += [(readIs, '\x09')]
+    for x in (0, 1, 1040, 0x7fffffff, 0x80000000, 0xffffffff):
+        payloads.append((readInteger, '\x04' + struct.pack('>I', x)))
+    for x in (0, 1040, 0xffff):
+        payloads.append((readInteger, '\x03' + struct.pack('>H', x)))
+    payloads += [(readInteger, code + s) for code in '\x02\x05' for s in strings]
+    payloads += [(readInteger, '\x0a\x00\x00' + s) for s in strings]
+    payloads.append((readInteger, '\x09'))
+    return payloads
+
+
+def checkReaders():
+    # compare each buffer reader against its stream reader on samplePayloads:
+    # the same value, and the same number of bytes used
+    ok = True
+    payloads = samplePayloads()
+    for reader, payload in payloads:
+        f = cStringIO.StringIO(payload)
+        expected = (reader(f), f.tell())
+        actual = BUFFER_READERS[reader](payload, 0)
+        if expected != actual or repr(expected) != repr(actual):
+            print '%s %r: %r != %r' % (reader.__name__, payload, expected, actual)
+            ok = False
+    if ok:
+        print '%d payloads match' % len(payloads)
+    return ok
+
+
+def checkFile(infilename, unwrap=False):
+    # compare the buffer decoder against the stream readers record by record
+    with open(infilename, 'rb') as infile:
+        expected = decodeFile(infile, stream=True, unwrap=unwrap)
+        with open(infilename, 'rb') as mapped:
+            actual = decodeBuffer(loadFile(mapped, unwrap))
+            n = 0
+            for a, b in map(None, expected, actual):
+                if a != b or repr(a) != repr(b):
+                    print '%s: record %d differs: %r != %r' % (infilename, n, a, b)
+                    return False
+                n += 1
+    print '%s: %d records match' % (infilename, n)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the buffer decoder matches the stream readers.')
+    parser.add_argument('files', nargs='*', metavar='file', help='encoded Pascal source file')
+    parser.add_argument('--readers', action='store_true',
+                        help='also compare the readers on sample payloads of every layout')
+    lspArchive.addUnwrapArgument(parser)
+    args = parser.parse_args()
+    if not args.files and not args.readers:
+        parser.error('nothing to check')
+    ok = checkReaders() if args.readers else True
+    for infilename in args.files:
+        ok = checkFile(infilename, args.unwrap) and ok
+    sys.exit(0 if ok else 1)
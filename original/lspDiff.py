@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# Token-level diff between two encoded versions of a Lightspeed Pascal (LSP)
+# unit.
+#
+# Both units are cut into segments with the routine index (lspIndex): the
+# part before the first indexed record, then the interface, the
+# implementation and every procedure and function, each up to the next.
+# Segments are paired by kind, name and how many of the same name came
+# before (a routine is usually declared in the interface and defined in the
+# implementation).  A pair whose bytes are the same is identical and never
+# decoded.  The rest are decoded, and those whose tokens still differ (not
+# just in the skipped bytes) go through Myers' O(ND) diff, after trimming
+# the tokens they start and end with in common.  So apart from finding the
+# segments, the work grows with how much changed, not with the size of the
+# unit.
+
+import argparse
+import json
+import sys
+from lspArchive import addUnwrapArgument
+from lspDecoder import (DecodeError, addRecoveryArguments, decodeOffsets, decodeRecoveringOffsets,
+                        errorBudget, loadFile)
+from lspIndex import loadIndex
+from lspOutput import openOutput
+from lspTokenStream import TEXT_ENCODING, TOKEN_NAMES
+from lspTokenizer import TRACING_EMITTERS, TRACING_SIGNIFICANT_EMITTERS
+import lspTrace
+
+
+class Segment(object):
+    __slots__ = ('kind', 'name', 'start', 'end', 'offsets', 'tokens')
+
+    def __init__(self, kind, name, start, end):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.end = end
+        self.offsets = None
+        self.tokens = None
+
+    def title(self):
+        if self.name is None:
+            return self.kind
+        return '%s %s' % (self.kind, self.name.encode('utf-8'))
+
+
+def splitUnit(infilename, data, unwrap=False):
+    # {(kind, lowercased name, n): Segment} and the keys in file order
+    routines = loadIndex(infilename, data, save=False, unwrap=unwrap)['routines']
+    segments = {}
+    order = []
+    first = routines[0][2] if routines else len(data)
+    spans = [('header', None, 0, first)] + [tuple(entry) for entry in routines]
+    for kind, name, start, end in spans:
+        key = (kind, name.lower() if name else None, 0)
+        while key in segments:
+            key = (key[0], key[1], key[2] + 1)
+        segments[key] = Segment(kind, name, start, end)
+        order.append(key)
+    return segments, order
+
+
+def decodeSegment(data, segment, trivia=False, maxErrors=None):
+    # fills in the segment's tokens, as (code, value), and their offsets
+    emitters = TRACING_EMITTERS if trivia else TRACING_SIGNIFICANT_EMITTERS
+    if maxErrors is None:
+        records = decodeOffsets(data, segment.start, segment.end)
+    else:
+        records = decodeRecoveringOffsets(data, segment.start, segment.end, maxErrors)
+    offsets = []
+    tokens = []
+    for offset, code, value in records:
+        token = emitters[code](code, value)
+        if token is not None:
+            offsets.append(offset)
+            tokens.append((code, token[2]))
+    segment.offsets = offsets
+    segment.tokens = tokens
+
+
+def shortestEdit(a, b):
+    # Myers' greedy algorithm: the shortest list of ('-', i) deletions from
+    # a and ('+', j) insertions from b that turns a into b, in order.  Only
+    # the diagonals reached so far are kept for each d, so time and space
+    # grow with the number of edits, not with the lengths.
+    n = len(a)
+    m = len(b)
+    trace = []
+    previous = { 1: 0 }
+    for d in xrange(n + m + 1):
+        current = {}
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and previous[k - 1] < previous[k + 1]):
+                x = previous[k + 1]
+            else:
+                x = previous[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            current[k] = x
+            if x >= n and y >= m:
+                trace.append(current)
+                return backtrack(trace, n, m)
+        trace.append(current)
+        previous = current
+    return []
+
+
+def backtrack(trace, x, y):
+    # walks back from (x, y), the ends of both sequences; between the end
+    # of one edit and the next there are only equal items
+    edits = []
+    for d in xrange(len(trace) - 1, 0, -1):
+        previous = trace[d - 1]
+        k = x - y
+        if k == -d or (k != d and previous[k - 1] < previous[k + 1]):
+            k += 1
+            x = previous[k]
+            y = x - k
+            edits.append(('+', y))
+        else:
+            k -= 1
+            x = previous[k]
+            y = x - k
+            edits.append(('-', x))
+    edits.reverse()
+    return edits
+
+
+def diffTokens(a, b):
+    # shortestEdit after trimming the common head and tail
+    head = 0
+    limit = min(len(a), len(b))
+    while head < limit and a[head] == b[head]:
+        head += 1
+    tail = 0
+    while tail < limit - head and a[len(a) - 1 - tail] == b[len(b) - 1 - tail]:
+        tail += 1
+    edits = shortestEdit(a[head:len(a) - tail], b[head:len(b) - tail])
+    return [(op, index + head) for op, index in edits]
+
+
+def diffUnits(oldname, newname, trivia=False, maxErrors=None, unwrap=False):
+    # yields (status, old segment, new segment, edits) per segment, with
+    # status one of 'same', 'changed', 'removed', 'added'; edits is a list of
+    # ('-', old token index) and ('+', new token index)
+    with open(oldname, 'rb') as infile:
+        oldData = loadFile(infile, unwrap)
+    with open(newname, 'rb') as infile:
+        newData = loadFile(infile, unwrap)
+    oldSegments, oldOrder = splitUnit(oldname, oldData, unwrap)
+    newSegments, newOrder = splitUnit(newname, newData, unwrap)
+    for key in oldOrder:
+        old = oldSegments[key]
+        new = newSegments.get(key)
+        if new is None:
+            yield 'removed', old, None, []
+            continue
+        if oldData[old.start:old.end] == newData[new.start:new.end]:
+            yield 'same', old, new, []
+            continue
+        decodeSegment(oldData, old, trivia, maxErrors)
+        decodeSegment(newData, new, trivia, maxErrors)
+        if old.tokens == new.tokens:
+            yield 'same', old, new, []
+            continue
+        yield 'changed', old, new, diffTokens(old.tokens, new.tokens)
+    for key in newOrder:
+        if key not in oldSegments:
+            yield 'added', None, newSegments[key], []
+
+
+def formatToken(offset, token):
+    code, value = token
+    return '%d\t%s\t%s' % (offset, TOKEN_NAMES.get(code, '%02X' % code),
+                           json.dumps(value, encoding=TEXT_ENCODING, ensure_ascii=False).encode('utf-8'))
+
+
+def writeDiff(oldname, newname, out, trivia=False, maxErrors=None, unwrap=False):
+    # returns the number of segments that differ
+    counts = { 'same': 0, 'changed': 0, 'removed': 0, 'added': 0 }
+    out.write('--- %s\n+++ %s\n' % (oldname, newname))
+    for status, old, new, edits in diffUnits(oldname, newname, trivia, maxErrors, unwrap):
+        counts[status] += 1
+        if status == 'removed':
+            out.write('- %s\n' % old.title())
+        elif status == 'added':
+            out.write('+ %s\n' % new.title())
+        elif status == 'changed':
+            out.write('~ %s\n' % new.title())
+            for op, index in edits:
+                if op == '-':
+                    out.write('  -\t%s\n' % formatToken(old.offsets[index], old.tokens[index]))
+                else:
+                    out.write('  +\t%s\n' % formatToken(new.offsets[index], new.tokens[index]))
+    lspTrace.info('%d segments the same, %d changed, %d removed, %d added' %
+                  (counts['same'], counts['changed'], counts['removed'], counts['added']))
+    return counts['changed'] + counts['removed'] + counts['added']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two encoded Lightspeed Pascal source files token by token.')
+    parser.add_argument('oldname', metavar='old', help='encoded Pascal source file')
+    parser.add_argument('newname', metavar='new', help='encoded Pascal source file')
+    parser.add_argument('--trivia', action='store_true', help='compare SPACE and NEWLINE tokens too')
+    parser.add_argument('-o', '--output', metavar='outfile',
+                        help='write to outfile instead of standard output')
+    addRecoveryArguments(parser)
+    addUnwrapArgument(parser)
+    lspTrace.addArguments(parser)
+    args = parser.parse_args()
+    lspTrace.configure(args)
+
+    out = openOutput(args.output)
+    try:
+        differences = writeDiff(args.oldname, args.newname, out, args.trivia, errorBudget(args), args.unwrap)
+    except DecodeError as e:
+        lspTrace.error(str(e.value))
+        sys.exit(2)
+    finally:
+        out.close()
+    # like diff: 0 if the same, 1 if not
+    sys.exit(1 if differences else 0)
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# Output equivalence test for the Lightspeed Pascal (LSP) decoders.
+#
+# parseLSP and lspTokenizer decode either with the stream readers (--stream,
+# a byte at a time) or with the buffer readers (the default).  This decodes
+# the same inputs both ways, renders each as parseLSP text, JSON tokens and
+# binary tokens, and checks that the bytes are the same.  The inputs are:
+#
+#   generated lspCorpus units
+#   one record per reader layout in lspDecoder.samplePayloads
+#   fuzzed copies of the units: bytes changed, inserted, or cut short
+#
+# It prints the first difference of each input and exits 1 if there was
+# any, so it can run as a test.
+
+import argparse
+import cStringIO
+import random
+import sys
+from lspCorpus import generateUnit, parseSize
+from lspDecoder import OPCODES, decode, decodeBuffer, samplePayloads
+from lspTokenStream import BinaryTokenWriter, JsonTokenWriter
+import lspTokenizer
+import lspTrace
+import parseLSP
+
+
+def collect(records):
+    # the records, and whether decoding them failed part way
+    decoded = []
+    try:
+        for record in records:
+            decoded.append(record)
+    except Exception:
+        return decoded, True
+    return decoded, False
+
+
+def render(records):
+    # (kind, bytes) for every output of the records
+    text = cStringIO.StringIO()
+    parseLSP.renderRecords(records, text)
+    outputs = [('text', text.getvalue())]
+    for kind, Writer in (('tokens', JsonTokenWriter), ('binary tokens', BinaryTokenWriter)):
+        out = cStringIO.StringIO()
+        writer = Writer(out)
+        for code, name, value in lspTokenizer.processRecords(records):
+            writer.write(code, name, value)
+        writer.close()
+        outputs.append((kind, out.getvalue()))
+    return outputs
+
+
+def firstDifference(a, b):
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+    return min(len(a), len(b))
+
+
+def checkData(name, data):
+    expected, expectedFailed = collect(decode(cStringIO.StringIO(data)))
+    actual, actualFailed = collect(decodeBuffer(data))
+    if expectedFailed != actualFailed:
+        print '%s: the stream readers %s, the buffer readers %s' % (
+            name, 'fail' if expectedFailed else 'finish', 'fail' if actualFailed else 'finish')
+        return False
+    for (kind, a), (_, b) in zip(render(expected), render(actual)):
+        if a != b:
+            i = firstDifference(a, b)
+            print '%s: %s differs at byte %d: %r != %r' % (name, kind, i, a[i:i + 40], b[i:i + 40])
+            return False
+    return True
+
+
+def layoutRecords():
+    # (name, data) of a record for each sample payload, under the first
+    # opcode with that reader
+    opcodes = {}
+    for op in OPCODES:
+        if op is not None and op.reader is not None:
+            opcodes.setdefault(op.reader, op)
+    for reader, payload in samplePayloads():
+        op = opcodes[reader]
+        yield '%s %r' % (reader.__name__, payload), chr(op.code) + '\0' * op.skip + payload
+
+
+def fuzz(data, rng):
+    # a damaged copy of data
+    kind = rng.randint(0, 2)
+    if kind == 0:
+        data = bytearray(data)
+        for i in xrange(rng.randint(1, 8)):
+            data[rng.randrange(len(data))] = rng.randint(0, 255)
+        return str(data)
+    elif kind == 1:
+        pos = rng.randrange(len(data))
+        return data[:pos] + chr(rng.randint(0, 255)) + data[pos:]
+    return data[:rng.randrange(len(data))]
+
+
+def runChecks(count, size, mutants, seed=0):
+    # returns the number of inputs that differ
+    lspTrace.setLevel(lspTrace.QUIET)
+    rng = random.Random(seed)
+    inputs = list(layoutRecords())
+    for i in xrange(count):
+        name = 'Unit%d' % i
+        data = generateUnit(name, size, seed=seed + i)
+        inputs.append((name, data))
+        for j in xrange(mutants):
+            inputs.append(('%s fuzzed %d' % (name, j), fuzz(data, rng)))
+    failures = 0
+    for name, data in inputs:
+        if not checkData(name, data):
+            failures += 1
+    print '%d of %d inputs differ' % (failures, len(inputs))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the stream and buffer decoders render the same output.')
+    parser.add_argument('-n', '--count', type=int, default=4, help='units to generate (default: 4)')
+    parser.add_argument('-s', '--size', type=parseSize, default=parseSize('32K'),
+                        help='size of each generated unit (default: 32K)')
+    parser.add_argument('-m', '--mutants', type=int, default=25,
+                        help='fuzzed copies of each unit (default: 25)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args()
+    sys.exit(1 if runChecks(args.count, args.size, args.mutants, args.seed) else 0)
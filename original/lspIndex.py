@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# Routine offset index for encoded Lightspeed Pascal (LSP) units.
+#
+# A quick pass over the file (record boundaries only, no payload decoding)
+# finds every procedure, function, interface and implementation record.
+# Each entry is [kind, name, start, end]: the byte span from that record up
+# to the next indexed record, or to the end of the file.  The index is kept
+# next to the unit as FILE.idx and rebuilt whenever the unit, the opcode
+# table or whether it was unwrapped (which moves every offset) changes, so
+# decoding one routine can seek straight to its span.
+
+import argparse
+import json
+import os
+from tokens import *
+from lspArchive import addUnwrapArgument
+from lspDecoder import OPCODES, loadFile, opcodeTableVersion, readStringAt, scanBuffer
+
+INDEXED = {
+    TOKEN_PROCEDURE: 'procedure',
+    TOKEN_FUNCTION: 'function',
+    TOKEN_INTERFACE: 'interface',
+    TOKEN_IMPLEMENTATION: 'implementation',
+}
+
+INDEX_SUFFIX = '.idx'
+
+
+def scanRoutines(data):
+    entries = []
+    indexed = INDEXED
+    for offset, code in scanBuffer(data):
+        kind = indexed.get(code)
+        if kind is None:
+            continue
+        if entries:
+            entries[-1][3] = offset
+        name = None
+        if OPCODES[code].reader is not None:
+            name = readStringAt(data, offset + 1 + OPCODES[code].skip)[0].decode('mac_roman')
+        entries.append([kind, name, offset, len(data)])
+    return entries
+
+
+def indexStamp(infilename, unwrap=False):
+    st = os.stat(infilename)
+    return { 'size': st.st_size, 'mtime': st.st_mtime, 'version': opcodeTableVersion(), 'unwrapped': unwrap }
+
+
+def buildIndex(infilename, data=None, unwrap=False):
+    # data, if given, is the file as loaded with unwrap
+    if data is None:
+        with open(infilename, 'rb') as infile:
+            data = loadFile(infile, unwrap)
+    index = indexStamp(infilename, unwrap)
+    index['routines'] = scanRoutines(data)
+    return index
+
+
+def loadIndex(infilename, data=None, save=True, rebuild=False, unwrap=False):
+    # the sidecar index if it is current, otherwise a fresh one (saved for
+    # next time if the directory is writable)
+    indexfilename = infilename + INDEX_SUFFIX
+    stamp = indexStamp(infilename, unwrap)
+    if not rebuild:
+        try:
+            with open(indexfilename) as f:
+                index = json.load(f)
+            if all(index.get(key) == value for key, value in stamp.items()):
+                return index
+        except (IOError, ValueError):
+            pass
+    index = buildIndex(infilename, data, unwrap)
+    if save:
+        try:
+            with open(indexfilename, 'w') as f:
+                json.dump(index, f)
+        except IOError:
+            pass
+    return index
+
+
+def findRoutine(index, name):
+    # spans of every indexed record called name (a routine is usually
+    # declared in the interface and defined in the implementation);
+    # Pascal names are case insensitive
+    name = name.lower()
+    return [(start, end) for kind, entry, start, end in index['routines']
+            if entry is not None and entry.lower() == name]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the routines of encoded Lightspeed Pascal units.')
+    parser.add_argument('files', nargs='+', metavar='file', help='encoded Pascal source file')
+    parser.add_argument('--rebuild', action='store_true', help='ignore any saved index')
+    addUnwrapArgument(parser)
+    args = parser.parse_args()
+
+    for infilename in args.files:
+        index = loadIndex(infilename, rebuild=args.rebuild, unwrap=args.unwrap)
+        for kind, name, start, end in index['routines']:
+            print '%s\t%s\t%s\t%d\t%d' % (infilename, kind, (name or '').encode('utf-8'), start, end)
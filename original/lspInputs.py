@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# Find the encoded Lightspeed Pascal (LSP) files to work on.
+#
+# The tools that take many files (lspBatch, lspSymbols, lspColumns) accept
+# files, directories (searched recursively) and glob patterns.  Hidden files
+# and directories are skipped, and so are the outputs and sidecar files the
+# tools write, so a tree can be converted in place and converted again.
+
+import fnmatch
+import glob
+import os
+from lspIndex import INDEX_SUFFIX
+
+# outputs of the lspBatch tools and sidecar files, which are never inputs
+OUTPUT_SUFFIXES = ('.p', '.tokens', '.btokens', '.lspc', '.json', INDEX_SUFFIX)
+
+
+def isMagic(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+def globBase(pattern):
+    # the leading directories of a pattern that contain no wildcards
+    parts = pattern.split(os.sep)
+    base = []
+    for part in parts[:-1]:
+        if isMagic(part):
+            break
+        base.append(part)
+    return os.sep.join(base)
+
+
+def wanted(filename, match):
+    name = os.path.basename(filename)
+    if name.startswith('.') or name.endswith(OUTPUT_SUFFIXES):
+        return False
+    return fnmatch.fnmatch(name, match)
+
+
+def findInputs(paths, match='*'):
+    # yields (infilename, path relative to the tree being converted)
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+                for filename in sorted(filenames):
+                    found.append(os.path.join(dirpath, filename))
+            base = path
+        elif isMagic(path):
+            found = sorted(filename for filename in glob.glob(path) if os.path.isfile(filename))
+            base = globBase(path)
+        else:
+            found = [path]
+            base = os.path.dirname(path)
+        for filename in found:
+            if filename in seen or not wanted(filename, match):
+                continue
+            seen.add(filename)
+            yield filename, os.path.relpath(filename, base or os.curdir)
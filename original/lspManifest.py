@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# Manifest of a batch conversion, for incremental runs (lspBatch.py
+# --incremental).
+#
+# For every input it records the size, mtime and content hash, the unit
+# name and the units its interface uses, and the outputs made from it.  An
+# input whose size and mtime match is taken as unchanged without reading
+# it; otherwise it is hashed, so touching a file costs a hash but not a
+# conversion.  The uses lists give the reverse dependencies: when a unit
+# changes, the units that use it (directly or not) have their trees
+# rebuilt.  A manifest written by a different decoder or tool version is
+# ignored, which rebuilds everything.
+
+import json
+import os
+import tempfile
+from lspTokenStream import TEXT_ENCODING
+
+MANIFEST_NAME = '.lsp-manifest.json'
+
+# bump when the manifest layout changes
+MANIFEST_VERSION = 1
+
+
+class Manifest(object):
+    def __init__(self, filename, stamp):
+        # stamp names everything the outputs depend on besides the inputs
+        self.filename = filename
+        self.stamp = '%d:%s' % (MANIFEST_VERSION, stamp)
+        self.files = {}
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+            if data.get('stamp') == self.stamp:
+                self.files = data['files']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        # written to a temporary name first, so an interrupted run leaves
+        # the previous manifest in place
+        directory = os.path.dirname(self.filename) or os.curdir
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({ 'stamp': self.stamp, 'files': self.files }, f, encoding=TEXT_ENCODING)
+        os.rename(temp, self.filename)
+
+    def dependents(self, units):
+        # inputs whose interfaces use any of units, directly or through
+        # other units; names are compared case-insensitively, as in Pascal
+        users = {}
+        for infilename, entry in self.files.items():
+            for unit in entry.get('uses', ()):
+                users.setdefault(unit.lower(), []).append(infilename)
+        found = set()
+        pending = [unit.lower() for unit in units]
+        while pending:
+            for infilename in users.get(pending.pop(), ()):
+                if infilename not in found:
+                    found.add(infilename)
+                    unit = self.files[infilename].get('unit')
+                    if unit:
+                        pending.append(unit.lower())
+        return found
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# Buffered output for the Lightspeed Pascal (LSP) tools.
+#
+# The decoders produce output a token at a time, often a single space or
+# newline.  OutputBuffer collects those pieces and writes them out in large
+# blocks, so the number of write() calls grows with the size of the output
+# rather than with the number of tokens.
+
+import sys
+
+BLOCK_SIZE = 256 * 1024
+
+
+class OutputBuffer(object):
+    def __init__(self, out, blockSize=BLOCK_SIZE):
+        self.out = out
+        self.blockSize = blockSize
+        self.chunks = []
+        self.size = 0
+
+    def write(self, s):
+        self.chunks.append(s)
+        self.size += len(s)
+        if self.size >= self.blockSize:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.out.write(''.join(self.chunks))
+            self.chunks = []
+            self.size = 0
+        self.out.flush()
+
+    def close(self):
+        self.flush()
+        if self.out is not sys.stdout:
+            self.out.close()
+
+
+def openOutput(outfilename):
+    # None means standard output
+    if outfilename is None:
+        return OutputBuffer(sys.stdout)
+    return OutputBuffer(open(outfilename, 'wb'))
+
+
+def addOutputArguments(parser, suffix):
+    parser.add_argument('-o', '--output', metavar='outfile',
+                        help='write to outfile instead of standard output')
+    parser.add_argument('-O', '--default-output', action='store_true',
+                        help='write to the input file name plus %s' % suffix)
+
+
+def outputFileName(args, infilename, suffix):
+    if args.default_output:
+        return infilename + suffix
+    return args.output
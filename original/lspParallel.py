@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# Decode one large encoded Lightspeed Pascal (LSP) unit on several cores.
+#
+# Records have to be walked in order to find where each one starts, but
+# the routine index (lspIndex) already knows the offsets of procedure and
+# function records, and decoding can restart at any of them.  The unit is
+# cut at the routine boundaries nearest to equal-sized pieces, a pool of
+# workers renders the pieces, and the results come back in file order, so
+# the output is the same as decoding the whole file in one pass.
+
+import bisect
+import multiprocessing
+from lspDecoder import loadFile
+from lspIndex import loadIndex
+import lspTrace
+
+# pieces per worker, so a slow piece doesn't leave the others idle
+PIECES_PER_JOB = 4
+
+# units smaller than this aren't worth splitting
+MIN_PIECE_SIZE = 256 * 1024
+
+
+def splitSpans(infilename, data, pieces, unwrap=False):
+    # (start, end) spans covering the whole file, cut at routine boundaries
+    # (an index sidecar is used if there is one, but never written)
+    size = len(data)
+    routines = loadIndex(infilename, data, save=False, unwrap=unwrap)['routines']
+    boundaries = sorted(set(start for kind, name, start, end in routines))
+    cuts = [0]
+    for i in xrange(1, pieces):
+        target = size * i / pieces
+        # the boundaries either side of the target
+        j = bisect.bisect_left(boundaries, target)
+        nearby = [offset for offset in boundaries[max(j - 1, 0):j + 1] if offset > cuts[-1]]
+        if nearby:
+            cuts.append(min(nearby, key=lambda offset: abs(offset - target)))
+    return zip(cuts, cuts[1:] + [size])
+
+
+def initWorker(level):
+    lspTrace.setLevel(level)
+
+
+def decodeInParallel(infilename, renderSpan, jobs=None, options=(), unwrap=False):
+    # yields renderSpan((infilename, start, end, unwrap) + options) for each
+    # piece, in file order; renderSpan must be a module-level function so
+    # the workers can find it
+    with open(infilename, 'rb') as infile:
+        data = loadFile(infile, unwrap)
+    jobs = jobs or multiprocessing.cpu_count()
+    pieces = max(1, min(jobs * PIECES_PER_JOB, len(data) / MIN_PIECE_SIZE))
+    tasks = [(infilename, start, end, unwrap) + tuple(options)
+             for start, end in splitSpans(infilename, data, pieces, unwrap)]
+    if len(tasks) == 1 or jobs == 1:
+        for task in tasks:
+            yield renderSpan(task)
+        return
+    pool = multiprocessing.Pool(jobs, initWorker, (lspTrace.level,))
+    try:
+        for text in pool.imap(renderSpan, tasks):
+            yield text
+    finally:
+        pool.close()
+        pool.join()
@@ -3,10 +3,19 @@
 # typically as generated by lspTokenizer.py, and, based on a Pascal grammar,
 # emit a parse tree, in JSON format.
 
+import argparse
 import fileinput
 import json
 import sys
 from tokens import *
+from lspArchive import addUnwrapArgument
+from lspDecoder import (OPCODES, DecodeError, addRecoveryArguments, decodeBuffer, decodeRecovering, errorBudget, loadFile,
+                        scanBuffer)
+from lspTokenStream import TEXT_ENCODING, TOKEN_EOF, Token, readBinaryTokens, readJsonTokens
+from lspOutput import openOutput
+from lspTreeStream import JsonTreeWriter, NdjsonTreeWriter, TreeBuilder
+import lspTokenizer
+import lspTrace
 
 
 class LSPSyntaxError(Exception):
@@ -20,43 +29,91 @@ class LSPSyntaxError(Exception):
         return repr(self.value)
 
 
-def tokenGenerator():
-    for line in fileinput.input():
-        try:
-            tuple = json.loads(line)
-            print 'read token', tuple[0], 'name', tuple[1], 'data', tuple[2]
-            token = { 'id': tuple[0], 'name': tuple[1], 'data': tuple[2] }
-            yield token
-        except Exception as e:
-            print e
+# tokens whose data is a name that recurs throughout a unit; each distinct
+# name is kept once, however many tokens refer to it
+INTERNED = set([TOKEN_IDENTIFIER, TOKEN_IDENTIFIER2, TOKEN_CONST_DEF,
+                TOKEN_UNIT, TOKEN_PROGRAM, TOKEN_PROCEDURE, TOKEN_FUNCTION,
+                TOKEN_POINTER, TOKEN_FOR])
+
+
+def tokenGenerator(tuples):
+    names = {}
+    interned = INTERNED
+    trace = lspTrace.level >= lspTrace.DEBUG
+    for id, name, data in tuples:
+        if trace:
+            lspTrace.debug('read token %s name %s data %r' % (id, name, data))
+        if id in interned:
+            data = names.setdefault(data, data)
+        yield Token(id, data)
+
+
+class TokenBuffer(object):
+    # Ring buffer of the next significant tokens, so the parser can look
+    # ahead without consuming anything.  Spaces and newlines are dropped as
+    # the buffer fills; past the end of the input every token is TOKEN_EOF.
+    def __init__(self, tokens, size=8):
+        self.tokens = tokens
+        self.ring = [None] * size
+        self.size = size
+        self.head = 0
+        self.count = 0
+
+    def fill(self, n):
+        eof = None
+        while self.count < n:
+            token = eof or next(self.tokens, None)
+            if token is None:
+                token = eof = Token(TOKEN_EOF, None)
+            elif token.id == TOKEN_SPACE or token.id == TOKEN_NEWLINE:
+                continue
+            self.ring[(self.head + self.count) % self.size] = token
+            self.count += 1
+
+    def peek(self, k=0):
+        if k >= self.count:
+            if k >= self.size:
+                raise IndexError('lookahead %d is beyond the token buffer' % k)
+            self.fill(k + 1)
+        return self.ring[(self.head + k) % self.size]
+
+    def next(self):
+        if self.count == 0:
+            self.fill(1)
+        token = self.ring[self.head]
+        self.head = (self.head + 1) % self.size
+        self.count -= 1
+        return token
+
+
+gTokens = None
+
+# the LazySource being parsed, if routine bodies are to be skipped
+gSource = None
 
 
 def getToken():
-    global gTokens
-    return next(gTokens)
+    return gTokens.next()
 
 
-def skipSpace():
-    while True:
-        token = getToken()
-        code = token['id']
-        if code != TOKEN_SPACE and code != TOKEN_NEWLINE:
-            return token
+def peekToken():
+    # the parser only ever looks one token ahead
+    return gTokens.peek()
 
 
 def require(token, code, name):
-    if token['id'] != code:
-        raise LSPSyntaxError(name, token);
+    if token.id != code:
+        raise LSPSyntaxError(name, token)
 
 
 def parseUses():
     units = []
     while True:
-        token = skipSpace()
-        if token['id'] == TOKEN_IDENTIFIER:
-            units.append(token['data'])
-            token = skipSpace()
-            if token['id'] == TOKEN_SEMICOLON:
+        token = getToken()
+        if token.id == TOKEN_IDENTIFIER:
+            units.append(token.data)
+            token = getToken()
+            if token.id == TOKEN_SEMICOLON:
                 return { 'uses': units }
             require(token, TOKEN_COMMA, ',')
         else:
@@ -66,50 +123,826 @@ def parseUses():
 def parseConst():
     constants = []
     while True:
-        name = skipSpace()
-        if name['id'] != TOKEN_CONST_DEF:
+        if peekToken().id != TOKEN_CONST_DEF:
             return { 'const': constants }
-        value = skipSpace()
+        name = getToken()
+        value = getToken()
         require(value, TOKEN_IS, '=')
-        semi = skipSpace()
+        semi = getToken()
         require(semi, TOKEN_SEMICOLON, ';')
-        constants.append({ name['data']: value['data'] })
+        constants.append({ name.data: value.data })
+
+
+# tokens that can only start a subrange type's lower bound; a type name
+# can too, and is one when '..' follows it
+SUBRANGE_STARTS = set([TOKEN_INTEGER, TOKEN_IDENTIFIER2, TOKEN_MINUS, TOKEN_HYPHEN, TOKEN_PLUS])
+
+# enumeration type brackets
+ENUMERATIONS = {
+    TOKEN_LPAREN: TOKEN_RPAREN,
+    TOKEN_LPAREN2: TOKEN_RPAREN2,
+}
+
+
+def parseEnumeration(close):
+    names = []
+    while True:
+        token = getToken()
+        if token.id != TOKEN_IDENTIFIER and token.id != TOKEN_IDENTIFIER2:
+            raise LSPSyntaxError('identifier', token)
+        names.append(token.data)
+        token = getToken()
+        if token.id == close:
+            return names
+        if token.id not in COMMAS:
+            raise LSPSyntaxError(',', token)
+
+
+def parseSubrange(low):
+    require(getToken(), TOKEN_RANGE, '..')
+    return { 'range': [low, parseExpression()] }
+
+
+def parseTypeSpec():
+    if peekToken().id in SUBRANGE_STARTS:
+        return parseSubrange(parseExpression())
+    token = getToken()
+    if token.id == TOKEN_IDENTIFIER:
+        if peekToken().id == TOKEN_RANGE:
+            # a constant's name, as parseDesignator has it
+            return parseSubrange({ 'name': token.data })
+        return token.data
+    elif token.id in ENUMERATIONS:
+        return { 'enum': parseEnumeration(ENUMERATIONS[token.id]) }
+    elif token.id == TOKEN_POINTER:
+        return { 'pointer': token.data }
+    elif token.id == TOKEN_STRING:
+        return { 'string': token.data }
+    elif token.id == TOKEN_ARRAY:
+        require(getToken(), TOKEN_OF, 'of')
+        return { 'array': { 'range': list(token.data), 'of': parseTypeSpec() } }
+    elif token.id == TOKEN_RECORD:
+        fields = parseFields()
+        require(getToken(), TOKEN_END, 'end')
+        return { 'record': fields }
+    elif token.id == TOKEN_PACKED_A or token.id == TOKEN_PACKED_R:
+        return { 'packed': parseTypeSpec() }
+    raise LSPSyntaxError('type', token)
+
+
+def parseNames():
+    names = []
+    while True:
+        token = getToken()
+        require(token, TOKEN_IDENTIFIER, 'identifier')
+        names.append(token.data)
+        if peekToken().id != TOKEN_COMMA:
+            return names
+        getToken()
+
+
+def parseFields():
+    # name, name: type; ... -- the body of a var section or a record
+    fields = []
+    while peekToken().id == TOKEN_IDENTIFIER:
+        names = parseNames()
+        require(getToken(), TOKEN_COLON, ':')
+        fields.append({ 'names': names, 'type': parseTypeSpec() })
+        require(getToken(), TOKEN_SEMICOLON, ';')
+    return fields
+
+
+def parseType():
+    types = []
+    while peekToken().id == TOKEN_CONST_DEF:
+        name = getToken()
+        types.append({ name.data: parseTypeSpec() })
+        require(getToken(), TOKEN_SEMICOLON, ';')
+    return { 'type': types }
+
+
+def parseParameters():
+    parameters = []
+    while True:
+        parameter = {}
+        if peekToken().id == TOKEN_VAR:
+            getToken()
+            parameter['var'] = True
+        parameter['names'] = parseNames()
+        require(getToken(), TOKEN_COLON, ':')
+        parameter['type'] = parseTypeSpec()
+        parameters.append(parameter)
+        token = getToken()
+        if token.id == TOKEN_RPAREN:
+            return parameters
+        require(token, TOKEN_SEMICOLON, ';')
+
+
+def parseRoutine(token, body):
+    # procedure or function header, and with body the routine's own
+    # declarations and compound statement
+    routine = { 'name': token.data }
+    if peekToken().id == TOKEN_LPAREN:
+        getToken()
+        routine['parameters'] = parseParameters()
+    if token.id == TOKEN_FUNCTION:
+        require(getToken(), TOKEN_COLON, ':')
+        routine['result'] = parseTypeSpec()
+    require(getToken(), TOKEN_SEMICOLON, ';')
+    if body:
+        routine['declarations'] = parseDeclarations(True)
+        require(getToken(), TOKEN_BEGIN, 'begin')
+        if gSource is not None:
+            routine['body'] = gSource.skipBody()
+        else:
+            routine['body'] = parseStatements(TOKEN_END)
+        require(getToken(), TOKEN_SEMICOLON, ';')
+    return { token.name: routine }
+
+
+def parseDeclarations(bodies, add=None):
+    # const, type and var sections and routines, in any order; routines in
+    # an interface are headers only.  Each one is passed to add as soon as
+    # it is complete, or collected and returned.
+    declarations = []
+    if add is None:
+        add = declarations.append
+    while True:
+        code = peekToken().id
+        try:
+            if code == TOKEN_CONST:
+                getToken()
+                add(parseConst())
+            elif code == TOKEN_TYPE:
+                getToken()
+                add(parseType())
+            elif code == TOKEN_VAR:
+                getToken()
+                add({ 'var': parseFields() })
+            elif code == TOKEN_PROCEDURE or code == TOKEN_FUNCTION:
+                add(parseRoutine(getToken(), bodies))
+            elif code in REMARKS:
+                add(parseRemark())
+            elif code == TOKEN_ERROR:
+                raise LSPSyntaxError('declaration', peekToken())
+            else:
+                return declarations
+        except LSPSyntaxError as e:
+            add(recover(e, DECLARATION_STOPS))
 
 
-def parseInterface():
-    interface = []
-    token = skipSpace()
-    if token['id'] == TOKEN_USES:
-        interface.append(parseUses())
-    token = skipSpace()
-    if token['id'] == TOKEN_CONST:
-        interface.append(parseConst())
-    return { 'interface': interface }
+# Expressions are parsed by precedence climbing: each binary operator has a
+# precedence, and parseExpression(p) only takes operators of precedence p
+# or higher, so one loop handles every level.
 
+# binary operators, loosest first
+PRECEDENCE = [
+    (TOKEN_EQUALS, TOKEN_NOT_EQUALS, TOKEN_LESS_THAN, TOKEN_GREATER_THAN,
+     TOKEN_LESS_EQUAL, TOKEN_GR_EQUAL, TOKEN_IN),
+    (TOKEN_PLUS, TOKEN_MINUS, TOKEN_OR),
+    (TOKEN_TIMES, TOKEN_SLASH, TOKEN_DIV, TOKEN_MOD, TOKEN_AND),
+]
+BINARY = dict((code, level + 1) for level, codes in enumerate(PRECEDENCE) for code in codes)
 
-def parseUnit(token):
-    print 'parsing unit'
-    unit_name = token['data']
-    token = skipSpace()
-    require(token, TOKEN_SEMICOLON, ';')
-    token = skipSpace()
-    require(token, TOKEN_INTERFACE, 'interface')
-    interface = parseInterface()
-    return { 'unit': { 'name': unit_name, 'body': [ interface ] } }
+UNARY = set([TOKEN_NOT, TOKEN_MINUS, TOKEN_HYPHEN, TOKEN_PLUS, TOKEN_AT])
 
+# argument and index separators
+COMMAS = set([TOKEN_COMMA2, TOKEN_COMMA3, TOKEN_COMMA])
 
-def parseFile():
-    print 'parsing file'
+
+def parseExpression(precedence=1):
+    left = parseFactor()
+    binary = BINARY
+    while True:
+        p = binary.get(peekToken().id)
+        if p is None or p < precedence:
+            return left
+        op = getToken()
+        # operators are left associative, so the right operand only takes
+        # operators that bind tighter
+        left = { 'op': op.name, 'left': left, 'right': parseExpression(p + 1) }
+
+
+def parseRange():
+    # an expression, or low..high where a set or case label allows one
+    low = parseExpression()
+    if peekToken().id != TOKEN_RANGE:
+        return low
+    getToken()
+    return { 'range': [low, parseExpression()] }
+
+
+def parseExpressions(close, parse=parseExpression):
+    expressions = [parse()]
+    while peekToken().id in COMMAS:
+        getToken()
+        expressions.append(parse())
     token = getToken()
-    if token['id'] == TOKEN_UNIT:
-        return parseUnit(token)
+    require(token, close, OPCODES[close].name)
+    return expressions
+
+
+def parseFactor():
+    token = peekToken()
+    code = token.id
+    if code == TOKEN_IDENTIFIER2 or code == TOKEN_IDENTIFIER:
+        return parseDesignator(True)
+    getToken()
+    if code == TOKEN_INTEGER:
+        return token.data
+    elif code == TOKEN_IS:
+        return token.data
+    elif code == TOKEN_NULL:
+        return None
+    elif code == TOKEN_LPAREN2:
+        expression = parseExpression()
+        require(getToken(), TOKEN_RPAREN2, ')')
+        return expression
+    elif code == TOKEN_LBRACKET:
+        if peekToken().id == TOKEN_RBRACKET:
+            getToken()
+            return { 'set': [] }
+        return { 'set': parseExpressions(TOKEN_RBRACKET, parseRange) }
+    elif code in UNARY:
+        # unary operators bind tighter than any binary one
+        return { 'op': token.name, 'operand': parseFactor() }
+    raise LSPSyntaxError('expression', token)
+
+
+def parseDesignator(calls):
+    # a variable with any field, index and pointer selectors, or with calls
+    # set, a function call
+    token = getToken()
+    if calls and peekToken().id == TOKEN_LPAREN2:
+        getToken()
+        return { 'call': { 'name': token.data, 'arguments': parseExpressions(TOKEN_RPAREN2) } }
+    designator = { 'name': token.data }
+    while True:
+        code = peekToken().id
+        if code == TOKEN_DOT:
+            getToken()
+            field = getToken()
+            if field.id != TOKEN_IDENTIFIER2 and field.id != TOKEN_IDENTIFIER:
+                raise LSPSyntaxError('field name', field)
+            designator = { 'field': { 'record': designator, 'name': field.data } }
+        elif code == TOKEN_LBRACKET:
+            getToken()
+            designator = { 'index': { 'array': designator, 'subscripts': parseExpressions(TOKEN_RBRACKET) } }
+        elif code == TOKEN_DEREFERENCE:
+            getToken()
+            designator = { 'deref': designator }
+        else:
+            return designator
+
+
+# comments and conditional compilation lines can turn up between any two
+# statements or declarations
+REMARKS = {
+    TOKEN_COMMENT: 'comment',
+    TOKEN_COND_COMP: 'conditional',
+}
+
+
+def parseRemark():
+    token = getToken()
+    return { REMARKS[token.id]: token.data }
+
+
+def parseRemarks(add):
+    # remarks between the parts of a unit's or program's outline, outside
+    # the declaration and statement loops that take them otherwise
+    while peekToken().id in REMARKS:
+        add(parseRemark())
+
+
+# Panic mode: given an error budget, parseFile notes a syntax error in a
+# statement or declaration as an {"error": message} node, skips to where
+# the next one can start, and carries on, until the budget is spent.
+
+gMaxErrors = None
+gErrorCount = 0
+
+# tokens opening a block that ends with end, which recovery skips whole
+NESTED = set([TOKEN_BEGIN, TOKEN_CASE, TOKEN_RECORD])
+
+# tokens that never turn up inside a block of statements, where recovery
+# always stops: a block that runs into one was never closed
+HARD_STOPS = set([TOKEN_CONST, TOKEN_TYPE, TOKEN_VAR, TOKEN_PROCEDURE, TOKEN_FUNCTION,
+                  TOKEN_IMPLEMENTATION, TOKEN_EOF])
+
+# where the next declaration can start
+DECLARATION_STOPS = HARD_STOPS | set([TOKEN_END])
+
+
+def recover(error, stops):
+    # returns the error node, having skipped to a token in stops outside
+    # any nested block (or in HARD_STOPS anywhere); raises error instead if
+    # recovery is off or the budget is spent
+    global gErrorCount
+    if gMaxErrors is None or gErrorCount >= gMaxErrors:
+        raise error
+    gErrorCount += 1
+    lspTrace.error(error.value)
+    nested = NESTED
+    hard = HARD_STOPS
+    depth = 0
+    while True:
+        code = peekToken().id
+        if code in hard or (depth == 0 and code in stops):
+            return { 'error': error.value }
+        if code in nested:
+            depth += 1
+        elif code == TOKEN_END and depth:
+            depth -= 1
+        getToken()
+
+
+def expect(code, name, add, stops=()):
+    # takes the token code that the outline of a unit or program calls for
+    # next.  If it isn't there, the error node from recover goes to add, and
+    # the token is taken if recovery finds it before a hard stop (or any of
+    # stops) and left otherwise.
+    token = peekToken()
+    if token.id != code:
+        add(recover(LSPSyntaxError(name, token), (code,) + stops))
+        if peekToken().id != code:
+            return
+    getToken()
+
+
+def parseStatements(close, add=None):
+    # statements up to and including the close token; empty statements
+    # (a semicolon right before end) are dropped.  Each one is passed to add
+    # as soon as it is complete, or collected and returned.
+    statements = []
+    if add is None:
+        add = statements.append
+    stops = (TOKEN_SEMICOLON, close)
+    while True:
+        code = peekToken().id
+        if code == close:
+            getToken()
+            return statements
+        elif code == TOKEN_SEMICOLON:
+            getToken()
+        elif code in REMARKS:
+            add(parseRemark())
+        elif code in HARD_STOPS:
+            add(recover(LSPSyntaxError(OPCODES[close].name, peekToken()), stops))
+            return statements
+        else:
+            try:
+                statement = parseStatement()
+            except LSPSyntaxError as e:
+                add(recover(e, stops))
+                continue
+            add(statement)
+            code = peekToken().id
+            if code != TOKEN_SEMICOLON and code != close and code not in REMARKS:
+                add(recover(LSPSyntaxError(';', peekToken()), stops))
+
+
+def parseStatement():
+    token = peekToken()
+    code = token.id
+    if code == TOKEN_IDENTIFIER2 or code == TOKEN_IDENTIFIER:
+        target = parseDesignator(True)
+        if peekToken().id == TOKEN_GETS:
+            if 'call' in target:
+                raise LSPSyntaxError('variable', token)
+            getToken()
+            return { 'assign': { 'target': target, 'value': parseExpression() } }
+        if 'call' in target:
+            return target
+        # a procedure called without arguments
+        return { 'call': { 'name': target['name'], 'arguments': [] } }
+    statement = STATEMENTS.get(code)
+    if statement is None:
+        raise LSPSyntaxError('statement', token)
+    return statement(getToken())
+
+
+# tokens that can follow an empty statement
+EMPTY = set([TOKEN_SEMICOLON, TOKEN_ELSE, TOKEN_END])
+
+
+def parseSubStatement():
+    # the statement governed by if, while, for, with or a case label, with
+    # any comments leading up to it
+    if peekToken().id in EMPTY:
+        return None
+    remarks = []
+    while peekToken().id in REMARKS:
+        remarks.append(parseRemark())
+    if remarks:
+        remarks.append(parseStatement())
+        return { 'begin': remarks }
+    return parseStatement()
+
+
+def parseBegin(token):
+    return { 'begin': parseStatements(TOKEN_END) }
+
+
+def parseIf(token):
+    statement = { 'condition': parseExpression() }
+    if peekToken().id == TOKEN_STATEMENT:
+        getToken()
+    statement['then'] = parseSubStatement()
+    if peekToken().id == TOKEN_ELSE:
+        getToken()
+        statement['else'] = parseSubStatement()
+    return { 'if': statement }
+
+
+def parseWhile(token):
+    condition = parseExpression()
+    require(getToken(), TOKEN_DO, 'do')
+    return { 'while': { 'condition': condition, 'do': parseSubStatement() } }
+
+
+def parseFor(token):
+    statement = { 'variable': token.data, 'from': parseExpression() }
+    direction = getToken()
+    if direction.id == TOKEN_TO:
+        statement['to'] = parseExpression()
+    elif direction.id == TOKEN_DOWN_TO:
+        statement['downto'] = parseExpression()
+    else:
+        raise LSPSyntaxError('to', direction)
+    require(getToken(), TOKEN_DO, 'do')
+    statement['do'] = parseSubStatement()
+    return { 'for': statement }
+
+
+def parseWith(token):
+    records = [parseDesignator(False)]
+    while peekToken().id in COMMAS:
+        getToken()
+        records.append(parseDesignator(False))
+    require(getToken(), TOKEN_DO, 'do')
+    return { 'with': { 'records': records, 'do': parseSubStatement() } }
+
+
+def parseCase(token):
+    statement = { 'selector': parseExpression() }
+    require(getToken(), TOKEN_OF, 'of')
+    cases = []
+    while True:
+        code = peekToken().id
+        if code == TOKEN_END:
+            getToken()
+            break
+        elif code == TOKEN_SEMICOLON:
+            getToken()
+        elif code in REMARKS:
+            parseRemark()
+        elif code in HARD_STOPS:
+            cases.append(recover(LSPSyntaxError('end', peekToken()), ()))
+            break
+        else:
+            try:
+                if code == TOKEN_DEFAULT:
+                    getToken()
+                    statement['default'] = parseSubStatement()
+                    continue
+                labels = [parseRange()]
+                while peekToken().id in COMMAS:
+                    getToken()
+                    labels.append(parseRange())
+                require(getToken(), TOKEN_COLON, ':')
+                cases.append({ 'labels': labels, 'do': parseSubStatement() })
+            except LSPSyntaxError as e:
+                cases.append(recover(e, (TOKEN_SEMICOLON, TOKEN_END)))
+    statement['cases'] = cases
+    return { 'case': statement }
+
+
+# statement keyword -> parser, called with the keyword token
+STATEMENTS = {
+    TOKEN_BEGIN: parseBegin,
+    TOKEN_IF: parseIf,
+    TOKEN_WHILE: parseWhile,
+    TOKEN_WHILE2: parseWhile,
+    TOKEN_FOR: parseFor,
+    TOKEN_WITH: parseWith,
+    TOKEN_CASE: parseCase,
+}
+
+
+def parseInterface(sink, remarks):
+    # remarks are the ones before interface, which go first
+    sink.beginObject()
+    sink.beginArray('interface')
+    for remark in remarks:
+        sink.add(remark)
+    parseRemarks(sink.add)
+    if peekToken().id == TOKEN_USES:
+        getToken()
+        try:
+            sink.add(parseUses())
+        except LSPSyntaxError as e:
+            sink.add(recover(e, DECLARATION_STOPS))
+    parseDeclarations(False, sink.add)
+    sink.end()
+    sink.end()
+
+
+def parseImplementation(sink):
+    sink.beginObject()
+    sink.beginArray('implementation')
+    parseDeclarations(True, sink.add)
+    if peekToken().id == TOKEN_BEGIN:
+        # unit initialization, written a statement at a time
+        getToken()
+        sink.beginObject()
+        sink.beginArray('begin')
+        parseStatements(TOKEN_END, sink.add)
+        sink.end()
+        sink.end()
     else:
+        expect(TOKEN_END, 'end', sink.add)
+    sink.end()
+    sink.end()
+
+
+def parseUnit(token, sink):
+    lspTrace.info('parsing unit')
+    unit_name = token.data
+    # remarks (and errors) before the interface go first in it
+    remarks = []
+    expect(TOKEN_SEMICOLON, ';', remarks.append, (TOKEN_INTERFACE,))
+    parseRemarks(remarks.append)
+    expect(TOKEN_INTERFACE, 'interface', remarks.append, (TOKEN_USES,))
+    sink.beginObject()
+    sink.beginObject('unit')
+    sink.add(unit_name, 'name')
+    sink.beginArray('body')
+    parseInterface(sink, remarks)
+    expect(TOKEN_IMPLEMENTATION, 'implementation', sink.add)
+    parseImplementation(sink)
+    parseRemarks(sink.add)
+    expect(TOKEN_PERIOD, '.', sink.add)
+    sink.end()
+    sink.end()
+    sink.end()
+
+
+def parseProgram(token, sink):
+    lspTrace.info('parsing program')
+    # remarks (and errors) before the uses list go first in the declarations
+    remarks = []
+    expect(TOKEN_SEMICOLON, ';', remarks.append, (TOKEN_USES,))
+    parseRemarks(remarks.append)
+    sink.beginObject()
+    sink.beginObject('program')
+    sink.add(token.data, 'name')
+    if peekToken().id == TOKEN_USES:
+        getToken()
+        try:
+            sink.add(parseUses()['uses'], 'uses')
+        except LSPSyntaxError as e:
+            sink.add(recover(e, DECLARATION_STOPS), 'uses')
+    sink.beginArray('declarations')
+    for remark in remarks:
+        sink.add(remark)
+    parseDeclarations(True, sink.add)
+    sink.end()
+    # the main program, written a statement at a time
+    sink.beginArray('body')
+    expect(TOKEN_BEGIN, 'begin', sink.add)
+    parseStatements(TOKEN_END, sink.add)
+    sink.end()
+    # remarks (and errors) after the final end
+    trailing = []
+    parseRemarks(trailing.append)
+    expect(TOKEN_PERIOD, '.', trailing.append)
+    if trailing:
+        sink.add(trailing, 'trailing')
+    sink.end()
+    sink.end()
+
+
+def parseFile(tuples, sink=None, source=None, maxErrors=None):
+    # tuples is any iterable of (id, name, data) tokens: a token stream
+    # reader, or lspTokenizer.processFile for in-process decoding.  Returns
+    # the tree, or with sink (see lspTreeStream) hands it over a piece at a
+    # time as each top-level declaration is parsed, and returns None.
+    # source is the LazySource the tokens come from, for a lazy parse.
+    # maxErrors turns on panic mode with that error budget.
+    global gTokens, gSource, gMaxErrors, gErrorCount
+    gTokens = TokenBuffer(tokenGenerator(tuples))
+    gSource = source
+    gMaxErrors = maxErrors
+    gErrorCount = 0
+    builder = None
+    if sink is None:
+        sink = builder = TreeBuilder()
+    lspTrace.info('parsing file')
+    token = getToken()
+    try:
+        if token.id == TOKEN_UNIT:
+            parseUnit(token, sink)
+        elif token.id == TOKEN_PROGRAM:
+            parseProgram(token, sink)
+        else:
+            raise LSPSyntaxError('unit', token)
+    finally:
+        # close what is open if an error (past the budget) stopped the parse
+        sink.finish()
+    if builder is not None:
+        return builder.tree
+
+
+def parseHeader(tuples):
+    # (name, uses) of a unit or program, reading no further than its uses
+    # list
+    global gTokens
+    gTokens = TokenBuffer(tokenGenerator(tuples))
+    token = getToken()
+    if token.id != TOKEN_UNIT and token.id != TOKEN_PROGRAM:
         raise LSPSyntaxError('unit', token)
+    require(getToken(), TOKEN_SEMICOLON, ';')
+    while peekToken().id in REMARKS:
+        getToken()
+    if token.id == TOKEN_UNIT:
+        require(getToken(), TOKEN_INTERFACE, 'interface')
+        while peekToken().id in REMARKS:
+            getToken()
+    uses = []
+    if peekToken().id == TOKEN_USES:
+        getToken()
+        uses = parseUses()['uses']
+    return (token.data, uses)
+
+
+def decodeHeader(infilename, unwrap=False):
+    # records are decoded as the parser asks for them, so this only decodes
+    # the first few
+    with open(infilename, 'rb') as infile:
+        return parseHeader(lspTokenizer.processFile(infile, trivia=False, unwrap=unwrap))
+
+
+# Lazy parsing: routine bodies are skipped over by record boundaries (no
+# payload decoding, no statement parsing) and left in the tree as LazyBody
+# spans of the encoded file, each parsed only when it is first used.
+
+# statements that open a block closed by end
+BLOCKS = set([TOKEN_BEGIN, TOKEN_CASE])
+
 
+class LazyBody(dict):
+    # a routine body, written out as {"span": [start, end]}; the statements
+    # property parses it the first time and keeps the result
+    def __init__(self, data, start, end):
+        dict.__init__(self, span=[start, end])
+        self.data = data
+        self.start = start
+        self.end = end
+        self.parsed = None
 
-# main program
-gTokens = tokenGenerator()
-tree = parseFile()
-print '---', 'Parse Tree', '---'
-print json.dumps(tree, indent=2, separators=(',', ': '))
+    @property
+    def statements(self):
+        global gTokens, gSource
+        if self.parsed is None:
+            saved = gTokens, gSource
+            try:
+                records = decodeBuffer(self.data, self.start, self.end)
+                gTokens = TokenBuffer(tokenGenerator(lspTokenizer.processRecords(records, trivia=False)))
+                gSource = None
+                self.parsed = parseStatements(TOKEN_END)
+            finally:
+                gTokens, gSource = saved
+        return self.parsed
 
+
+class LazySource(object):
+    # the records of a mapped encoded file, from which the parser can skip
+    # a routine body
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def records(self):
+        data = self.data
+        end = len(data)
+        opcodes = OPCODES
+        while self.pos < end:
+            b = ord(data[self.pos])
+            pos = self.pos + 1
+            op = opcodes[b]
+            value = None
+            if op is not None:
+                pos += op.skip
+                if op.readerAt is not None:
+                    value, pos = op.readerAt(data, pos)
+            self.pos = pos
+            yield b, value
+
+    def skipBody(self):
+        # called with the body's begin just taken by the parser, so the
+        # token buffer is empty and pos is right after it; returns the
+        # LazyBody up to and including the matching end
+        if gTokens.count:
+            raise RuntimeError('cannot skip a body with tokens buffered')
+        start = self.pos
+        depth = 1
+        blocks = BLOCKS
+        for offset, code in scanBuffer(self.data, start):
+            if code in blocks:
+                depth += 1
+            elif code == TOKEN_END:
+                depth -= 1
+                if depth == 0:
+                    self.pos = offset + 1 + OPCODES[TOKEN_END].skip
+                    return LazyBody(self.data, start, self.pos)
+        raise LSPSyntaxError('end', Token(TOKEN_EOF, None))
+
+
+def decodeAndParse(infilename, stream=False, sink=None, lazy=False, maxErrors=None, unwrap=False):
+    # run the whole chain on an encoded file without any intermediate text;
+    # the parser never looks at spaces and newlines, so they aren't decoded
+    # into tokens at all.  maxErrors is the error budget for both the
+    # decoder's and the parser's recovery.
+    with open(infilename, 'rb') as infile:
+        if stream and not lazy:
+            tuples = lspTokenizer.processFile(infile, stream, trivia=False, maxErrors=maxErrors, unwrap=unwrap)
+            return parseFile(tuples, sink, None, maxErrors)
+        return parseBuffer(loadFile(infile, unwrap), sink, lazy, maxErrors)
+
+
+def parseBuffer(data, sink=None, lazy=False, maxErrors=None):
+    # decodeAndParse for a unit already in memory
+    if lazy:
+        source = LazySource(data)
+        return parseFile(lspTokenizer.processRecords(source.records(), trivia=False), sink, source, maxErrors)
+    if maxErrors is None:
+        records = decodeBuffer(data)
+    else:
+        records = decodeRecovering(data, maxErrors=maxErrors)
+    return parseFile(lspTokenizer.processRecords(records, trivia=False), sink, None, maxErrors)
+
+
+def writeTree(tree, out):
+    out.write(json.dumps(tree, indent=2, separators=(',', ': '), encoding=TEXT_ENCODING) + '\n')
+
+
+def treeWriter(out, ndjson=False):
+    if ndjson:
+        return NdjsonTreeWriter(out)
+    return JsonTreeWriter(out)
+
+
+def convertFile(infilename, outfilename=None, stream=False, ndjson=False, lazy=False, maxErrors=None,
+                unwrap=False):
+    # the tree is written as it is parsed, never held whole
+    out = openOutput(outfilename)
+    try:
+        decodeAndParse(infilename, stream, treeWriter(out, ndjson), lazy, maxErrors, unwrap)
+    finally:
+        out.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse a Lightspeed Pascal token stream into a JSON parse tree.')
+    parser.add_argument('files', nargs='*', metavar='file',
+                        help='token stream from lspTokenizer.py (default: standard input)')
+    parser.add_argument('--binary', action='store_true',
+                        help='read the compact binary token format instead of JSON lines')
+    parser.add_argument('--encoded', action='store_true',
+                        help='read an encoded Pascal source file and tokenize it in-process')
+    parser.add_argument('--ndjson', action='store_true',
+                        help='write one line of JSON per top-level declaration')
+    parser.add_argument('--lazy', action='store_true',
+                        help='with --encoded, skip routine bodies and write their byte spans instead')
+    addRecoveryArguments(parser)
+    addUnwrapArgument(parser)
+    lspTrace.addArguments(parser)
+    args = parser.parse_args()
+    lspTrace.configure(args)
+
+    if args.encoded:
+        if len(args.files) != 1:
+            parser.error('--encoded takes exactly one encoded Pascal source file')
+    elif args.lazy or args.unwrap:
+        parser.error('--lazy and --unwrap need --encoded')
+    try:
+        if args.encoded:
+            convertFile(args.files[0], ndjson=args.ndjson, lazy=args.lazy, maxErrors=errorBudget(args),
+                        unwrap=args.unwrap)
+        else:
+            if args.binary:
+                if args.files:
+                    tuples = readBinaryTokens(open(args.files[0], 'rb'))
+                else:
+                    tuples = readBinaryTokens(sys.stdin)
+            else:
+                tuples = readJsonTokens(fileinput.input(args.files))
+            out = openOutput(None)
+            try:
+                parseFile(tuples, treeWriter(out, args.ndjson), maxErrors=errorBudget(args))
+            finally:
+                out.close()
+    except (DecodeError, LSPSyntaxError) as e:
+        lspTrace.error(e.value)
+        sys.exit(1)
@@ -0,0 +1,536 @@
+#!/usr/bin/python
+# Long-running decode service for the Lightspeed Pascal (LSP) tools.
+#
+# Starting parseLSP.py for every file pays for the interpreter, the imports
+# and the opcode tables each time.  The service pays for them once: an
+# asyncore loop accepts connections on a Unix socket (or a localhost TCP
+# port), and a pool of worker processes does the decoding.
+#
+# A request is one JSON line, then the encoded bytes if it carries any:
+#
+#   {"id": ..., "tool": "text" | "tokens" | "tree", "path": "/abs/file"}
+#   {"id": ..., "tool": ..., "name": "for the text header", "length": n}
+#
+# with optional "trivia" (tokens), "ndjson" (tree), "max_errors" (all
+# tools; recover from damage with that budget) and "unwrap" (all tools;
+# take the data fork out of a MacBinary or AppleSingle file, see
+# lspArchive).  Each response is a JSON
+# line, {"id": ..., "ok": true, "length": n, "cached": bool} followed by
+# the n bytes of output, or {"id": ..., "ok": false, "error": "..."}.
+#
+# Requests may be pipelined: a client can send many before reading any
+# responses, which come back in request order.  A connection stops being
+# read while it has MAX_PIPELINE requests unanswered or MAX_UNSENT bytes of
+# output its client hasn't taken yet, and every connection stops while the
+# pool has JOBS_QUEUED requests per worker, so a fast client slows to the
+# pace of the workers (and a slow one to its own) instead of piling up
+# memory.  Outputs are kept in an in-memory LRU cache keyed by the tool,
+# its options and the input (its content hash, or a path's size and
+# mtime), and a request for an output already being made waits for that
+# one.  Sent bytes are unwrapped like a file, so with "unwrap" a MacBinary
+# or AppleSingle unit can be sent as it is.
+
+import argparse
+import asyncore
+import collections
+import cStringIO
+import errno
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import Queue
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from lspCache import DEFAULT_CACHE_DIR
+from lspDecoder import addRecoveryArguments, decodeBuffer, decodeRecovering, errorBudget, loadFile
+from lspTokenStream import JsonTokenWriter
+import lspArchive
+import lspParser
+import lspTokenizer
+import lspTrace
+import parseLSP
+
+DEFAULT_SOCKET = os.path.join(DEFAULT_CACHE_DIR, 'decode.sock')
+
+# requests read ahead and unanswered per connection
+MAX_PIPELINE = 64
+
+# requests queued for the pool per worker before no connection is read
+JOBS_QUEUED = 4
+
+DEFAULT_RESULT_CACHE = 256 * 1024 * 1024
+
+BLOCK_SIZE = 256 * 1024
+
+# unsent output per connection before its requests stop being read
+MAX_UNSENT = 16 * 1024 * 1024
+
+MAX_HEADER = 64 * 1024
+
+LISTEN_BACKLOG = 64
+
+
+# The workers: each tool renders mapped or received bytes to a string.
+
+def records(data, options):
+    maxErrors = options.get('max_errors')
+    if maxErrors is None:
+        return decodeBuffer(data)
+    return decodeRecovering(data, maxErrors=maxErrors)
+
+
+def renderText(data, name, out, options):
+    out.write('{ Pascal source code from %s }\n' % name)
+    parseLSP.renderRecords(records(data, options), out)
+
+
+def renderTokens(data, name, out, options):
+    writer = JsonTokenWriter(out)
+    for code, tokenName, value in lspTokenizer.processRecords(records(data, options), options.get('trivia', True)):
+        writer.write(code, tokenName, value)
+
+
+def renderTree(data, name, out, options):
+    lspParser.parseBuffer(data, lspParser.treeWriter(out, options.get('ndjson', False)), False,
+                          options.get('max_errors'))
+
+
+# tool name -> (output suffix, renderer)
+TOOLS = {
+    'text': ('.p', renderText),
+    'tokens': ('.tokens', renderTokens),
+    'tree': ('.json', renderTree),
+}
+
+OPTIONS = ('trivia', 'ndjson', 'max_errors', 'unwrap')
+
+
+def initWorker(level):
+    lspTrace.setLevel(level)
+
+
+def render(job):
+    # runs in a worker; returns (True, output) or (False, error), never
+    # raises
+    tool, path, data, name, options = job
+    unwrap = options.get('unwrap', False)
+    try:
+        if data is None:
+            with open(path, 'rb') as infile:
+                data = loadFile(infile, unwrap)
+        elif unwrap:
+            data = lspArchive.unwrap(data)
+        out = cStringIO.StringIO()
+        TOOLS[tool][1](data, name, out, options)
+        return (True, out.getvalue())
+    except Exception:
+        return (False, traceback.format_exc().strip().splitlines()[-1])
+
+
+# The front end.
+
+class ResultCache(object):
+    # least recently used outputs, up to maxSize bytes in all
+    def __init__(self, maxSize=DEFAULT_RESULT_CACHE):
+        self.maxSize = maxSize
+        self.size = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        output = self.entries.pop(key, None)
+        if output is not None:
+            self.entries[key] = output
+        return output
+
+    def put(self, key, output):
+        if len(output) > self.maxSize or key in self.entries:
+            return
+        self.entries[key] = output
+        self.size += len(output)
+        while self.size > self.maxSize:
+            key, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class Request(object):
+    def __init__(self, header, body):
+        self.id = header.get('id')
+        self.response = None
+        self.key = None
+        self.job = None
+        tool = header.get('tool')
+        if tool not in TOOLS:
+            self.fail('unknown tool %r' % (tool,))
+            return
+        options = dict((option, header[option]) for option in OPTIONS if header.get(option) is not None)
+        path = header.get('path')
+        if 'length' in header:
+            name = header.get('name') or '<data>'
+            self.key = (tool, tuple(sorted(options.items())), 'data', name, hashlib.sha1(body).hexdigest())
+            self.job = (tool, None, body, name, options)
+        elif path is not None:
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                self.fail(e.strerror)
+                return
+            self.key = (tool, tuple(sorted(options.items())), 'path', path, st.st_size, st.st_mtime)
+            self.job = (tool, path, None, path, options)
+        else:
+            self.fail('no path and no data')
+
+    def fail(self, error):
+        self.response = (json.dumps({ 'id': self.id, 'ok': False, 'error': error }) + '\n',)
+
+    def finish(self, ok, output, cached=False):
+        if not ok:
+            self.fail(output)
+            return
+        header = { 'id': self.id, 'ok': True, 'length': len(output), 'cached': cached }
+        self.response = (json.dumps(header) + '\n', output)
+
+
+class Connection(asyncore.dispatcher):
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock)
+        self.server = server
+        # the request being received: its header line so far, then its
+        # header and the pieces of its body
+        self.line = ''
+        self.header = None
+        self.body = []
+        self.needed = 0
+        # requests in the order they came, answered or not
+        self.pending = collections.deque()
+        # responses ready to send, as strings, the first partly sent
+        self.unsent = collections.deque()
+        self.unsentSize = 0
+        self.sent = 0
+
+    def readable(self):
+        # backpressure: leave requests in the socket (and the client's send
+        # blocked) while this connection or the pool is full, or the client
+        # is slow to read what it asked for
+        return (len(self.pending) < MAX_PIPELINE and self.unsentSize < MAX_UNSENT and
+                self.server.hasRoom())
+
+    def writable(self):
+        return bool(self.unsent)
+
+    def handle_read(self):
+        data = self.recv(BLOCK_SIZE)
+        position = 0
+        while position < len(data):
+            if self.header is None:
+                end = data.find('\n', position)
+                if end < 0:
+                    self.line += data[position:]
+                    if len(self.line) > MAX_HEADER:
+                        self.reject('request header too long')
+                    return
+                if not self.startRequest(self.line + data[position:end]):
+                    return
+                self.line = ''
+                position = end + 1
+            else:
+                take = min(self.needed, len(data) - position)
+                self.body.append(data[position:position + take])
+                self.needed -= take
+                position += take
+            if self.header is not None and self.needed == 0:
+                self.endRequest()
+
+    def startRequest(self, line):
+        try:
+            header = json.loads(line)
+            if not isinstance(header, dict):
+                raise ValueError('not an object')
+            length = header.get('length', 0)
+            if not isinstance(length, (int, long)) or length < 0:
+                raise ValueError('bad length %r' % (length,))
+        except ValueError as e:
+            self.reject('bad request header: %s' % e)
+            return False
+        self.header = header
+        self.needed = length
+        return True
+
+    def endRequest(self):
+        request = Request(self.header, ''.join(self.body))
+        self.header = None
+        self.body = []
+        self.pending.append(request)
+        self.server.submit(self, request)
+
+    def reject(self, error):
+        # the stream can't be followed any further
+        lspTrace.error(error)
+        self.handle_close()
+
+    def complete(self):
+        # queue the responses that are ready, stopping at the first request
+        # still being decoded
+        while self.pending and self.pending[0].response is not None:
+            for part in self.pending.popleft().response:
+                if part:
+                    self.unsent.append(part)
+                    self.unsentSize += len(part)
+
+    def handle_write(self):
+        part = self.unsent[0]
+        sent = self.send(buffer(part, self.sent, BLOCK_SIZE))
+        self.sent += sent
+        self.unsentSize -= sent
+        if self.sent == len(part):
+            self.unsent.popleft()
+            self.sent = 0
+
+    def handle_close(self):
+        self.pending.clear()
+        self.unsent.clear()
+        self.unsentSize = 0
+        self.close()
+
+    def handle_error(self):
+        lspTrace.error('connection: %s' % traceback.format_exc().strip().splitlines()[-1])
+        self.handle_close()
+
+
+class Waker(asyncore.file_dispatcher):
+    # a pipe the pool's result thread writes to, to wake the loop
+    def __init__(self, callback):
+        r, self.w = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r)
+        os.close(r)
+        self.callback = callback
+
+    def wake(self):
+        os.write(self.w, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.callback()
+
+
+class DecodeServer(asyncore.dispatcher):
+    def __init__(self, address, jobs=None, cacheSize=DEFAULT_RESULT_CACHE):
+        # address is a Unix socket path or a (host, port) pair
+        jobs = jobs or multiprocessing.cpu_count()
+        # the workers are forked before any socket exists
+        self.pool = multiprocessing.Pool(jobs, initWorker, (lspTrace.level,))
+        self.maxRunning = jobs * JOBS_QUEUED
+        self.cache = ResultCache(cacheSize)
+        # key -> [(connection, request)] waiting for that output
+        self.running = {}
+        self.finished = Queue.Queue()
+        self.waker = Waker(self.collect)
+        self.requests = 0
+        self.hits = 0
+        asyncore.dispatcher.__init__(self)
+        if isinstance(address, tuple):
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        else:
+            directory = os.path.dirname(address)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            if os.path.exists(address):
+                os.remove(address)
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(LISTEN_BACKLOG)
+        self.address = address
+
+    def hasRoom(self):
+        return len(self.running) < self.maxRunning
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Connection(pair[0], self)
+
+    def submit(self, connection, request):
+        self.requests += 1
+        if request.response is None:
+            output = self.cache.get(request.key)
+            if output is not None:
+                self.hits += 1
+                request.finish(True, output, cached=True)
+            elif request.key in self.running:
+                self.running[request.key].append((connection, request))
+                return
+            else:
+                self.running[request.key] = [(connection, request)]
+                self.pool.apply_async(render, (request.job,), callback=functools.partial(self.done, request.key))
+                return
+        connection.complete()
+
+    def done(self, key, result):
+        # called in the pool's result thread
+        self.finished.put((key, result))
+        self.waker.wake()
+
+    def collect(self):
+        while True:
+            try:
+                key, (ok, output) = self.finished.get_nowait()
+            except Queue.Empty:
+                return
+            if ok:
+                self.cache.put(key, output)
+            else:
+                lspTrace.error('%s: %s' % (key[3], output))
+            for connection, request in self.running.pop(key):
+                request.finish(ok, output)
+                connection.complete()
+
+    def shutdown(self):
+        self.close()
+        self.pool.terminate()
+        self.pool.join()
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.remove(self.address)
+        lspTrace.info('%d requests, %d from the cache' % (self.requests, self.hits))
+
+
+def serve(address, jobs=None, cacheSize=DEFAULT_RESULT_CACHE):
+    server = DecodeServer(address, jobs, cacheSize)
+    lspTrace.info('serving on %s' % (address,))
+    # stop as cleanly when killed as when interrupted
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncore.loop(timeout=1.0, use_poll=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+class DecodeClient(object):
+    def __init__(self, address):
+        if isinstance(address, tuple):
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.infile = self.sock.makefile('rb', BLOCK_SIZE)
+
+    def close(self):
+        self.infile.close()
+        self.sock.close()
+
+    def send(self, header, data=None):
+        if data is not None:
+            header = dict(header, length=len(data))
+        self.sock.sendall(json.dumps(header) + '\n' + (data or ''))
+
+    def receive(self):
+        # (header, output or None)
+        line = self.infile.readline()
+        if not line:
+            raise IOError(errno.ECONNRESET, 'connection closed by the server')
+        header = json.loads(line)
+        if not header.get('ok'):
+            return header, None
+        return header, self.infile.read(header['length'])
+
+    def decode(self, requests):
+        # requests is a list of (header, data or None); yields the (header,
+        # output) responses in the same order.  A thread sends while this
+        # one reads, so neither side waits on the other.
+        def sendAll():
+            try:
+                for header, data in requests:
+                    self.send(header, data)
+            except socket.error as e:
+                lspTrace.error('sending requests: %s' % e)
+        sender = threading.Thread(target=sendAll)
+        sender.daemon = True
+        sender.start()
+        for i in xrange(len(requests)):
+            yield self.receive()
+        sender.join()
+
+
+def serverAddress(args):
+    if args.port is not None:
+        return ('127.0.0.1', args.port)
+    return args.socket
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode encoded Lightspeed Pascal source files in a long-running service.')
+    lspTrace.addArguments(parser)
+    commands = parser.add_subparsers(dest='command')
+    server = commands.add_parser('serve', help='run the service until interrupted')
+    client = commands.add_parser('decode', help='have the service decode files')
+    for command in (server, client):
+        command.add_argument('--socket', default=DEFAULT_SOCKET, metavar='path',
+                             help='Unix socket to listen on or connect to (default: %(default)s)')
+        command.add_argument('--port', type=int, metavar='n', help='use localhost TCP port n instead')
+    server.add_argument('-j', '--jobs', type=int, metavar='n',
+                        help='number of worker processes (default: one per CPU)')
+    server.add_argument('--cache-size', type=int, default=DEFAULT_RESULT_CACHE / (1024 * 1024), metavar='MB',
+                        help='keep up to this much output in memory (default: %(default)d)')
+    client.add_argument('files', nargs='+', metavar='file', help='encoded Pascal source file')
+    client.add_argument('-t', '--tool', choices=sorted(TOOLS), default='text',
+                        help='what to make of each file (default: %(default)s)')
+    client.add_argument('-O', '--default-output', action='store_true',
+                        help="write each file's output to the file name plus the tool's suffix "
+                        'instead of standard output')
+    client.add_argument('--send-data', action='store_true',
+                        help='send the encoded bytes instead of the path, for a service that cannot read them')
+    client.add_argument('--no-trivia', dest='trivia', action='store_false',
+                        help='leave out SPACE and NEWLINE tokens')
+    client.add_argument('--ndjson', action='store_true', help='write the tree as NDJSON')
+    addRecoveryArguments(client)
+    lspArchive.addUnwrapArgument(client)
+    args = parser.parse_args()
+    lspTrace.configure(args)
+
+    address = serverAddress(args)
+    if args.command == 'serve':
+        serve(address, args.jobs, args.cache_size * 1024 * 1024)
+        sys.exit(0)
+
+    requests = []
+    for n, infilename in enumerate(args.files):
+        header = { 'id': n, 'tool': args.tool, 'trivia': args.trivia, 'ndjson': args.ndjson,
+                   'max_errors': errorBudget(args), 'unwrap': args.unwrap }
+        data = None
+        if args.send_data:
+            with open(infilename, 'rb') as infile:
+                data = infile.read()
+            header['name'] = infilename
+        else:
+            header['path'] = os.path.abspath(infilename)
+        requests.append((header, data))
+    try:
+        connection = DecodeClient(address)
+    except socket.error as e:
+        lspTrace.error('cannot connect to %s: %s' % (address, e))
+        sys.exit(2)
+    failures = 0
+    start = time.time()
+    for (header, output), infilename in itertools.izip(connection.decode(requests), args.files):
+        if output is None:
+            lspTrace.error('%s: %s' % (infilename, header.get('error')))
+            failures += 1
+        elif args.default_output:
+            with open(infilename + TOOLS[args.tool][0], 'wb') as outfile:
+                outfile.write(output)
+        else:
+            sys.stdout.write(output)
+    connection.close()
+    lspTrace.info('%d files, %d failed, %.3fs' % (len(args.files), failures, time.time() - start))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# Decode an encoded Lightspeed Pascal (LSP) unit once into several outputs.
+#
+# parseLSP.py, lspTokenizer.py, --stats and lspSymbols.py each walk the
+# records of a file for themselves, so asking for all of them decodes the
+# file once per output.  Here the records are decoded once, and each is
+# handed with its offset to any number of sinks:
+#
+#   parseLSP.TextSink        readable Pascal text
+#   lspTokenizer.TokenSink   JSON lines or binary token stream
+#   lspColumns.ColumnSink    columnar token store
+#   lspStats.StatsSink       per-opcode counts and sizes
+#   lspSymbols.SymbolSink    symbols for the cross-unit symbol index
+#
+# A sink has record(offset, code, value), called for every record in file
+# order, and close(), called when the file is done; lspDecoder.decodeInto
+# drives them.
+
+import argparse
+import sys
+from lspArchive import addUnwrapArgument
+from lspDecoder import DecodeError, addRecoveryArguments, decodeInto, errorBudget, loadFile
+from lspOutput import openOutput
+from lspStats import DecodeStats, StatsSink, addStatsArgument
+from lspTokenStream import BinaryTokenWriter, JsonTokenWriter
+from lspTokenizer import TokenSink
+from lspSymbols import DEFAULT_DATABASE, SymbolIndex, SymbolSink
+from parseLSP import TextSink
+import lspColumns
+import lspTrace
+
+# output name -> usual suffix
+OUTPUTS = {
+    'text': '.p',
+    'tokens': '.tokens',
+    'binary-tokens': '.btokens',
+    'columns': '.lspc',
+}
+
+# the outputs written from one shared TokenSink
+TOKEN_WRITERS = {
+    'tokens': JsonTokenWriter,
+    'binary-tokens': BinaryTokenWriter,
+}
+
+
+def convertFile(infilename, outputs, trivia=True, stats=None, sinks=(), maxErrors=None, unwrap=False):
+    # outputs maps output names (see OUTPUTS) to file names, None meaning
+    # standard output; stats is a DecodeStats to record into, and sinks are
+    # any others to feed
+    with open(infilename, 'rb') as infile:
+        data = loadFile(infile, unwrap)
+    convertData(infilename, data, outputs, trivia, stats, sinks, maxErrors)
+
+
+def convertData(infilename, data, outputs, trivia=True, stats=None, sinks=(), maxErrors=None):
+    # convertFile for a unit already in memory (an archive member, say),
+    # which the outputs say came from infilename
+    targets = []
+    writers = []
+    for name, outfilename in sorted(outputs.items()):
+        out = openOutput(outfilename)
+        if name in TOKEN_WRITERS:
+            writers.append(TOKEN_WRITERS[name](out))
+        elif name == 'columns':
+            targets.append(lspColumns.ColumnSink(lspColumns.ColumnWriter(), infilename, len(data), trivia, out))
+        else:
+            targets.append(TextSink(out, infilename))
+    if writers:
+        targets.append(TokenSink(writers, trivia))
+    if stats is not None:
+        targets.append(StatsSink(stats, len(data), infilename))
+    decodeInto(data, targets + list(sinks), maxErrors=maxErrors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode an encoded Lightspeed Pascal source file once '
+                                     'into any of its text, tokens, stats and symbols.')
+    parser.add_argument('infilename', metavar='file', help='encoded Pascal source file')
+    for name, suffix in sorted(OUTPUTS.items()):
+        parser.add_argument('--' + name, metavar='outfile',
+                            help='write %s output (usually FILE%s) to outfile ("-" for standard output)'
+                            % (name, suffix))
+    parser.add_argument('--no-trivia', dest='trivia', action='store_false',
+                        help='leave out SPACE and NEWLINE tokens')
+    parser.add_argument('--symbols', nargs='?', const=DEFAULT_DATABASE, metavar='database',
+                        help='add the symbols to a symbol database (default: %s)' % DEFAULT_DATABASE)
+    addRecoveryArguments(parser)
+    addStatsArgument(parser)
+    addUnwrapArgument(parser)
+    lspTrace.addArguments(parser)
+    args = parser.parse_args()
+    lspTrace.configure(args)
+
+    infilename = args.infilename
+    outputs = {}
+    for name in OUTPUTS:
+        outfilename = getattr(args, name.replace('-', '_'))
+        if outfilename is not None:
+            outputs[name] = None if outfilename == '-' else outfilename
+    if outputs.values().count(None) > 1:
+        parser.error('only one output can go to standard output')
+    stats = DecodeStats() if args.stats else None
+    symbols = SymbolSink() if args.symbols else None
+    try:
+        convertFile(infilename, outputs, args.trivia, stats, [symbols] if symbols else (), errorBudget(args),
+                    args.unwrap)
+    except DecodeError as e:
+        lspTrace.error('%s: %s' % (infilename, e.value))
+        sys.exit(1)
+    if symbols:
+        index = SymbolIndex(args.symbols)
+        with index.db:
+            index.addSymbols(infilename, symbols.symbols)
+        index.close()
+    if stats:
+        stats.write(args.stats)
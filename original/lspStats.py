@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# Per-opcode statistics for the Lightspeed Pascal (LSP) decoders.
+#
+# DecodeStats.decode yields the same records as lspDecoder.decodeBuffer (or
+# with maxErrors, lspDecoder.decodeRecovering), but also counts each opcode
+# and the bytes its records take, times every payload reader, and notes
+# where unknown bytes and damaged spans turn up.  It is a separate loop, so decoding without
+# --stats runs the plain decoder untouched.
+
+import json
+import struct
+import sys
+import time
+from tokens import TOKEN_ERROR
+from lspDecoder import OPCODES, DecodeError, resync
+
+# offsets kept per unknown byte value, and of damaged spans; the counts are
+# always exact
+MAX_OFFSETS = 100
+
+
+class DecodeStats(object):
+    def __init__(self):
+        self.counts = [0] * 256
+        self.recordBytes = [0] * 256
+        self.payloadBytes = [0] * 256
+        self.readerCalls = {}
+        self.readerSeconds = {}
+        self.unknownOffsets = {}
+        self.damagedSpans = 0
+        self.damagedBytes = 0
+        self.damagedOffsets = []
+        self.files = []
+        self.seconds = 0.0
+
+    def decode(self, data, start=0, end=None, name=None, maxErrors=None):
+        if end is None:
+            end = len(data)
+        self.files.append({ 'file': name, 'bytes': end - start })
+        counts = self.counts
+        recordBytes = self.recordBytes
+        payloadBytes = self.payloadBytes
+        readerCalls = self.readerCalls
+        readerSeconds = self.readerSeconds
+        clock = time.time
+        opcodes = OPCODES
+        errors = 0
+        began = clock()
+        pos = start
+        while pos < end:
+            offset = pos
+            b = ord(data[pos])
+            pos += 1
+            op = opcodes[b]
+            if op is None:
+                if maxErrors is None:
+                    counts[b] += 1
+                    self.noteUnknown(b, offset)
+                    recordBytes[b] += 1
+                    yield b, None
+                    continue
+            else:
+                pos += op.skip
+                if op.readerAt is None:
+                    value = None
+                else:
+                    payload = pos
+                    before = clock()
+                    try:
+                        value, pos = op.readerAt(data, pos)
+                    except (IndexError, struct.error):
+                        if maxErrors is None:
+                            raise
+                        # a payload that runs off the end
+                        op = None
+                    if op is not None:
+                        reader = op.reader.__name__
+                        readerSeconds[reader] = readerSeconds.get(reader, 0.0) + clock() - before
+                        readerCalls[reader] = readerCalls.get(reader, 0) + 1
+                        payloadBytes[b] += pos - payload
+                if op is not None and (maxErrors is None or pos <= end):
+                    counts[b] += 1
+                    recordBytes[b] += pos - offset
+                    yield b, value
+                    continue
+            # a damaged span, skipped as in lspDecoder.decodeRecovering
+            errors += 1
+            if errors > maxErrors:
+                raise DecodeError('more than %d damaged spans, the last at offset %d' % (maxErrors, offset))
+            pos = resync(data, offset, end)
+            self.noteDamaged(offset, pos)
+            yield TOKEN_ERROR, (offset, pos)
+        # includes the time spent by whoever consumes the records
+        self.seconds += clock() - began
+
+    def noteUnknown(self, b, offset):
+        offsets = self.unknownOffsets.setdefault(b, [])
+        if len(offsets) < MAX_OFFSETS:
+            offsets.append(offset)
+
+    def noteDamaged(self, start, end):
+        self.damagedSpans += 1
+        self.damagedBytes += end - start
+        if len(self.damagedOffsets) < MAX_OFFSETS:
+            self.damagedOffsets.append(start)
+
+    def summary(self):
+        opcodes = {}
+        for code in xrange(256):
+            if self.counts[code] and OPCODES[code] is not None:
+                opcodes['%02X %s' % (code, OPCODES[code].name)] = {
+                    'count': self.counts[code],
+                    'bytes': self.recordBytes[code],
+                    'payload_bytes': self.payloadBytes[code],
+                }
+        readers = {}
+        for reader, calls in self.readerCalls.items():
+            readers[reader] = { 'calls': calls, 'seconds': self.readerSeconds[reader] }
+        unknown = {}
+        for code, offsets in self.unknownOffsets.items():
+            unknown['%02X' % code] = { 'count': self.counts[code], 'offsets': offsets }
+        return {
+            'files': self.files,
+            'records': sum(self.counts) + self.damagedSpans,
+            'seconds': self.seconds,
+            'opcodes': opcodes,
+            'readers': readers,
+            'unknown': unknown,
+            'damaged': { 'count': self.damagedSpans, 'bytes': self.damagedBytes, 'offsets': self.damagedOffsets },
+        }
+
+    def write(self, outfilename):
+        # '-' means standard error, keeping standard output for the tool
+        if outfilename == '-':
+            json.dump(self.summary(), sys.stderr, indent=2, sort_keys=True)
+            sys.stderr.write('\n')
+        else:
+            with open(outfilename, 'w') as f:
+                json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+class StatsSink(object):
+    # records into a DecodeStats from records decoded once for several
+    # outputs (see lspSinks).  A record's size is the distance to the next
+    # one; a damaged span's size is in its value.  Reader timings need the instrumented loop in DecodeStats.decode,
+    # so they are left out.
+    def __init__(self, stats, end, name=None, start=0):
+        stats.files.append({ 'file': name, 'bytes': end - start })
+        self.stats = stats
+        self.end = end
+        self.last = None
+        self.began = time.time()
+
+    def count(self, offset, code, end):
+        stats = self.stats
+        stats.counts[code] += 1
+        stats.recordBytes[code] += end - offset
+        op = OPCODES[code]
+        if op is None:
+            stats.noteUnknown(code, offset)
+        elif op.reader is not None:
+            stats.payloadBytes[code] += end - offset - 1 - op.skip
+
+    def record(self, offset, code, value):
+        if self.last is not None:
+            self.count(self.last[0], self.last[1], offset)
+        if code == TOKEN_ERROR and value is not None:
+            self.stats.noteDamaged(*value)
+            self.last = None
+        else:
+            self.last = (offset, code)
+
+    def close(self):
+        if self.last is not None:
+            self.count(self.last[0], self.last[1], self.end)
+        self.stats.seconds += time.time() - self.began
+
+
+def addStatsArgument(parser):
+    parser.add_argument('--stats', metavar='file',
+                        help='write per-opcode counts, sizes and reader timings to file as JSON '
+                        '("-" for standard error)')
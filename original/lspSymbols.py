@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# Cross-unit symbol index for archives of encoded Lightspeed Pascal (LSP)
+# units, kept in an SQLite database.
+#
+# Indexing is one pass over each file that only reads the payloads of the
+# records it keeps: unit and program names, routine names, constant
+# definitions, identifier uses and the units named in uses lists, each with
+# its byte offset.  Files whose size, mtime and opcode table version haven't
+# changed since they were indexed are skipped.  Queries (definitions,
+# references, which units use a unit) then come straight from the database.
+
+import argparse
+import os
+import sqlite3
+import sys
+from tokens import *
+from lspArchive import addUnwrapArgument
+from lspInputs import findInputs
+from lspDecoder import OPCODES, loadFile, readStringAt, scanBuffer
+from lspIndex import indexStamp
+import lspTrace
+
+DEFAULT_DATABASE = 'lsp-symbols.db'
+
+# opcode -> kind of symbol its name is
+KINDS = {
+    TOKEN_UNIT: 'unit',
+    TOKEN_PROGRAM: 'program',
+    TOKEN_PROCEDURE: 'procedure',
+    TOKEN_FUNCTION: 'function',
+    TOKEN_CONST_DEF: 'const',
+    TOKEN_IDENTIFIER: 'reference',
+    TOKEN_IDENTIFIER2: 'reference',
+    TOKEN_FOR: 'reference',
+}
+
+DEFINITIONS = ('unit', 'program', 'procedure', 'function', 'const')
+
+SCHEMA = '''
+create table if not exists files (
+    id integer primary key,
+    path text unique not null,
+    unit text,
+    size integer,
+    mtime real,
+    version text
+);
+create table if not exists symbols (
+    file integer not null references files(id),
+    name text not null,
+    spelling text not null,
+    kind text not null,
+    offset integer not null
+);
+create index if not exists symbols_name on symbols (name, kind);
+create index if not exists symbols_file on symbols (file);
+'''
+
+
+class SymbolSink(object):
+    # collects (name, kind, offset) symbols from decoded records, which can
+    # be shared with other outputs (see lspSinks); the identifiers between
+    # uses and the next semicolon are the units being used
+    def __init__(self):
+        self.symbols = []
+        self.inUses = False
+
+    def record(self, offset, code, value):
+        if code == TOKEN_USES:
+            self.inUses = True
+            return
+        if code == TOKEN_SEMICOLON:
+            self.inUses = False
+            return
+        kind = KINDS.get(code)
+        if kind is None:
+            return
+        if self.inUses and code == TOKEN_IDENTIFIER:
+            kind = 'uses'
+        self.symbols.append((value.decode('mac_roman'), kind, offset))
+
+    def close(self):
+        pass
+
+
+def scanSymbols(data):
+    # the symbols of SymbolSink, reading only the payloads of the records
+    # it keeps
+    sink = SymbolSink()
+    record = sink.record
+    kinds = KINDS
+    opcodes = OPCODES
+    for offset, code in scanBuffer(data):
+        value = None
+        if code in kinds:
+            value = readStringAt(data, offset + 1 + opcodes[code].skip)[0]
+        record(offset, code, value)
+    return sink.symbols
+
+
+class SymbolIndex(object):
+    def __init__(self, filename=DEFAULT_DATABASE):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def isCurrent(self, infilename):
+        stamp = indexStamp(infilename)
+        row = self.db.execute('select size, mtime, version from files where path = ?',
+                              (infilename,)).fetchone()
+        return row is not None and tuple(row) == (stamp['size'], stamp['mtime'], stamp['version'])
+
+    def forget(self, infilename):
+        db = self.db
+        db.execute('delete from symbols where file in (select id from files where path = ?)', (infilename,))
+        db.execute('delete from files where path = ?', (infilename,))
+
+    def addFile(self, infilename, unwrap=False):
+        # replaces whatever was indexed for infilename before; returns the
+        # number of symbols found
+        with open(infilename, 'rb') as infile:
+            data = loadFile(infile, unwrap)
+        return self.addSymbols(infilename, scanSymbols(data))
+
+    def addSymbols(self, infilename, symbols):
+        # the same, for symbols already found (by a SymbolSink, say)
+        stamp = indexStamp(infilename)
+        unit = None
+        for name, kind, offset in symbols:
+            if kind in ('unit', 'program'):
+                unit = name
+                break
+        self.forget(infilename)
+        fileId = self.db.execute('insert into files (path, unit, size, mtime, version) values (?, ?, ?, ?, ?)',
+                                 (infilename, unit, stamp['size'], stamp['mtime'], stamp['version'])).lastrowid
+        self.db.executemany('insert into symbols (file, name, spelling, kind, offset) values (?, ?, ?, ?, ?)',
+                            ((fileId, name.lower(), name, kind, offset) for name, kind, offset in symbols))
+        return len(symbols)
+
+    def update(self, paths, match='*', rebuild=False, unwrap=False):
+        # indexes new and changed files in one transaction; returns
+        # (files indexed, files failed)
+        indexed = failed = 0
+        with self.db:
+            for infilename, relpath in findInputs(paths, match):
+                if not rebuild and self.isCurrent(infilename):
+                    continue
+                try:
+                    n = self.addFile(infilename, unwrap)
+                except Exception as e:
+                    lspTrace.error('%s: %s' % (infilename, e))
+                    failed += 1
+                    continue
+                lspTrace.info('%s: %d symbols' % (infilename, n))
+                indexed += 1
+        return indexed, failed
+
+    def prune(self):
+        # drops files that no longer exist; returns how many
+        gone = [path for (path,) in self.db.execute('select path from files') if not os.path.exists(path)]
+        with self.db:
+            for path in gone:
+                self.forget(path)
+        return len(gone)
+
+    def lookup(self, name, kinds):
+        # (path, offset, kind, spelling) of every symbol called name
+        marks = ', '.join('?' * len(kinds))
+        return self.db.execute('select files.path, symbols.offset, symbols.kind, symbols.spelling '
+                               'from symbols join files on files.id = symbols.file '
+                               'where symbols.name = ? and symbols.kind in (%s) '
+                               'order by files.path, symbols.offset' % marks,
+                               (name.lower(),) + tuple(kinds)).fetchall()
+
+    def definitions(self, name):
+        return self.lookup(name, DEFINITIONS)
+
+    def references(self, name):
+        return self.lookup(name, ('reference', 'uses'))
+
+    def users(self, unit):
+        # (path, unit) of every file whose uses list names unit
+        return self.db.execute('select distinct files.path, files.unit '
+                               'from symbols join files on files.id = symbols.file '
+                               'where symbols.name = ? and symbols.kind = ? '
+                               'order by files.path',
+                               (unit.lower(), 'uses')).fetchall()
+
+
+def printSymbols(rows):
+    for path, offset, kind, spelling in rows:
+        print '%s\t%d\t%s\t%s' % (path, offset, kind, spelling.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index and query the symbols of encoded Lightspeed Pascal units.')
+    parser.add_argument('-D', '--database', default=DEFAULT_DATABASE, metavar='file',
+                        help='symbol database (default: %(default)s)')
+    lspTrace.addArguments(parser)
+    commands = parser.add_subparsers(dest='command')
+    index = commands.add_parser('index', help='add new and changed files to the database')
+    index.add_argument('paths', nargs='+', metavar='path',
+                       help='encoded Pascal source file, directory or glob pattern')
+    index.add_argument('--match', default='*', metavar='pattern',
+                       help='only index files whose names match pattern (default: all)')
+    index.add_argument('--rebuild', action='store_true', help='re-index files even if unchanged')
+    index.add_argument('--prune', action='store_true', help='drop files that no longer exist')
+    addUnwrapArgument(index)
+    defs = commands.add_parser('defs', help='where a unit, routine or constant is defined')
+    defs.add_argument('name')
+    refs = commands.add_parser('refs', help='where an identifier is used')
+    refs.add_argument('name')
+    users = commands.add_parser('users', help='which units use a unit')
+    users.add_argument('name')
+    args = parser.parse_args()
+    lspTrace.configure(args)
+
+    symbols = SymbolIndex(args.database)
+    status = 0
+    if args.command == 'index':
+        indexed, failed = symbols.update(args.paths, args.match, args.rebuild, args.unwrap)
+        if args.prune:
+            lspTrace.info('pruned %d files' % symbols.prune())
+        lspTrace.info('indexed %d files, %d failed' % (indexed, failed))
+        status = 1 if failed else 0
+    elif args.command == 'defs':
+        printSymbols(symbols.definitions(args.name))
+    elif args.command == 'refs':
+        printSymbols(symbols.references(args.name))
+    elif args.command == 'users':
+        for path, unit in symbols.users(args.name):
+            print '%s\t%s' % (path, (unit or '').encode('utf-8'))
+    symbols.close()
+    sys.exit(status)
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# Token stream formats passed from lspTokenizer.py to lspParser.py.
+#
+# The default format is one JSON list [id, name, value] per line, which is
+# easy to read and grep.  The binary format is much smaller and cheaper to
+# read back:
+#
+#   'LSPT' version-byte, then per token:
+#   opcode byte, value
+#
+# where a value is a tag byte followed by its data:
+#
+#   VALUE_NONE                   no data
+#   VALUE_BYTE                   one unsigned byte
+#   VALUE_INT                    signed 32 bit big-endian integer
+#   VALUE_NEW_STRING             varint length, bytes; the string is added
+#                                to the string table
+#   VALUE_STRING                 varint index into the string table
+#   VALUE_PAIR                   two values (array bounds)
+#   VALUE_LONG                   zigzag varint, for integers that don't fit
+#                                VALUE_INT (unsigned 32 bit literals)
+#
+# Token names aren't stored; they come from the opcode table.
+
+import json
+import struct
+from tokens import TOKEN_ERROR
+from lspDecoder import OPCODES
+import lspTrace
+
+BINARY_MAGIC = 'LSPT'
+BINARY_VERSION = 1
+
+VALUE_NONE = 0
+VALUE_BYTE = 1
+VALUE_INT = 2
+VALUE_NEW_STRING = 3
+VALUE_STRING = 4
+VALUE_PAIR = 5
+VALUE_LONG = 6
+
+INT_MIN = -0x80000000
+INT_MAX = 0x7FFFFFFF
+
+# Pascal strings and names are Mac Roman bytes; JSON output carries them as
+# the matching unicode characters
+TEXT_ENCODING = 'mac_roman'
+
+# json.dumps makes a new encoder per call for any encoding but UTF-8
+encodeJson = json.JSONEncoder(encoding=TEXT_ENCODING).encode
+
+# not a byte code: marks the end of the token stream for the parser
+TOKEN_EOF = 0x100
+
+
+TOKEN_NAMES = dict((op.code, op.name) for op in OPCODES if op is not None)
+TOKEN_NAMES[TOKEN_EOF] = 'end of file'
+TOKEN_NAMES[TOKEN_ERROR] = 'ERROR'
+
+
+class Token(object):
+    # one token as seen by the parser; the name comes from the opcode table
+    __slots__ = ('id', 'data')
+
+    def __init__(self, id, data):
+        self.id = id
+        self.data = data
+
+    @property
+    def name(self):
+        return TOKEN_NAMES[self.id]
+
+    def __repr__(self):
+        return 'Token(%s, %r)' % (self.name, self.data)
+
+
+class JsonTokenWriter(object):
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, code, name, value):
+        self.out.write(encodeJson([int(code), name, value]) + '\n')
+
+    def close(self):
+        pass
+
+
+def encodeVarint(n):
+    s = ''
+    while n >= 0x80:
+        s += chr((n & 0x7F) | 0x80)
+        n >>= 7
+    return s + chr(n)
+
+
+class BinaryTokenWriter(object):
+    def __init__(self, out):
+        self.out = out
+        self.strings = {}
+        out.write(BINARY_MAGIC + chr(BINARY_VERSION))
+
+    def encodeValue(self, value):
+        if value is None:
+            return chr(VALUE_NONE)
+        elif isinstance(value, str):
+            index = self.strings.get(value)
+            if index is None:
+                self.strings[value] = len(self.strings)
+                return chr(VALUE_NEW_STRING) + encodeVarint(len(value)) + value
+            return chr(VALUE_STRING) + encodeVarint(index)
+        elif isinstance(value, tuple):
+            return chr(VALUE_PAIR) + self.encodeValue(value[0]) + self.encodeValue(value[1])
+        elif 0 <= value < 256:
+            return chr(VALUE_BYTE) + chr(value)
+        elif INT_MIN <= value <= INT_MAX:
+            return chr(VALUE_INT) + struct.pack('>i', value)
+        # zigzag: 0, -1, 1, -2 ... become 0, 1, 2, 3 ...
+        return chr(VALUE_LONG) + encodeVarint(value * 2 if value >= 0 else -value * 2 - 1)
+
+    def write(self, code, name, value):
+        self.out.write(chr(code) + self.encodeValue(value))
+
+    def close(self):
+        pass
+
+
+def readJsonTokens(lines):
+    for line in lines:
+        try:
+            yield json.loads(line)
+        except Exception as e:
+            lspTrace.error('bad token line %r: %s' % (line, e))
+
+
+class BinaryTokenError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def decodeVarint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (n, pos)
+        shift += 7
+
+
+def decodeValue(data, pos, strings):
+    tag = ord(data[pos])
+    pos += 1
+    if tag == VALUE_NONE:
+        return (None, pos)
+    elif tag == VALUE_BYTE:
+        return (ord(data[pos]), pos + 1)
+    elif tag == VALUE_STRING:
+        index, pos = decodeVarint(data, pos)
+        return (strings[index], pos)
+    elif tag == VALUE_NEW_STRING:
+        n, pos = decodeVarint(data, pos)
+        s = data[pos:pos + n]
+        strings.append(s)
+        return (s, pos + n)
+    elif tag == VALUE_INT:
+        return (struct.unpack_from('>i', data, pos)[0], pos + 4)
+    elif tag == VALUE_LONG:
+        n, pos = decodeVarint(data, pos)
+        return (n >> 1 if n & 1 == 0 else -(n + 1 >> 1), pos)
+    elif tag == VALUE_PAIR:
+        first, pos = decodeValue(data, pos, strings)
+        last, pos = decodeValue(data, pos, strings)
+        return ((first, last), pos)
+    raise BinaryTokenError('unknown value tag %02X at offset %d' % (tag, pos - 1))
+
+
+def readBinaryTokens(infile):
+    data = infile.read()
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise BinaryTokenError('not a binary token stream')
+    version = ord(data[len(BINARY_MAGIC)])
+    if version != BINARY_VERSION:
+        raise BinaryTokenError('unsupported binary token stream version %d' % version)
+    strings = []
+    names = TOKEN_NAMES
+    pos = len(BINARY_MAGIC) + 1
+    end = len(data)
+    while pos < end:
+        code = ord(data[pos])
+        tag = ord(data[pos + 1])
+        # the common tags are decoded inline
+        if tag == VALUE_NONE:
+            value = None
+            pos += 2
+        elif tag == VALUE_BYTE:
+            value = ord(data[pos + 2])
+            pos += 3
+        else:
+            value, pos = decodeValue(data, pos + 1, strings)
+        yield [code, names[code], value]
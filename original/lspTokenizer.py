@@ -1,320 +1,198 @@
 #!/usr/bin/python
-# Parse a Lightspeed Pascal source file into a human-readable text file
+# Convert a Lightspeed Pascal source file into a stream of tokens
 
-import json
+import argparse
+import cStringIO
 import sys
 from tokens import *
+from lspArchive import addUnwrapArgument
+from lspDecoder import (OPCODES, DecodeError, addRecoveryArguments, decodeBuffer, decodeFile, decodeInto,
+                        errorBudget, loadFile, tracing)
+from lspParallel import decodeInParallel
+from lspTokenStream import BinaryTokenWriter, JsonTokenWriter
+from lspOutput import addOutputArguments, openOutput, outputFileName
+from lspStats import DecodeStats, StatsSink, addStatsArgument
+import lspColumns
+import lspTrace
 
 
-def skip(f, n):
-    skipped = f.read(n)
-    skipped_str = ' '.join(x.encode('hex') for x in skipped)
-    #sys.stdout.write('{ Skipped %d bytes: %s }' % (n, skipped_str))
+# Each emitter takes a decoded (code, value) record and returns the token
+# for it as an (id, name, data) tuple, or None for a record that couldn't be
+# decoded.  The TRACING_ tables also trace those (see
+# lspDecoder.recordErrors).
 
+def emitToken(code, value):
+    return (code, OPCODES[code].name, value)
 
-def readString(f):
-    n = ord(f.read(1))
-    return f.read(n)
 
+def emitIs(code, value):
+    type_code, x = value
+    if x is None:
+        return None
+    return (code, 'IS', x)
 
-def readInt(f):
-    n = ord(f.read(1))
-    x = 0
-    sign = 1
-    for i in xrange(n):
-        b = ord(f.read(1))
-        if b == 4 and i == 0:
-            sign = -1
-        else:
-            x = x * 256 + b
-    if sign == -1:
-        x -= 65536
-    return x
-
-
-def readArrayRange(f):
-    b = ord(f.read(1))
-    if b == 0:
-        f.read(1)
-        return readString(f)
-    elif b == 3:
-        sign_code = ord(f.read(1))
-        x = ord(f.read(1)) * 256
-        x += ord(f.read(1))
-        if sign_code == 4:
-            x -= 65536
-        return x
-    else:
-        printstr('{ unknown array range %02X }' % b)
-        return '?'
-
-
-def printstr(s):
-    sys.stdout.write(s)
-
-
-def errorstr(s):
-    sys.stderr.write('ERROR: ' + s + '\n')
-
-
-def emit(token, name, value):
-    sys.stdout.write(json.dumps([int(token), name, value]) + '\n')
-
-
-def processFile(infile):
-    while True:
-        b = infile.read(1)
-        if b == '':
-            break
-        b = ord(b)
-        #printstr('{read %02X}' % b)
-        if b == TOKEN_UNIT:
-            skip(infile, 5)
-            name = readString(infile)
-            emit(b, 'unit', name)
-        elif b == TOKEN_PROGRAM:
-            skip(infile, 5)
-            name = readString(infile)
-            emit(b, 'program', name)
-        elif b == TOKEN_INTERFACE:
-            skip(infile, 5)
-            emit(b, 'interface', None)
-        elif b == TOKEN_IMPLEMENTATION:
-            skip(infile, 5)
-            emit(b, 'implementation', None)
-        elif b == TOKEN_COND_COMP:
-            skip(infile, 3)
-            s = readString(infile)
-            emit(b, 'CONDITIONAL', s)
-        elif b == TOKEN_SEMICOLON:
-            n = ord(infile.read(1))
-            emit(b, ';', n)
-        elif b == TOKEN_NEWLINE:
-            n = ord(infile.read(1))
-            emit(b, 'NEWLINE', n)
-        elif b == TOKEN_USES:
-            skip(infile, 1)
-            emit(b, 'uses', None)
-        elif b == TOKEN_IDENTIFIER:
-            skip(infile, 1)
-            name = readString(infile)
-            emit(b, 'IDENTIFIER_1', name)
-        elif b == TOKEN_IDENTIFIER2:
-            name = readString(infile)
-            emit(b, 'IDENTIFIER_2', name)
-        elif b == TOKEN_COMMA:
-            n = ord(infile.read(1))
-            emit(b, ',', n)
-        elif b == TOKEN_CONST:
-            skip(infile, 1)
-            emit(b, 'const', None)
-        elif b == TOKEN_COMMENT:
-            skip(infile, 3)
-            comment = readString(infile)
-            emit(b, 'COMMENT', comment)
-        elif b == TOKEN_CONST_DEF:
-            skip(infile, 1)
-            name = readString(infile)
-            emit(b, 'CONST_DEF', name)
-        elif b == TOKEN_IS:
-            type_code = ord(infile.read(1))
-            if type_code == 3:
-                x = readInt(infile)
-                emit(b, 'IS', x)
-            elif type_code == 5:
-                skip(infile, 4)
-                value = readString(infile)
-                emit(b, 'IS', value)
-            else:
-                errorstr('unknown type code %02X' % type_code)
-        elif b == TOKEN_POINTER:
-            skip(infile, 1)
-            value = readString(infile)
-            emit(b, '^', value)
-        elif b == TOKEN_PACKED_A:
-            skip(infile, 1)
-            emit(b, 'packedA', None)
-        elif b == TOKEN_PACKED_R:
-            skip(infile, 1)
-            emit(b, 'packedR', None)
-        elif b == TOKEN_RECORD:
-            skip(infile, 1)
-            emit(b, 'record', None)
-        elif b == TOKEN_TYPE:
-            skip(infile, 1)
-            emit(b, 'type', None)
-        elif b == TOKEN_ARRAY:
-            skip(infile, 1)
-            first = readArrayRange(infile)
-            last = readArrayRange(infile)
-            emit(b, 'array', (first, last))
-        elif b == TOKEN_OF:
-            skip(infile, 1)
-            emit(b, 'of', None)
-        elif b == TOKEN_COLON:
-            n = ord(infile.read(1))
-            emit(b, ':', n)
-        elif b == TOKEN_END:
-            skip(infile, 1)
-            emit(b, 'end', None)
-        elif b == TOKEN_STRING:
-            skip(infile, 1)
-            n = readInt(infile)
-            emit(b, 'String', n);
-        elif b == TOKEN_VAR:
-            skip(infile, 1)
-            emit(b, 'var', None)
-        elif b == TOKEN_FUNCTION:
-            skip(infile, 5)
-            name = readString(infile)
-            emit(b, 'function', name)
-        elif b == TOKEN_LPAREN:
-            skip(infile, 1);
-            emit(b, '(1', None)
-        elif b == TOKEN_RPAREN:
-            skip(infile, 1)
-            emit(b, ')1', None)
-        elif b == TOKEN_PROCEDURE:
-            skip(infile, 5)
-            name = readString(infile)
-            emit(b, 'procedure', name)
-        elif b == TOKEN_BEGIN:
-            skip(infile, 9)
-            emit(b, 'begin', None)
-        elif b == TOKEN_WITH:
-            skip(infile, 1)
-            emit(b, 'with', None)
-        elif b == TOKEN_IF:
-            skip(infile, 1)
-            emit(b, 'if', None)
-        elif b == TOKEN_STATEMENT:
-            skip(infile, 1)
-            emit(b, 'STATEMENT', None)
-        elif b == TOKEN_ELSE:
-            skip(infile, 1)
-            emit(b, 'else', None)
-        elif b == TOKEN_OR:
-            emit(b, 'or', None)
-        elif b == TOKEN_EQUALS:
-            emit(b, '=', None)
-        elif b == TOKEN_NOT_EQUALS:
-            emit(b, '<>', None)
-        elif b == TOKEN_GETS:
-            emit(b, ':=', None)
-        elif b == TOKEN_LPAREN2:
-            emit(b, '(2', None)
-        elif b == TOKEN_RPAREN2:
-            emit(b, ')2', None)
-        elif b == TOKEN_COMMA2 or b == TOKEN_COMMA3:
-            emit(b, ',', None)
-        elif b == TOKEN_INTEGER:
-            type_code = ord(infile.read(1))
-            if type_code == 0x04:
-                x = ord(infile.read(1)) * 256 * 256 * 256
-                x += ord(infile.read(1)) * 256 * 256
-                x += ord(infile.read(1)) * 256
-                x += ord(infile.read(1))
-                emit(b, 'INTEGER', x)
-            elif type_code == 0x03:
-                x = ord(infile.read(1)) * 256
-                x += ord(infile.read(1))
-                emit(b, 'INTEGER', x)
-            elif type_code == 0x02:
-                s = readString(infile)
-                sh = ''.join(c.encode('hex') for c in s)
-                printstr('trouble: %s --> %s' % (s, sh))
-                emit(b, 'INTEGER', sh)
-            elif type_code == 0x05:
-                s = readString(infile)
-                emit(b, 'INTEGER', s)
-            elif type_code == 0x0A:
-                skip(infile, 2)
-                s = readString(infile)
-                emit(b, 'INTEGER', s)
-            else:
-                errorstr('unknown number code %02X' % type_code)
-        elif b == TOKEN_TIMES:
-            emit(b, '*', None)
-        elif b == TOKEN_MOD:
-            emit(b, 'mod', None)
-        elif b == TOKEN_SLASH:
-            emit(b, '/', None)
-        elif b == TOKEN_DIV:
-            emit(b, 'div', None)
-        elif b == TOKEN_SPACE:
-            emit(b, 'SPACE', None)
-        elif b == TOKEN_LESS_EQUAL:
-            emit(b, '<=', None)
-        elif b == TOKEN_GR_EQUAL:
-            emit(b, '>=', None)
-        elif b == TOKEN_LBRACKET:
-            emit(b, '[', None)
-        elif b == TOKEN_RBRACKET:
-            emit(b, ']', None)
-        elif b == TOKEN_IN:
-            emit(b, 'in', None)
-        elif b == TOKEN_RANGE:
-            emit(b, '..', None)
-        elif b == TOKEN_PLUS:
-            emit(b, '+', None)
-        elif b == TOKEN_MINUS:
-            emit(b, '-', None)
-        elif b == TOKEN_NULL:
-            emit(b, 'null', None)
-        elif b == TOKEN_HYPHEN:
-            emit(b, '-', None)
-        elif b == TOKEN_CASE:
-            skip(infile, 1)
-            emit(b, 'case', None)
-        elif b == TOKEN_DO:
-            skip(infile, 1)
-            emit(b, 'do', None)
-        elif b == TOKEN_FOR:
-            skip(infile, 1)
-            s = readString(infile)
-            emit(b, 'for', s)
-        elif b == TOKEN_AT:
-            emit(b, '@', None)
-        elif b == TOKEN_WHILE:
-            skip(infile, 1)
-            emit(b, 'while_1', None)
-        elif b == TOKEN_WHILE2:
-            skip(infile, 1)
-            emit(b, 'while_2', None)
-        elif b == TOKEN_DEFAULT:
-            skip(infile, 1)
-            emit(b, 'default', None)
-        elif b == TOKEN_NOT:
-            emit(b, 'not', None)
-        elif b == TOKEN_AND:
-            emit(b, 'and', None)
-        elif b == TOKEN_LESS_THAN:
-            emit(b, '<', None)
-        elif b == TOKEN_GREATER_THAN:
-            emit(b, '>', None)
-        elif b == TOKEN_DOT:
-            emit(b, '.', None)
-        elif b == TOKEN_DEREFERENCE:
-            emit(b, '^', None)
-        elif b == TOKEN_TO:
-            emit(b, 'to', None)
-        elif b == TOKEN_DOWN_TO:
-            emit(b, 'down to', None)
-        elif b == TOKEN_PERIOD:
-            skip(infile, 3)
-            emit(b, '.', None)
-        else:
-            errorstr('unknown byte %02X' % b)
-            pass
 
+def emitInteger(code, value):
+    type_code, x = value
+    if x is None:
+        return None
+    elif type_code == 0x02:
+        sh = ''.join(c.encode('hex') for c in x)
+        lspTrace.warning('trouble: %s --> %s' % (x, sh))
+        return (code, 'INTEGER', sh)
+    return (code, 'INTEGER', x)
+
+
+def emitUnknown(code, value):
+    return None
+
+
+def emitError(code, value):
+    if value is None:
+        return emitUnknown(code, value)
+    return (code, 'ERROR', value)
+
+
+def emitNothing(code, value):
+    return None
+
+
+EMITTERS = [emitUnknown if op is None else emitToken for op in OPCODES]
+EMITTERS[TOKEN_IS] = emitIs
+EMITTERS[TOKEN_INTEGER] = emitInteger
+EMITTERS[TOKEN_ERROR] = emitError
+
+# the same, dropping trivia (spaces and newlines) at the source
+SIGNIFICANT_EMITTERS = list(EMITTERS)
+SIGNIFICANT_EMITTERS[TOKEN_SPACE] = emitNothing
+SIGNIFICANT_EMITTERS[TOKEN_NEWLINE] = emitNothing
+
+TRACING_EMITTERS = tracing(EMITTERS)
+TRACING_SIGNIFICANT_EMITTERS = tracing(SIGNIFICANT_EMITTERS)
 
-if len(sys.argv) != 2:
-    print 'Usage:', sys.argv[0], '<encoded Pascal source file>'
-    exit(0)
 
-infilename = sys.argv[1]
-outfilename = infilename + '.p'
+def processRecords(records, trivia=True):
+    # yields an (id, name, data) tuple per token
+    emitters = TRACING_EMITTERS if trivia else TRACING_SIGNIFICANT_EMITTERS
+    for code, value in records:
+        token = emitters[code](code, value)
+        if token is not None:
+            yield token
 
-with open(infilename, 'rb') as infile:
-    processFile(infile)
 
+class TokenSink(object):
+    # writes the tokens of records decoded once for several outputs (see
+    # lspSinks) to any number of token writers, each token made once;
+    # decodeInto traces the errors
+    def __init__(self, writers, trivia=True):
+        self.writers = writers
+        self.writes = [writer.write for writer in writers]
+        self.emitters = EMITTERS if trivia else SIGNIFICANT_EMITTERS
+
+    def record(self, offset, code, value):
+        token = self.emitters[code](code, value)
+        if token is not None:
+            for write in self.writes:
+                write(*token)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+            writer.out.close()
+
+
+def processFile(infile, stream=False, trivia=True, stats=None, maxErrors=None, unwrap=False):
+    return processRecords(decodeFile(infile, stream, stats, maxErrors, unwrap), trivia)
+
+
+def writeTokens(infile, writer, stream=False, trivia=True, stats=None, maxErrors=None, unwrap=False):
+    write = writer.write
+    for code, name, value in processFile(infile, stream, trivia, stats, maxErrors, unwrap):
+        write(code, name, value)
+    writer.close()
+
+
+def writeColumns(infilename, out, trivia=True, stats=None, maxErrors=None, unwrap=False):
+    # a one-file lspColumns store, which needs each token's offset
+    with open(infilename, 'rb') as infile:
+        data = loadFile(infile, unwrap)
+    sinks = [lspColumns.ColumnSink(lspColumns.ColumnWriter(), infilename, len(data), trivia, out)]
+    if stats is not None:
+        sinks.append(StatsSink(stats, len(data), infilename))
+    decodeInto(data, sinks, maxErrors=maxErrors)
+
+
+def convertFile(infilename, outfilename=None, stream=False, binary=False, trivia=True, stats=None,
+                maxErrors=None, columns=False, unwrap=False):
+    out = openOutput(outfilename)
+    if columns:
+        writeColumns(infilename, out, trivia, stats, maxErrors, unwrap)
+        return
+    if binary:
+        writer = BinaryTokenWriter(out)
+    else:
+        writer = JsonTokenWriter(out)
+    with open(infilename, 'rb') as infile:
+        writeTokens(infile, writer, stream, trivia, stats, maxErrors, unwrap)
+    out.close()
+
+
+def renderSpan(task):
+    # one piece of a unit being decoded by lspParallel, as JSON lines
+    infilename, start, end, unwrap, trivia = task
+    with open(infilename, 'rb') as infile:
+        data = loadFile(infile, unwrap)
+    out = cStringIO.StringIO()
+    writer = JsonTokenWriter(out)
+    for code, name, value in processRecords(decodeBuffer(data, start, end), trivia):
+        writer.write(code, name, value)
+    return out.getvalue()
+
+
+def convertFileParallel(infilename, outfilename=None, trivia=True, jobs=None, unwrap=False):
+    out = openOutput(outfilename)
+    for text in decodeInParallel(infilename, renderSpan, jobs, (trivia,), unwrap):
+        out.write(text)
+    out.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert an encoded Lightspeed Pascal source file into a JSON token stream.')
+    parser.add_argument('infilename', metavar='file', help='encoded Pascal source file')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the file a byte at a time instead of mapping it whole')
+    formats = parser.add_mutually_exclusive_group()
+    formats.add_argument('--binary', action='store_true',
+                         help='write the compact binary token format instead of JSON lines')
+    formats.add_argument('--columns', action='store_true',
+                         help='write a columnar store (see lspColumns) instead of JSON lines')
+    parser.add_argument('--no-trivia', dest='trivia', action='store_false',
+                        help='leave out SPACE and NEWLINE tokens')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='n',
+                        help='decode large units on n cores (0: one per CPU), split at routine boundaries '
+                        '(JSON output only; default: 1)')
+    addRecoveryArguments(parser)
+    addOutputArguments(parser, '.tokens')
+    addStatsArgument(parser)
+    addUnwrapArgument(parser)
+    lspTrace.addArguments(parser)
+    args = parser.parse_args()
+    lspTrace.configure(args)
+    if args.stream and args.recover:
+        parser.error('--recover looks ahead through the whole file, so it can\'t be used with --stream')
+
+    infilename = args.infilename
+    outfilename = outputFileName(args, infilename, '.tokens')
+    stats = DecodeStats() if args.stats else None
+    maxErrors = errorBudget(args)
+    try:
+        if args.jobs != 1 and not (args.stream or args.binary or args.columns or stats or args.recover):
+            convertFileParallel(infilename, outfilename, args.trivia, args.jobs, args.unwrap)
+        else:
+            convertFile(infilename, outfilename, args.stream, args.binary, args.trivia, stats, maxErrors,
+                        args.columns, args.unwrap)
+    except DecodeError as e:
+        lspTrace.error('%s: %s' % (infilename, e.value))
+        sys.exit(1)
+    if stats:
+        stats.write(args.stats)
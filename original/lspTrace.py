@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# Levelled diagnostics for the Lightspeed Pascal (LSP) tools.
+#
+# Messages go to stderr so the tools' real output can be piped.  error,
+# warning, info and debug are rebound by setLevel: a level that is off is
+# the no-op function, so a disabled trace call costs only the call itself.
+# Per-token tracing in hot loops should also test `level` once, outside the
+# loop, and not make the call at all.
+
+import sys
+
+QUIET = 0
+ERROR = 1
+WARNING = 2
+INFO = 3
+DEBUG = 4
+
+level = WARNING
+
+
+def noop(s):
+    pass
+
+
+def writeError(s):
+    sys.stderr.write('ERROR: ' + s + '\n')
+
+
+def writeWarning(s):
+    sys.stderr.write('WARNING: ' + s + '\n')
+
+
+def writeMessage(s):
+    sys.stderr.write(s + '\n')
+
+
+def setLevel(n):
+    global level, error, warning, info, debug
+    level = n
+    error = writeError if n >= ERROR else noop
+    warning = writeWarning if n >= WARNING else noop
+    info = writeMessage if n >= INFO else noop
+    debug = writeMessage if n >= DEBUG else noop
+
+
+setLevel(level)
+
+
+def addArguments(parser):
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='report progress; give twice to trace every token')
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help='hide warnings; give twice to hide errors too')
+
+
+def configure(args):
+    setLevel(max(QUIET, min(DEBUG, WARNING + args.verbose - args.quiet)))
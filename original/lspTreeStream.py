@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# Parse tree sinks for lspParser.py.
+#
+# The parser reports the outer structure of a unit as events -- an object
+# or array opens, a finished subtree (one declaration, say) is added, the
+# container closes -- and each sink does something different with them:
+#
+#   TreeBuilder       builds the whole tree in memory, as parseFile returns
+#   JsonTreeWriter    writes the same JSON as writeTree, a subtree at a
+#                     time, so nothing is kept once it has been written
+#   NdjsonTreeWriter  writes one line per subtree: {"unit.body.interface":
+#                     {...}}, keyed by the path of enclosing keys
+#
+# A key is given for each event inside an object, and None inside an array
+# or at the top level.  finish() ends whatever containers are still open,
+# so a parse that stops early still leaves a complete document.
+
+import json
+from lspTokenStream import TEXT_ENCODING
+
+
+class TreeBuilder(object):
+    def __init__(self):
+        self.stack = []
+        self.tree = None
+
+    def add(self, value, key=None):
+        if not self.stack:
+            self.tree = value
+        elif key is None:
+            self.stack[-1].append(value)
+        else:
+            self.stack[-1][key] = value
+
+    def beginObject(self, key=None):
+        container = {}
+        self.add(container, key)
+        self.stack.append(container)
+
+    def beginArray(self, key=None):
+        container = []
+        self.add(container, key)
+        self.stack.append(container)
+
+    def end(self):
+        self.stack.pop()
+
+    def finish(self):
+        del self.stack[:]
+
+
+class JsonTreeWriter(object):
+    def __init__(self, out, indent=2):
+        self.out = out
+        self.indent = indent
+        # [closing bracket, anything written yet] per open container
+        self.stack = []
+
+    def dumps(self, value):
+        text = json.dumps(value, indent=self.indent, separators=(',', ': '), encoding=TEXT_ENCODING)
+        return text.replace('\n', '\n' + ' ' * (self.indent * len(self.stack)))
+
+    def start(self, key):
+        # separator, newline and indentation before an item
+        if self.stack:
+            container = self.stack[-1]
+            self.out.write((',\n' if container[1] else '\n') + ' ' * (self.indent * len(self.stack)))
+            container[1] = True
+        if key is not None:
+            self.out.write(json.dumps(key, encoding=TEXT_ENCODING) + ': ')
+
+    def add(self, value, key=None):
+        self.start(key)
+        self.out.write(self.dumps(value))
+        if not self.stack:
+            self.out.write('\n')
+
+    def beginObject(self, key=None):
+        self.start(key)
+        self.out.write('{')
+        self.stack.append(['}', False])
+
+    def beginArray(self, key=None):
+        self.start(key)
+        self.out.write('[')
+        self.stack.append([']', False])
+
+    def end(self):
+        close, written = self.stack.pop()
+        if written:
+            self.out.write('\n' + ' ' * (self.indent * len(self.stack)))
+        self.out.write(close)
+        if not self.stack:
+            self.out.write('\n')
+
+    def finish(self):
+        while self.stack:
+            self.end()
+
+
+class NdjsonTreeWriter(object):
+    def __init__(self, out):
+        self.out = out
+        self.path = []
+
+    def add(self, value, key=None):
+        path = '.'.join(k for k in self.path + [key] if k is not None)
+        self.out.write(json.dumps({ path: value }, separators=(',', ':'), encoding=TEXT_ENCODING) + '\n')
+
+    def beginObject(self, key=None):
+        self.path.append(key)
+
+    beginArray = beginObject
+
+    def end(self):
+        self.path.pop()
+
+    def finish(self):
+        del self.path[:]
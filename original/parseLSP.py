@@ -1,304 +1,273 @@
 #!/usr/bin/python
 # Parse a Lightspeed Pascal source file into a human-readable text file
 
+import argparse
+import cStringIO
 import sys
 from tokens import *
+from lspArchive import addUnwrapArgument
+from lspDecoder import (DecodeError, UnknownRange, addRecoveryArguments, decodeBuffer, decodeFile,
+                        decodeRecovering, errorBudget, loadFile, tracing)
+from lspIndex import findRoutine, loadIndex
+from lspParallel import decodeInParallel
+from lspOutput import addOutputArguments, openOutput, outputFileName
+from lspStats import DecodeStats, addStatsArgument
+import lspTrace
 
 
-def skip(f, n):
-    skipped = f.read(n)
-    skipped_str = ' '.join(x.encode('hex') for x in skipped)
-    #sys.stdout.write('{ Skipped %d bytes: %s }' % (n, skipped_str))
+# Each renderer takes (code, value) and returns the text for that record,
+# marking anything that couldn't be decoded; TRACING_RENDERERS also traces
+# it (see lspDecoder.recordErrors).
 
+def text(s):
+    return lambda code, value: s
 
-def readString(f):
-    n = ord(f.read(1))
-    return f.read(n)
 
+def format(fmt):
+    return lambda code, value: fmt % value
 
-def readInt(f):
-    n = ord(f.read(1))
-    x = 0
-    sign = 1
-    for i in xrange(n):
-        b = ord(f.read(1))
-        if b == 4 and i == 0:
-            sign = -1
-        else:
-            x = x * 256 + b
-    if sign == -1:
-        x -= 65536
+
+def repeat(s):
+    return lambda code, n: s * n
+
+
+def renderIs(code, value):
+    type_code, x = value
+    if x is None:
+        return '{ unknown type code %02X }' % type_code
+    elif type_code == 3:
+        return ' %d' % x
     return x
 
 
-def readArrayRange(f):
-    b = ord(f.read(1))
-    if b == 0:
-        f.read(1)
-        return readString(f)
-    elif b == 3:
-        sign_code = ord(f.read(1))
-        x = ord(f.read(1)) * 256
-        x += ord(f.read(1))
-        if sign_code == 4:
-            x -= 65536
-        return x
-    else:
-        printstr('{ unknown array range %02X }' % b)
-        return '?'
-
-
-def printstr(s):
-    sys.stdout.write(s)
-
-
-def processFile(infile):
-    while True:
-        b = infile.read(1)
-        if b == '':
-            break
-        b = ord(b)
-        #printstr('{read %02X}' % b)
-        if b == TOKEN_UNIT:
-            skip(infile, 5)
-            name = readString(infile)
-            printstr('unit %s' % name)
-        elif b == TOKEN_PROGRAM:
-            skip(infile, 5)
-            name = readString(infile)
-            printstr('program %s' % name)
-        elif b == TOKEN_INTERFACE:
-            skip(infile, 5)
-            printstr('interface')
-        elif b == TOKEN_IMPLEMENTATION:
-            skip(infile, 5)
-            printstr('implementation')
-        elif b == TOKEN_COND_COMP:
-            skip(infile, 3)
-            s = readString(infile)
-            printstr('{CONDITIONAL:} %s\n' % s)
-        elif b == TOKEN_SEMICOLON:
-            n = ord(infile.read(1))
-            printstr(';\n' * n)
-        elif b == TOKEN_NEWLINE:
-            n = ord(infile.read(1))
-            printstr('\n' * n)
-        elif b == TOKEN_USES:
-            skip(infile, 1)
-            printstr('uses ')
-        elif b == TOKEN_IDENTIFIER:
-            skip(infile, 1)
-            name = readString(infile)
-            printstr(name)
-        elif b == TOKEN_IDENTIFIER2:
-            name = readString(infile)
-            printstr(name)
-        elif b == TOKEN_COMMA:
-            n = ord(infile.read(1))
-            printstr(', ' * n)
-        elif b == TOKEN_CONST:
-            skip(infile, 1)
-            printstr('const\n')
-        elif b == TOKEN_COMMENT:
-            skip(infile, 3)
-            comment = readString(infile)
-            printstr('%s\n' % comment)
-        elif b == TOKEN_CONST_DEF:
-            skip(infile, 1)
-            name = readString(infile)
-            printstr('%s =' % name)
-        elif b == TOKEN_IS:
-            type_code = ord(infile.read(1))
-            if type_code == 3:
-                x = readInt(infile)
-                printstr(' %d' % x)
-            elif type_code == 5:
-                skip(infile, 4)
-                value = readString(infile)
-                printstr(value)
-            else:
-                printstr('{ unknown type code %02X }' % type_code)
-        elif b == TOKEN_POINTER:
-            skip(infile, 1)
-            value = readString(infile)
-            printstr(' ^%s' % value)
-        elif b == TOKEN_PACKED_A or b == TOKEN_PACKED_R:
-            skip(infile, 1)
-            printstr(' packed ')
-        elif b == TOKEN_RECORD:
-            skip(infile, 1)
-            printstr(' record\n')
-        elif b == TOKEN_TYPE:
-            skip(infile, 1)
-            printstr('type')
-        elif b == TOKEN_ARRAY:
-            skip(infile, 1)
-            first = readArrayRange(infile)
-            last = readArrayRange(infile)
-            printstr('array [%s..%s]' % (first, last))
-        elif b == TOKEN_OF:
-            skip(infile, 1)
-            printstr(' of ')
-        elif b == TOKEN_COLON:
-            n = ord(infile.read(1))
-            printstr(': ' * n)
-        elif b == TOKEN_END:
-            skip(infile, 1)
-            printstr('end')
-        elif b == TOKEN_STRING:
-            skip(infile, 1)
-            n = readInt(infile)
-            printstr('String[%d]' % n);
-        elif b == TOKEN_VAR:
-            skip(infile, 1)
-            printstr('var\n')
-        elif b == TOKEN_FUNCTION:
-            skip(infile, 5)
-            name = readString(infile)
-            printstr('function %s' % name)
-        elif b == TOKEN_LPAREN:
-            skip(infile, 1);
-            printstr('(')
-        elif b == TOKEN_RPAREN:
-            skip(infile, 1)
-            printstr(')')
-        elif b == TOKEN_PROCEDURE:
-            skip(infile, 5)
-            name = readString(infile)
-            printstr('procedure %s' % name)
-        elif b == TOKEN_BEGIN:
-            skip(infile, 9)
-            printstr('\nbegin\n')
-        elif b == TOKEN_WITH:
-            skip(infile, 1)
-            printstr('with ')
-        elif b == TOKEN_IF:
-            skip(infile, 1)
-            printstr('\nif ')
-        elif b == TOKEN_STATEMENT:
-            skip(infile, 1)
-            printstr('\n')
-        elif b == TOKEN_ELSE:
-            skip(infile, 1)
-            printstr('\nelse\n')
-        elif b == TOKEN_OR:
-            printstr(' or ')
-        elif b == TOKEN_EQUALS:
-            printstr(' = ')
-        elif b == TOKEN_NOT_EQUALS:
-            printstr(' <> ')
-        elif b == TOKEN_GETS:
-            printstr(' := ')
-        elif b == TOKEN_LPAREN2:
-            printstr('(')
-        elif b == TOKEN_RPAREN2:
-            printstr(')')
-        elif b == TOKEN_COMMA2 or b == TOKEN_COMMA3:
-            printstr(', ')
-        elif b == TOKEN_INTEGER:
-            type_code = ord(infile.read(1))
-            if type_code == 0x04:
-                x = ord(infile.read(1)) * 256 * 256 * 256
-                x += ord(infile.read(1)) * 256 * 256
-                x += ord(infile.read(1)) * 256
-                x += ord(infile.read(1))
-                printstr('%d' % x)
-            elif type_code == 0x03:
-                x = ord(infile.read(1)) * 256
-                x += ord(infile.read(1))
-                printstr('%d' % x)
-            elif type_code == 0x02:
-                s = readString(infile)
-                printstr('\'%s\'' % s)
-            elif type_code == 0x05:
-                s = readString(infile)
-                printstr('"%s"' % s)
-            elif type_code == 0x0A:
-                skip(infile, 2)
-                s = readString(infile)
-                printstr(s)
-            else:
-                printstr('unknown number code %02X' % type_code)
-        elif b == TOKEN_TIMES:
-            printstr(' * ')
-        elif b == TOKEN_MOD:
-            printstr(' mod ')
-        elif b == TOKEN_SLASH:
-            printstr(' / ')
-        elif b == TOKEN_DIV:
-            printstr(' div ')
-        elif b == TOKEN_SPACE:
-            printstr(' ')
-        elif b == TOKEN_LESS_EQUAL:
-            printstr(' <= ')
-        elif b == TOKEN_GR_EQUAL:
-            printstr(' >= ')
-        elif b == TOKEN_LBRACKET:
-            printstr('[')
-        elif b == TOKEN_RBRACKET:
-            printstr(']')
-        elif b == TOKEN_IN:
-            printstr(' in ')
-        elif b == TOKEN_RANGE:
-            printstr('..')
-        elif b == TOKEN_PLUS:
-            printstr(' + ')
-        elif b == TOKEN_MINUS:
-            printstr(' - ')
-        elif b == TOKEN_NULL:
-            printstr('null')
-        elif b == TOKEN_HYPHEN:
-            printstr('-')
-        elif b == TOKEN_CASE:
-            skip(infile, 1)
-            printstr('case ')
-        elif b == TOKEN_DO:
-            skip(infile, 1)
-            printstr('do\n')
-        elif b == TOKEN_FOR:
-            skip(infile, 1)
-            s = readString(infile)
-            printstr('for %s := ' % s)
-        elif b == TOKEN_AT:
-            printstr('@')
-        elif b == TOKEN_WHILE or b == TOKEN_WHILE2:
-            skip(infile, 1)
-            printstr('\nwhile ')
-        elif b == TOKEN_DEFAULT:
-            skip(infile, 1)
-            printstr('default')
-        elif b == TOKEN_NOT:
-            printstr(' not ')
-        elif b == TOKEN_AND:
-            printstr(' and ')
-        elif b == TOKEN_LESS_THAN:
-            printstr(' < ')
-        elif b == TOKEN_GREATER_THAN:
-            printstr(' > ')
-        elif b == TOKEN_DOT:
-            printstr('.')
-        elif b == TOKEN_DEREFERENCE:
-            printstr('^')
-        elif b == TOKEN_TO:
-            printstr(' to ')
-        elif b == TOKEN_DOWN_TO:
-            printstr(' down to ')
-        elif b == TOKEN_PERIOD:
-            skip(infile, 3)
-            printstr('.\n')
-        else:
-            printstr('{ unknown byte %02X }' % b)
-            pass
+def renderArray(code, value):
+    s = ''
+    for bound in value:
+        if isinstance(bound, UnknownRange):
+            s += '{ unknown array range %02X }' % bound.kind
+    return s + 'array [%s..%s]' % value
+
+
+def renderInteger(code, value):
+    type_code, x = value
+    if x is None:
+        return 'unknown number code %02X' % type_code
+    elif type_code == 0x04 or type_code == 0x03:
+        return '%d' % x
+    elif type_code == 0x02:
+        return '\'%s\'' % x
+    elif type_code == 0x05:
+        return '"%s"' % x
+    return x
+
+
+def renderUnknown(code, value):
+    return '{ unknown byte %02X }' % code
+
+
+def renderError(code, value):
+    if value is None:
+        # a stray byte that happens to be TOKEN_ERROR
+        return renderUnknown(code, value)
+    start, end = value
+    return '{ %d damaged bytes skipped at offset %d }' % (end - start, start)
+
+
+RENDERERS = [renderUnknown] * 256
+RENDERERS[TOKEN_UNIT] = format('unit %s')
+RENDERERS[TOKEN_PROGRAM] = format('program %s')
+RENDERERS[TOKEN_INTERFACE] = text('interface')
+RENDERERS[TOKEN_IMPLEMENTATION] = text('implementation')
+RENDERERS[TOKEN_COND_COMP] = format('{CONDITIONAL:} %s\n')
+RENDERERS[TOKEN_SEMICOLON] = repeat(';\n')
+RENDERERS[TOKEN_NEWLINE] = repeat('\n')
+RENDERERS[TOKEN_USES] = text('uses ')
+RENDERERS[TOKEN_IDENTIFIER] = format('%s')
+RENDERERS[TOKEN_IDENTIFIER2] = format('%s')
+RENDERERS[TOKEN_COMMA] = repeat(', ')
+RENDERERS[TOKEN_CONST] = text('const\n')
+RENDERERS[TOKEN_COMMENT] = format('%s\n')
+RENDERERS[TOKEN_CONST_DEF] = format('%s =')
+RENDERERS[TOKEN_IS] = renderIs
+RENDERERS[TOKEN_POINTER] = format(' ^%s')
+RENDERERS[TOKEN_PACKED_A] = text(' packed ')
+RENDERERS[TOKEN_PACKED_R] = text(' packed ')
+RENDERERS[TOKEN_RECORD] = text(' record\n')
+RENDERERS[TOKEN_TYPE] = text('type')
+RENDERERS[TOKEN_ARRAY] = renderArray
+RENDERERS[TOKEN_OF] = text(' of ')
+RENDERERS[TOKEN_COLON] = repeat(': ')
+RENDERERS[TOKEN_END] = text('end')
+RENDERERS[TOKEN_STRING] = format('String[%d]')
+RENDERERS[TOKEN_VAR] = text('var\n')
+RENDERERS[TOKEN_FUNCTION] = format('function %s')
+RENDERERS[TOKEN_LPAREN] = text('(')
+RENDERERS[TOKEN_RPAREN] = text(')')
+RENDERERS[TOKEN_PROCEDURE] = format('procedure %s')
+RENDERERS[TOKEN_BEGIN] = text('\nbegin\n')
+RENDERERS[TOKEN_WITH] = text('with ')
+RENDERERS[TOKEN_IF] = text('\nif ')
+RENDERERS[TOKEN_STATEMENT] = text('\n')
+RENDERERS[TOKEN_ELSE] = text('\nelse\n')
+RENDERERS[TOKEN_OR] = text(' or ')
+RENDERERS[TOKEN_EQUALS] = text(' = ')
+RENDERERS[TOKEN_NOT_EQUALS] = text(' <> ')
+RENDERERS[TOKEN_GETS] = text(' := ')
+RENDERERS[TOKEN_LPAREN2] = text('(')
+RENDERERS[TOKEN_RPAREN2] = text(')')
+RENDERERS[TOKEN_COMMA2] = text(', ')
+RENDERERS[TOKEN_COMMA3] = text(', ')
+RENDERERS[TOKEN_INTEGER] = renderInteger
+RENDERERS[TOKEN_TIMES] = text(' * ')
+RENDERERS[TOKEN_MOD] = text(' mod ')
+RENDERERS[TOKEN_SLASH] = text(' / ')
+RENDERERS[TOKEN_DIV] = text(' div ')
+RENDERERS[TOKEN_SPACE] = text(' ')
+RENDERERS[TOKEN_LESS_EQUAL] = text(' <= ')
+RENDERERS[TOKEN_GR_EQUAL] = text(' >= ')
+RENDERERS[TOKEN_LBRACKET] = text('[')
+RENDERERS[TOKEN_RBRACKET] = text(']')
+RENDERERS[TOKEN_IN] = text(' in ')
+RENDERERS[TOKEN_RANGE] = text('..')
+RENDERERS[TOKEN_PLUS] = text(' + ')
+RENDERERS[TOKEN_MINUS] = text(' - ')
+RENDERERS[TOKEN_NULL] = text('null')
+RENDERERS[TOKEN_HYPHEN] = text('-')
+RENDERERS[TOKEN_CASE] = text('case ')
+RENDERERS[TOKEN_DO] = text('do\n')
+RENDERERS[TOKEN_FOR] = format('for %s := ')
+RENDERERS[TOKEN_AT] = text('@')
+RENDERERS[TOKEN_WHILE] = text('\nwhile ')
+RENDERERS[TOKEN_WHILE2] = text('\nwhile ')
+RENDERERS[TOKEN_DEFAULT] = text('default')
+RENDERERS[TOKEN_NOT] = text(' not ')
+RENDERERS[TOKEN_AND] = text(' and ')
+RENDERERS[TOKEN_LESS_THAN] = text(' < ')
+RENDERERS[TOKEN_GREATER_THAN] = text(' > ')
+RENDERERS[TOKEN_DOT] = text('.')
+RENDERERS[TOKEN_DEREFERENCE] = text('^')
+RENDERERS[TOKEN_TO] = text(' to ')
+RENDERERS[TOKEN_DOWN_TO] = text(' down to ')
+RENDERERS[TOKEN_PERIOD] = text('.\n')
+RENDERERS[TOKEN_ERROR] = renderError
+
+TRACING_RENDERERS = tracing(RENDERERS)
 
 
-if len(sys.argv) != 2:
-    print 'Usage:', sys.argv[0], '<encoded Pascal source file>'
-    exit(0)
+def renderRecords(records, out):
+    renderers = TRACING_RENDERERS
+    write = out.write
+    for code, value in records:
+        write(renderers[code](code, value))
 
-infilename = sys.argv[1]
-outfilename = infilename + '.p'
 
-with open(infilename, 'rb') as infile:
-    print '{ Pascal source code from', infilename, '}'
-    processFile(infile)
+class TextSink(object):
+    # renders records decoded once for several outputs (see lspSinks); the
+    # same text as convertFile.  decodeInto traces the errors.
+    def __init__(self, out, infilename):
+        self.out = out
+        self.write = out.write
+        self.renderers = RENDERERS
+        out.write('{ Pascal source code from %s }\n' % infilename)
 
+    def record(self, offset, code, value):
+        self.write(self.renderers[code](code, value))
+
+    def close(self):
+        self.out.close()
+
+
+def processFile(infile, out, stream=False, stats=None, maxErrors=None, unwrap=False):
+    renderRecords(decodeFile(infile, stream, stats, maxErrors, unwrap), out)
+
+
+def convertFile(infilename, outfilename=None, stream=False, stats=None, maxErrors=None, unwrap=False):
+    out = openOutput(outfilename)
+    with open(infilename, 'rb') as infile:
+        out.write('{ Pascal source code from %s }\n' % infilename)
+        processFile(infile, out, stream, stats, maxErrors, unwrap)
+    out.close()
+
+
+def renderSpan(task):
+    # one piece of a unit being decoded by lspParallel
+    infilename, start, end, unwrap = task
+    with open(infilename, 'rb') as infile:
+        data = loadFile(infile, unwrap)
+    out = cStringIO.StringIO()
+    renderRecords(decodeBuffer(data, start, end), out)
+    return out.getvalue()
+
+
+def convertFileParallel(infilename, outfilename=None, jobs=None, unwrap=False):
+    out = openOutput(outfilename)
+    out.write('{ Pascal source code from %s }\n' % infilename)
+    for text in decodeInParallel(infilename, renderSpan, jobs, unwrap=unwrap):
+        out.write(text)
+    out.close()
+
+
+def convertRoutine(infilename, name, outfilename=None, stats=None, maxErrors=None, unwrap=False):
+    # decode just the spans of the unit that the routine index has for name;
+    # returns False if there are none
+    with open(infilename, 'rb') as infile:
+        data = loadFile(infile, unwrap)
+    spans = findRoutine(loadIndex(infilename, data, unwrap=unwrap), name)
+    if not spans:
+        return False
+    out = openOutput(outfilename)
+    out.write('{ Pascal source code for %s from %s }\n' % (name, infilename))
+    for start, end in spans:
+        if stats is not None:
+            records = stats.decode(data, start, end, infilename, maxErrors)
+        elif maxErrors is not None:
+            records = decodeRecovering(data, start, end, maxErrors)
+        else:
+            records = decodeBuffer(data, start, end)
+        renderRecords(records, out)
+        out.write('\n')
+    out.close()
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert an encoded Lightspeed Pascal source file into readable Pascal text.')
+    parser.add_argument('infilename', metavar='file', help='encoded Pascal source file')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the file a byte at a time instead of mapping it whole')
+    parser.add_argument('--routine', metavar='name',
+                        help='only decode the named procedure or function, using the routine index')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='n',
+                        help='decode large units on n cores (0: one per CPU), split at routine boundaries (default: 1)')
+    addRecoveryArguments(parser)
+    addOutputArguments(parser, '.p')
+    addStatsArgument(parser)
+    addUnwrapArgument(parser)
+    lspTrace.addArguments(parser)
+    args = parser.parse_args()
+    lspTrace.configure(args)
+    if args.stream and args.recover:
+        parser.error('--recover looks ahead through the whole file, so it can\'t be used with --stream')
+
+    infilename = args.infilename
+    outfilename = outputFileName(args, infilename, '.p')
+    stats = DecodeStats() if args.stats else None
+    if args.routine:
+        try:
+            found = convertRoutine(infilename, args.routine, outfilename, stats, errorBudget(args), args.unwrap)
+        except DecodeError as e:
+            lspTrace.error('%s: %s' % (infilename, e.value))
+            sys.exit(1)
+        if not found:
+            lspTrace.error('no routine %s in %s' % (args.routine, infilename))
+            sys.exit(1)
+    elif args.jobs != 1 and not (args.stream or stats or args.recover):
+        convertFileParallel(infilename, outfilename, args.jobs, args.unwrap)
+    else:
+        try:
+            convertFile(infilename, outfilename, args.stream, stats, errorBudget(args), args.unwrap)
+        except DecodeError as e:
+            lspTrace.error('%s: %s' % (infilename, e.value))
+            sys.exit(1)
+    if stats:
+        stats.write(args.stats)
@@ -76,3 +76,6 @@ TOKEN_INTERFACE      = 0xC8
 TOKEN_IMPLEMENTATION = 0xCA
 TOKEN_CONST_DEF      = 0xCC
 
+
+# not a record: a run of damaged bytes skipped by the decoder's recovery
+TOKEN_ERROR          = 0xFF